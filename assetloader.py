@@ -0,0 +1,39 @@
+"""Reads and decodes files ahead of time on a thread pool driven by an asyncio event loop.
+
+Everything asked for starts loading at once, so waiting for all of it takes about as long as the slowest one,
+instead of the sum of them. zlib and file reads release the GIL, which is most of what loading a png or layer does."""
+
+import asyncio
+import threading
+import concurrent.futures
+
+class AssetLoader:
+  def __init__(self, threads):
+    self.pool = concurrent.futures.ThreadPoolExecutor(threads)
+    self.loop = asyncio.new_event_loop()
+    self.loop.set_default_executor(self.pool)
+    self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+    self.thread.start()
+    # key -> concurrent.futures.Future, for everything that hasn't been taken yet
+    self.pending = {}
+
+  def load(self, key, function, *args):
+    """starts function(*args) in the background, unless something is already loading for key"""
+    if key in self.pending: return
+    self.pending[key] = asyncio.run_coroutine_threadsafe(self.run(function, args), self.loop)
+
+  async def run(self, function, args):
+    return await self.loop.run_in_executor(None, function, *args)
+
+  def take(self, key):
+    """returns the Future for key and forgets about it, or None if nothing was loading for key"""
+    return self.pending.pop(key, None)
+
+  def close(self):
+    # anything still loading has to finish before the loop can stop cleanly
+    concurrent.futures.wait(self.pending.values())
+    self.pending.clear()
+    self.loop.call_soon_threadsafe(self.loop.stop)
+    self.thread.join()
+    self.loop.close()
+    self.pool.shutdown(wait=True)
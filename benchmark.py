@@ -0,0 +1,289 @@
+#!/usr/bin/env python3
+
+"""Times buildmap2 on synthetic maps laid out like the ffdec export, so it can be measured without the game's assets."""
+
+import os
+import sys
+import io
+import json
+import time
+import random
+import shutil
+import tempfile
+import contextlib
+sys.path.append(os.path.join(os.path.dirname(__file__), "simplepng.py"))
+import simplepng
+import buildmap2
+import pngstream
+
+# map sizes in tiles. a screen is 10x10 tiles.
+default_sizes = ["20x16", "80x64", "200x160"]
+# common entities that have sprites, in roughly the proportions the real maps have them
+entity_names = [
+  "Slime", "Slime", "Dust", "Dust", "Propelled", "Silverfish", "On_Off_Laser", "Pew_Laser",
+  "Shieldy", "Dog", "Gasguy", "Slasher", "Lion", "Annoyer", "Frog", "Rat", "Treasure",
+]
+all_png_modes = ["simplepng"] + sorted(buildmap2.png_modes)
+# physics tiles that don't depend on the map
+physics_char_codes = " #l,<^>vwhs&"
+
+def write_image(path, width, height, rng, transparent=0.2, semitransparent=0.1):
+  """random pixels, some of them transparent or semitransparent"""
+  image = simplepng.ImageBuffer(width, height)
+  for i in range(width * height):
+    r = rng.random()
+    if r < transparent:
+      alpha = 0
+    elif r < transparent + semitransparent:
+      alpha = 0x80
+    else:
+      alpha = 0xff
+    image.data[i] = (rng.getrandbits(24) << 8) | alpha
+  save_image(path, image)
+
+def save_image(path, image):
+  if not os.path.isdir(os.path.dirname(path)):
+    os.makedirs(os.path.dirname(path))
+  with open(path, "wb") as f:
+    writer = pngstream.PngStreamWriter(f, image.width, image.height)
+    writer.write_image_rows(image)
+    writer.finish()
+
+def write_tileset(path, rng):
+  """like a real tileset, most tiles are opaque, some have holes, and a few are semitransparent"""
+  image = simplepng.ImageBuffer(160, 160)
+  for tile_index in range(100):
+    r = rng.random()
+    if r < 0.8:
+      transparent, semitransparent = 0, 0
+    elif r < 0.95:
+      transparent, semitransparent = 0.3, 0
+    else:
+      transparent, semitransparent = 0.1, 0.5
+    for y in range(16):
+      for x in range(16):
+        r = rng.random()
+        if r < transparent:
+          alpha = 0
+        elif r < transparent + semitransparent:
+          alpha = 0x80
+        else:
+          alpha = 0xff
+        image.data[((tile_index // 10) * 16 + y) * 160 + (tile_index % 10) * 16 + x] = (rng.getrandbits(24) << 8) | alpha
+  save_image(path, image)
+
+def write_layer(path, width, height, rng, density):
+  """runs of tiles like a real map has. density is how much of the layer isn't tile 0."""
+  lines = []
+  for y in range(height):
+    row = []
+    while len(row) < width:
+      tile_index = rng.randrange(1, 100) if rng.random() < density else 0
+      row.extend([tile_index] * rng.randint(1, 8))
+    lines.append(",".join(str(tile_index) for tile_index in row[:width]))
+  with open(path, "w") as f:
+    f.write("\n".join(lines) + "\n")
+
+def make_fixture(root, sizes, entity_density, seed=0):
+  """writes the tilesets, layers, sprites and registry for one map per size.
+  returns the list of mapfiles, in the same format as buildmap2.mapfiles."""
+  rng = random.Random(seed)
+  solid_rng = random.Random(seed + 1)
+  for filename in ("physics_tiles.png", "grid_overlay.png", "grid_overlay_solid.png", "blocker_sprite.png", "vblock_sprite.png"):
+    shutil.copy(os.path.join(os.path.dirname(os.path.abspath(__file__)), filename), os.path.join(root, filename))
+  for entity_name in sorted(set(entity_names)):
+    write_image(os.path.join(root, buildmap2.sprite_paths[entity_name]), 64, 64, rng)
+
+  mapfiles = []
+  registry = ["<root>"]
+  for width, height in sizes:
+    map_name = "BENCH_{}x{}".format(width, height)
+    tileset = "data/TileData__{}_Tiles.png".format(map_name)
+    write_tileset(os.path.join(root, tileset), rng)
+    layers = []
+    for suffix, density in (("BG", 0.95), ("BG2", 0.3), ("FG", 0.1)):
+      layer = "data/CSV_Data_{}_{}.dat".format(map_name, suffix)
+      write_layer(os.path.join(root, layer), width, height, rng, density)
+      layers.append(layer)
+    mapfiles.append({
+      "map_name": map_name,
+      "tileset": tileset,
+      "layers": layers,
+      "physics": " " + "".join(rng.choice(physics_char_codes) for _ in range(99)),
+    })
+    registry.append('<map name="{}">'.format(map_name))
+    screens = (width // 10) * (height // 10)
+    for _ in range(int(screens * entity_density)):
+      registry.append('<{} x="{}" y="{}" frame="{}" type="1"/>'.format(
+        rng.choice(entity_names), rng.randrange(width) * 16, rng.randrange(height) * 16, rng.randrange(4)))
+    # the only entities that show up in the physics images.
+    # these come from their own random numbers, so the rest of the fixture is the same as it was before they were added.
+    for _ in range(max(1, screens // 4)):
+      registry.append('<Solid_Sprite x="{}" y="{}" frame="0" type="{}"/>'.format(
+        solid_rng.randrange(width) * 16, solid_rng.randrange(height) * 16, solid_rng.choice(["blocker", "vblock"])))
+    registry.append("</map>")
+  registry.append("</root>")
+  os.makedirs(os.path.join(root, "global"))
+  with open(os.path.join(root, "global", "Registry_EmbedXML.dat"), "w") as f:
+    f.write("\n".join(registry) + "\n")
+  return mapfiles
+
+def best_time(function, repeat):
+  best = None
+  for _ in range(repeat):
+    start = time.perf_counter()
+    function()
+    elapsed = time.perf_counter() - start
+    if best == None or elapsed < best:
+      best = elapsed
+  return best
+
+def run_benchmarks(mapfiles, objects_by_map_name, repeat, png_modes):
+  """returns {name: {"seconds": ..., "tiles_per_second": ..., "mb_per_second": ...}}"""
+  results = {}
+  def record(name, seconds, tiles, size):
+    results[name] = {
+      "seconds": seconds,
+      "tiles_per_second": tiles / seconds,
+      "mb_per_second": size / seconds / 1e6,
+    }
+    print("{:32} {:8.3f}s {:12.0f} tiles/s {:8.2f} MB/s".format(
+      name, seconds, results[name]["tiles_per_second"], results[name]["mb_per_second"]))
+
+  for mapfile in mapfiles:
+    map_name = mapfile["map_name"]
+    layers = buildmap2.read_map_layers(mapfile)
+    width = layers[0].width
+    height = layers[0].height
+    tiles = sum(width * height for layer in layers if layer != None)
+    # every layer gets its own rgba image
+    layer_size = tiles * 16 * 16 * 4
+
+    seconds = best_time(lambda: buildmap2.generate_map_image(mapfile), repeat)
+    record(map_name + "/layers", seconds, tiles, layer_size)
+
+    # only the first two layers count for physics.
+    # this does what render_layers() does with --physics, except that it calls paint_physics() itself,
+    # because generate_map_image() refuses physics on the upper layers of maps it doesn't know.
+    physics_tiles = sum(width * height for layer in layers[:2] if layer != None)
+    def render_physics():
+      for i, layer in enumerate(layers[:2]):
+        if layer == None: continue
+        buildmap2.paint_physics(simplepng.ImageBuffer(width * 16, height * 16), layer, mapfile["physics"], i)
+      with contextlib.redirect_stdout(io.StringIO()):
+        buildmap2.render_physics_entities(simplepng.ImageBuffer(width * 16, height * 16), objects_by_map_name[map_name], map_name)
+    seconds = best_time(render_physics, repeat)
+    record(map_name + "/physics", seconds, physics_tiles, physics_tiles * 16 * 16 * 4)
+
+    entities = objects_by_map_name[map_name]
+    def render():
+      image = simplepng.ImageBuffer(width * 16, height * 16)
+      # the warnings aren't what we're measuring
+      with contextlib.redirect_stdout(io.StringIO()):
+        buildmap2.render_entities(image, entities, map_name)
+    seconds = best_time(render, repeat)
+    record(map_name + "/entities", seconds, width * height, width * height * 16 * 16 * 4)
+
+    image = buildmap2.generate_map_image(mapfile)[0]
+    def write():
+      with io.BytesIO() as f:
+        buildmap2.write_png(f, image)
+    for png_mode in png_modes:
+      buildmap2.png_mode = png_mode
+      try:
+        seconds = best_time(write, repeat)
+      finally:
+        buildmap2.png_mode = "simplepng"
+      record("{}/png/{}".format(map_name, png_mode), seconds, width * height, len(image.data) * 4)
+  return results
+
+def compare_to_baseline(results, baseline, threshold):
+  """returns a list of complaints about anything that got slower by more than threshold"""
+  regressions = []
+  for name, result in sorted(results.items()):
+    if name not in baseline: continue
+    old_rate = baseline[name]["tiles_per_second"]
+    new_rate = result["tiles_per_second"]
+    if new_rate < old_rate * (1 - threshold):
+      regressions.append("{}: {:.0f} tiles/s, down from {:.0f} ({:.0%} slower)".format(
+        name, new_rate, old_rate, 1 - new_rate / old_rate))
+  return regressions
+
+def parse_size(text):
+  width, height = text.split("x")
+  return int(width), int(height)
+
+def main():
+  import argparse
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--sizes", nargs="+", default=default_sizes, help=
+    "map sizes in tiles, like 80x64. default: %(default)s")
+  parser.add_argument("--entity-density", type=float, default=4, help=
+    "entities per screen. default: %(default)s")
+  parser.add_argument("--repeat", type=int, default=3, help=
+    "time each benchmark this many times and keep the best. default: %(default)s")
+  parser.add_argument("--fixture-dir", help=
+    "where to write the synthetic assets. by default they go in a temporary directory that's deleted afterward.")
+  parser.add_argument("--baseline", default="benchmark_baseline.json", help=
+    "results to compare against. default: %(default)s")
+  parser.add_argument("--save-baseline", action="store_true", help=
+    "write these results to the baseline file instead of comparing against it.")
+  parser.add_argument("--threshold", type=float, default=0.2, help=
+    "fail if anything is this much slower than the baseline. default: %(default)s")
+  parser.add_argument("--output", help=
+    "also write the results to this json file.")
+  parser.add_argument("--png-modes", nargs="+", choices=all_png_modes, default=all_png_modes, help=
+    "which buildmap2.py --png-mode encoders to time, each on its own. default: %(default)s")
+  parser.add_argument("--no-numpy", action="store_true", help=
+    "benchmark the code paths that don't use numpy.")
+  args = parser.parse_args()
+  try:
+    sizes = [parse_size(size) for size in args.sizes]
+  except ValueError:
+    parser.error("sizes look like 80x64")
+  if args.repeat < 1:
+    parser.error("--repeat must be positive")
+
+  if args.no_numpy:
+    buildmap2.use_numpy = False
+    buildmap2.imagefilters.use_numpy = False
+
+  fixture_dir = args.fixture_dir
+  if fixture_dir == None:
+    fixture_dir = tempfile.mkdtemp(prefix="anodyne_benchmark_")
+  elif os.path.isdir(fixture_dir):
+    shutil.rmtree(fixture_dir)
+    os.makedirs(fixture_dir)
+  else:
+    os.makedirs(fixture_dir)
+  try:
+    mapfiles = make_fixture(fixture_dir, sizes, args.entity_density)
+    buildmap2.src_root = fixture_dir
+    objects_by_map_name = buildmap2.read_registry()
+    buildmap2.load_sprites()
+    results = run_benchmarks(mapfiles, objects_by_map_name, args.repeat, args.png_modes)
+  finally:
+    if args.fixture_dir == None:
+      shutil.rmtree(fixture_dir)
+
+  if args.output != None:
+    with open(args.output, "w") as f:
+      json.dump(results, f, indent=1, sort_keys=True)
+
+  if args.save_baseline:
+    with open(args.baseline, "w") as f:
+      json.dump(results, f, indent=1, sort_keys=True)
+    print("Wrote baseline: " + args.baseline)
+    return
+  if not os.path.exists(args.baseline):
+    print("No baseline to compare against. Use --save-baseline to make one.")
+    return
+  with open(args.baseline) as f:
+    baseline = json.load(f)
+  regressions = compare_to_baseline(results, baseline, args.threshold)
+  if len(regressions) > 0:
+    sys.exit("ERROR: slower than the baseline:\n" + "\n".join(regressions))
+  print("No regressions compared to: " + args.baseline)
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,46 @@
+"""Remembers which inputs each output was built from, so unchanged maps can be skipped."""
+
+import os
+import json
+import hashlib
+
+def hash_bytes(data):
+  return hashlib.sha1(data).hexdigest()
+
+class BuildCache:
+  def __init__(self, path):
+    self.path = path
+    try:
+      with open(path, "r") as f:
+        self.entries = json.load(f)
+    except (OSError, ValueError):
+      # missing or corrupt. either way, everything is out of date.
+      self.entries = {}
+
+  def is_up_to_date(self, output_name, inputs, hash_file):
+    entry = self.entries.get(output_name)
+    if entry == None: return False
+    if entry["inputs"] != inputs: return False
+    for path in entry["outputs"]:
+      if not os.path.exists(path): return False
+    # the sprites that got used last time are only known after rendering,
+    # so check that they haven't changed since then.
+    for path, digest in entry["sprites"].items():
+      try:
+        if hash_file(path) != digest: return False
+      except OSError:
+        return False
+    return True
+
+  def update(self, output_name, inputs, outputs, sprites):
+    self.entries[output_name] = {
+      "inputs": inputs,
+      "outputs": outputs,
+      "sprites": sprites,
+    }
+
+  def save(self):
+    tmp_path = self.path + ".tmp"
+    with open(tmp_path, "w") as f:
+      json.dump(self.entries, f, indent=1, sort_keys=True)
+    os.replace(tmp_path, self.path)
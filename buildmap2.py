@@ -3,12 +3,31 @@
 
 import os
 import sys
-import csv
 from collections import defaultdict
 import itertools
+import functools
+import io
+import contextlib
+import multiprocessing
+import json
+import array
+import base64
 from xml import sax
 sys.path.append(os.path.join(os.path.dirname(__file__), "simplepng.py"))
 import simplepng
+import buildcache
+import fastpaint
+import tilelayer
+import pngcache
+import registryindex
+import pngstream
+import slippytiles
+import spatialindex
+import spriteatlas
+import tilestamps
+import imagefilters
+import renderprofile
+import assetloader
 
 def find_and_open(filename, mode):
   try: return open(filename, mode)
@@ -23,83 +42,176 @@ def find_and_open(filename, mode):
   # broken
   open(filename, mode)
 
+def find_file(filename):
+  """returns the path find_and_open() would open, or None if there isn't one"""
+  candidates = [filename, os.path.join(src_root, filename)]
+  if filename.endswith(".dat"):
+    candidates.append(os.path.join(src_root, filename[:-len(".dat")]+".bin"))
+  for path in candidates:
+    if os.path.isfile(path):
+      return path
+  return None
+
+# when not None, tilesets and layers stay loaded here between renders, keyed by (filename, fade).
+# whoever sets this is responsible for removing anything that changes on disk.
+loaded_inputs = None
+# when not None, an AssetLoader that might already be reading what we need, with the same keys as loaded_inputs
+asset_loader = None
+
+def get_loaded(key, function, *args):
+  """returns what asset_loader loaded for key, or calls function(*args) now if it didn't"""
+  if asset_loader != None:
+    future = asset_loader.take(key)
+    if future != None:
+      return future.result()
+  return function(*args)
+
 def read_layer(filename):
-  with find_and_open(filename, "r") as f:
-    map_reader = csv.reader(f, delimiter=",")
-    map = []
-    for row in map_reader:
-      map.append(row)
-  return map
+  if loaded_inputs != None and (filename, False) in loaded_inputs:
+    return loaded_inputs[(filename, False)]
+  layer = get_loaded((filename, False), load_layer_file, filename)
+  if loaded_inputs != None:
+    loaded_inputs[(filename, False)] = layer
+  return layer
+
+def load_layer_file(filename):
+  with find_and_open(filename, "rb") as f:
+    return tilelayer.load_layer(f)
+
 
+png_cache = None
 
 def read_tileset(filename, fade=False):
+  if loaded_inputs != None and (filename, fade) in loaded_inputs:
+    return loaded_inputs[(filename, fade)]
+  image = get_loaded((filename, fade), decode_tileset, filename, fade)
+  if loaded_inputs != None:
+    loaded_inputs[(filename, fade)] = image
+  return image
+
+@renderprofile.timed("decode")
+def decode_tileset(filename, fade):
   with find_and_open(filename, "rb") as f:
-    image = simplepng.read_png(f)
+    if png_cache != None:
+      image = png_cache.read_png(f)
+    else:
+      image = simplepng.read_png(f)
   if fade:
     # apply semitransparency by clearing the msb of the alpha channel
-    for i in range(len(image.data)):
-      image.data[i] &= 0xffffff7f
+    imagefilters.fade(image)
   return image
 
+physics_lookups = {}
+def get_physics_lookup(physics_palette, layer_index):
+  """returns a list of physics tile indexes to paint for each tile index, or -1 where nothing gets painted.
+  the last entry is for every tile index past the end of the palette."""
+  key = (physics_palette, layer_index)
+  lookup = physics_lookups.get(key)
+  if lookup != None:
+    return lookup
+  lookup = []
+  for tile_index in range(max(len(physics_palette), 1) + 1):
+    if layer_index != 0 and tile_index == 0:
+      # in GO, GB1 tile 0 is solid, but GB2 tile 0 is open.
+      char_code = " "
+    elif tile_index < len(physics_palette):
+      char_code = physics_palette[tile_index]
+    else:
+      char_code = "#"
+    if layer_index != 0 and char_code == " ":
+      # this is typical for upper layers
+      lookup.append(-1)
+      continue
+    if layer_index == 1 and char_code == "#":
+      # impervious
+      char_code = "&"
+    lookup.append(physics_tileset_char_codes.index(char_code))
+  physics_lookups[key] = lookup
+  return lookup
+
+@renderprofile.timed("paint")
 def paint_physics(image, layer, physics_palette, layer_index):
   if layer_index > 1:
     # foreground never matters for physics
     return False
-  x_blocks = min(image.width // 16, len(layer[0]))
-  y_blocks = min(image.height // 16, len(layer))
+  lookup = get_physics_lookup(physics_palette, layer_index)
+  if use_numpy:
+    return fastpaint.paint_remapped_layer(image, layer, lookup, physics_tileset)
+  last_index = len(lookup) - 1
+  x_blocks = min(image.width // 16, layer.width)
+  y_blocks = min(image.height // 16, layer.height)
+  stamps = get_stamps(physics_tileset)
   found_anything = False
   for y in range(y_blocks):
-    for x in range(x_blocks):
-      tile_index = int(layer[y][x])
-      if layer_index != 0 and tile_index == 0:
-        # in GO, GB1 tile 0 is solid, but GB2 tile 0 is open.
-        char_code = " "
-      else:
-        try:
-          char_code = physics_palette[tile_index]
-        except IndexError:
-          char_code = "#"
-      if layer_index != 0 and char_code == " ":
-        # this is typical for upper layers
-        continue
-      if layer_index == 1 and char_code == "#":
-        # impervious
-        char_code = "&"
+    row = tilelayer.get_row(layer, y)[:x_blocks]
+    # different tiles often have the same physics, so the runs are found after the lookup
+    for x, length, output_tile_index in tilelayer.find_runs([lookup[min(tile_index, last_index)] for tile_index in row], skip=-1):
       found_anything = True
-      output_tile_index = physics_tileset_char_codes.index(char_code)
-      tile_y = output_tile_index // (physics_tileset.width // 16)
-      tile_x = output_tile_index % (physics_tileset.width // 16)
-      image.paste(physics_tileset, sx=tile_x*16, sy=tile_y*16, dx=x*16, dy=y*16, width=16, height=16)
+      stamps.paste(image, output_tile_index, x, y, length)
   return found_anything
 
+use_numpy = fastpaint.numpy != None
+
+@renderprofile.timed("paint")
 def paint_with_layer(image, layer, tileset):
-  x_blocks = min(image.width // 16, len(layer[0]))
-  y_blocks = min(image.height // 16, len(layer))
+  if use_numpy:
+    return fastpaint.paint_with_layer(image, layer, tileset)
+  x_blocks = min(image.width // 16, layer.width)
+  y_blocks = min(image.height // 16, layer.height)
+  stamps = get_stamps(tileset)
   found_anything = False
   for y in range(y_blocks):
-    for x in range(x_blocks):
-      tile_index = int(layer[y][x])
-      if tile_index == 0: continue
+    # runs of tile 0 are skipped entirely
+    for x, length, tile_index in tilelayer.get_row_runs(layer, y):
+      if x >= x_blocks: break
       found_anything = True
-      tile_y = tile_index // (tileset.width // 16)
-      tile_x = tile_index % (tileset.width // 16)
-      image.paste(tileset, sx=tile_x*16, sy=tile_y*16, dx=x*16, dy=y*16, width=16, height=16)
+      stamps.paste(image, tile_index, x, y, min(length, x_blocks - x))
   return found_anything
 
+# id(tileset) -> StampCache
+stamp_caches = {}
+def get_stamps(tileset):
+  stamps = stamp_caches.get(id(tileset))
+  if stamps == None or stamps.tileset is not tileset:
+    if len(stamp_caches) >= 4:
+      # only the physics tileset and the current map's tileset are ever in use
+      stamp_caches.clear()
+    stamps = stamp_caches[id(tileset)] = tilestamps.StampCache(tileset)
+  return stamps
+
+
+def copy_pixels(dest, src, sx, sy, dx, dy, width, height):
+  # like paste, but overwrites the destination instead of alpha blending.
+  for y in range(height):
+    src_start = (sy + y) * src.width + sx
+    dest_start = (dy + y) * dest.width + dx
+    row = src.data[src_start:src_start+width]
+    if isinstance(dest.data, array.array) and not (isinstance(row, array.array) and row.typecode == dest.data.typecode):
+      row = array.array(dest.data.typecode, row)
+    elif isinstance(dest.data, memoryview):
+      row = array.array(dest.data.format, row)
+    dest.data[dest_start:dest_start+width] = row
+  renderprofile.count_paste(width * height)
+
+@renderprofile.timed("layers")
+def read_map_layers(mapfile):
+  layers = [None, None, None, None]
+  for i, layerfile in enumerate(mapfile["layers"]):
+    if layerfile == None: continue
+    if i == 2: i = 3 # leave space for the entities layer
+    layers[i] = read_layer(layerfile)
+  return layers
 
 def generate_map_image(mapfile, physics_only=False):
   layer_images = [None, None, None, None]
   tileset = read_tileset(mapfile["tileset"])
   width = None
   height = None
-  for i, layerfile in enumerate(mapfile["layers"]):
-    if layerfile == None: continue
-    if i == 2: i = 3 # leave space for the entities layer
-
-    layer = read_layer(layerfile)
+  for i, layer in enumerate(read_map_layers(mapfile)):
+    if layer == None: continue
     if width == None:
-      width = len(layer[0]) * 16
-      height = len(layer) * 16
+      width = layer.width * 16
+      height = layer.height * 16
     image = simplepng.ImageBuffer(width, height)
     if physics_only:
       if paint_physics(image, layer, mapfile["physics"], i):
@@ -144,13 +256,23 @@ class RegistryHandler(sax.ContentHandler):
   def endElement(self, name):
     pass
 
-def read_registry():
+def parse_registry(f):
   parser = sax.make_parser()
   handler = RegistryHandler()
   parser.setContentHandler( handler )
-  parser.parse(find_and_open("global/Registry_EmbedXML.dat", "r"))
+  parser.parse(f)
   return handler.objects_by_map_name
 
+registry_path = "global/Registry_EmbedXML.dat"
+def read_registry():
+  return get_loaded((registry_path, False), open_registry)
+
+@renderprofile.timed("registry")
+def open_registry():
+  # the XML only gets parsed when the compiled index next to it is missing or stale.
+  with find_and_open(registry_path, "rb") as f:
+    return registryindex.load_registry(f, parse_registry)
+
 
 
 mapfiles = [
@@ -423,49 +545,83 @@ sprite_paths = {
   "Suburb_Killer": "entity/enemy/suburb/Suburb_Walker_embed_suburb_killer.png",
   "Key": "entity/gadget/Key_C_KEY_SPRITE.png",
 }
-sprites = {}
+# sprites that aren't just the default sprite for an entity name
+extra_sprite_paths = {
+  "nonsolid_rail_sprite": "entity/decoration/Nonsolid_rail_sprite.png",
+  "nonsolid_rail_crowd": "entity/decoration/Nonsolid_rail_CROWD_sprite.png",
+  "npc_cell_bodies": "entity/interactive/NPC_embed_cell_bodies.png",
+  "npc_rock": "entity/interactive/NPC_note_rock.png",
+  "door_portal": "entity/gadget/Door_White_Portal_Sprite.png",
+  "nexus_pad": "entity/interactive/NPC_embed_nexus_pad.png",
+  "beach_npcs": "entity/interactive/NPC_embed_beach_npcs.png",
+  "whirlpool": "entity/gadget/Door_Whirlpool_Door_Sprite.png",
+  "npc_sage_statue": "entity/interactive/NPC_sage_statue.png",
+  "big_key": "entity/interactive/NPC_key_green_embed.png",
+  "windmill_console": "entity/gadget/Console_embed_windmill_inside.png",
+  "windmill_shell": "entity/interactive/NPC_embed_windmill_shell.png",
+  "big_gate": "entity/gadget/KeyBlock_green_gate_embed.png",
+  "checkpoint": "entity/gadget/Checkpoint_checkpoint_sprite.png",
+  "Spike_Roller_V": "entity/enemy/crowd/Spike_Roller_Spike_Roller_Sprite.png",
+  "Spike_Roller_H": "entity/enemy/crowd/Spike_Roller_Spike_Roller_Sprite_H.png",
+  "Spike_Roller_V_S": "entity/enemy/crowd/Spike_Roller_vert_shadow_sprite.png",
+  "Spike_Roller_H_S": "entity/enemy/crowd/Spike_Roller_hori_shadow_sprite.png",
+  "npc_snowman": "entity/interactive/NPC_embed_blue_npcs.png",
+  "circus_folks_arthur": "entity/enemy/circus/Circus_Folks_arthur_sprite.png",
+  "circus_folks_javiera": "entity/enemy/circus/Circus_Folks_javiera_sprite.png",
+  "circus_folks_both": "entity/enemy/circus/Circus_Folks_both_sprite.png",
+  "npc_golem": "entity/interactive/NPC_embed_cliff_npcs.png",
+  "biofilm": "entity/interactive/NPC_npc_biofilm.png",
+  "wall_boss_wall": "entity/enemy/crowd/WallBoss_wall_sprite.png",
+  "wall_boss_mouth": "entity/enemy/crowd/WallBoss_face_sprite.png",
+  "wall_boss_hand": "entity/enemy/crowd/WallBoss_r_hand_sprite.png",
+  "npc_hotel": "entity/interactive/NPC_embed_hotel_npcs.png",
+  "bike": "entity/interactive/npc/Mitra_bike_sprite.png",
+  "mitra_on_bike": "entity/interactive/npc/Mitra_mitra_on_bike_sprite.png",
+  "smoke_red": "entity/interactive/NPC_embed_smoke_red.png",
+  "red_cave": "entity/decoration/Solid_Sprite_red_cave_left_sprite.png",
+  "ground_thorn": "entity/enemy/etc/Briar_Boss_embed_ground_thorn.png",
+  "npc_squiggles": "entity/interactive/NPC_npc_spritesheet.png",
+  "debug_tree": "entity/decoration/Solid_Sprite_trees_sprites.png",
+  "npc_devs": "states/EndingState_embed_dev_npcs.png",
+  "nexus_doors": "entity/gadget/Door_Nexus_door_previews_embed.png",
+  "random_npcs": "entity/interactive/NPC_embed_randoms.png",
+}
+# these are drawn semitransparent
+faded_sprite_names = ("Spike_Roller_V_S", "Spike_Roller_H_S")
+
+class SpriteSet:
+  # decodes each sprite the first time it's looked up, and remembers which ones got used,
+  # so we know which files a map depends on.
+  def __init__(self):
+    self.paths = {}
+    self.images = {}
+    self.used = set()
+  def add(self, name, path, fade=False):
+    self.paths[name] = (path, fade)
+  def __contains__(self, name):
+    return name in self.paths
+  def __getitem__(self, name):
+    self.used.add(name)
+    image = self.images.get(name)
+    if image == None:
+      path, fade = self.paths[name]
+      image = read_tileset(path, fade=fade)
+      self.images[name] = image
+    return image
+  def get(self, name, default=None):
+    if name not in self: return default
+    return self[name]
+  def used_paths(self):
+    return sorted(set(self.paths[name][0] for name in self.used))
+
+sprites = SpriteSet()
+# the images load_sprites() decodes right away
+global_tileset_paths = [physics_tileset_path, "grid_overlay.png", "grid_overlay_solid.png", "blocker_sprite.png", "vblock_sprite.png"]
 def load_sprites():
-  for sprite_name in sprite_paths:
-    if type(sprite_paths[sprite_name]) == str and sprite_paths[sprite_name] != "???":
-      sprites[sprite_name] = read_tileset(sprite_paths[sprite_name])
-  sprites["nonsolid_rail_sprite"] = read_tileset("entity/decoration/Nonsolid_rail_sprite.png")
-  sprites["nonsolid_rail_crowd"] = read_tileset("entity/decoration/Nonsolid_rail_CROWD_sprite.png")
-  sprites["npc_cell_bodies"] = read_tileset("entity/interactive/NPC_embed_cell_bodies.png")
-  sprites["npc_rock"] = read_tileset("entity/interactive/NPC_note_rock.png")
-  sprites["door_portal"] = read_tileset("entity/gadget/Door_White_Portal_Sprite.png")
-  sprites["nexus_pad"] = read_tileset("entity/interactive/NPC_embed_nexus_pad.png")
-  sprites["beach_npcs"] = read_tileset("entity/interactive/NPC_embed_beach_npcs.png")
-  sprites["whirlpool"] = read_tileset("entity/gadget/Door_Whirlpool_Door_Sprite.png")
-  sprites["npc_sage_statue"] = read_tileset("entity/interactive/NPC_sage_statue.png")
-  sprites["big_key"] = read_tileset("entity/interactive/NPC_key_green_embed.png")
-  sprites["windmill_console"] = read_tileset("entity/gadget/Console_embed_windmill_inside.png")
-  sprites["windmill_shell"] = read_tileset("entity/interactive/NPC_embed_windmill_shell.png")
-  sprites["big_gate"] = read_tileset("entity/gadget/KeyBlock_green_gate_embed.png")
-  sprites["checkpoint"] = read_tileset("entity/gadget/Checkpoint_checkpoint_sprite.png")
-  sprites["Spike_Roller_V"] = read_tileset("entity/enemy/crowd/Spike_Roller_Spike_Roller_Sprite.png")
-  sprites["Spike_Roller_H"] = read_tileset("entity/enemy/crowd/Spike_Roller_Spike_Roller_Sprite_H.png")
-  sprites["Spike_Roller_V_S"] = read_tileset("entity/enemy/crowd/Spike_Roller_vert_shadow_sprite.png", fade=True)
-  sprites["Spike_Roller_H_S"] = read_tileset("entity/enemy/crowd/Spike_Roller_hori_shadow_sprite.png", fade=True)
-  sprites["npc_snowman"] = read_tileset("entity/interactive/NPC_embed_blue_npcs.png")
-  sprites["circus_folks_arthur"] = read_tileset("entity/enemy/circus/Circus_Folks_arthur_sprite.png")
-  sprites["circus_folks_javiera"] = read_tileset("entity/enemy/circus/Circus_Folks_javiera_sprite.png")
-  sprites["circus_folks_both"] = read_tileset("entity/enemy/circus/Circus_Folks_both_sprite.png")
-  sprites["npc_golem"] = read_tileset("entity/interactive/NPC_embed_cliff_npcs.png")
-  sprites["biofilm"] = read_tileset("entity/interactive/NPC_npc_biofilm.png")
-  sprites["wall_boss_wall"] = read_tileset("entity/enemy/crowd/WallBoss_wall_sprite.png")
-  sprites["wall_boss_mouth"] = read_tileset("entity/enemy/crowd/WallBoss_face_sprite.png")
-  sprites["wall_boss_hand"] = read_tileset("entity/enemy/crowd/WallBoss_r_hand_sprite.png")
-  sprites["npc_hotel"] = read_tileset("entity/interactive/NPC_embed_hotel_npcs.png")
-  sprites["bike"] = read_tileset("entity/interactive/npc/Mitra_bike_sprite.png")
-  sprites["mitra_on_bike"] = read_tileset("entity/interactive/npc/Mitra_mitra_on_bike_sprite.png")
-  sprites["smoke_red"] = read_tileset("entity/interactive/NPC_embed_smoke_red.png")
-  sprites["red_cave"] = read_tileset("entity/decoration/Solid_Sprite_red_cave_left_sprite.png")
-  sprites["ground_thorn"] = read_tileset("entity/enemy/etc/Briar_Boss_embed_ground_thorn.png")
-  sprites["npc_squiggles"] = read_tileset("entity/interactive/NPC_npc_spritesheet.png")
-  sprites["debug_tree"] = read_tileset("entity/decoration/Solid_Sprite_trees_sprites.png")
-  sprites["npc_devs"] = read_tileset("states/EndingState_embed_dev_npcs.png")
-  sprites["nexus_doors"] = read_tileset("entity/gadget/Door_Nexus_door_previews_embed.png")
-  sprites["random_npcs"] = read_tileset("entity/interactive/NPC_embed_randoms.png")
+  # entity sprites aren't actually decoded until something needs them.
+  for sprite_name, path in itertools.chain(sprite_paths.items(), extra_sprite_paths.items()):
+    if type(path) != str or path == "???": continue
+    sprites.add(sprite_name, path, fade=sprite_name in faded_sprite_names)
   global physics_tileset
   physics_tileset = read_tileset(physics_tileset_path)
   global grid_overlay
@@ -477,6 +633,7 @@ def load_sprites():
   global vblock_sprite
   vblock_sprite = read_tileset("vblock_sprite.png")
 
+@renderprofile.timed("entities")
 def render_physics_entities(image, entities, map_name):
   did_anything = False
   for entity in entities:
@@ -500,769 +657,1419 @@ def render_physics_entities(image, entities, map_name):
   return did_anything
 
 warning_set = set()
-def render_entities(image, entities, map_name):
+# when not None, warn_once() collects (key, message) pairs here instead of printing them.
+pending_warnings = None
+def warn_once(key, message):
+  if key in warning_set: return
+  warning_set.add(key)
+  if pending_warnings != None:
+    pending_warnings.append((key, message))
+  else:
+    print(message)
+
+# flipped and rotated entity frames, shared by every map this process renders
+sprite_frames = spriteatlas.FrameAtlas()
+
+class EntityContext:
+  # what the entity renderers need to know besides the entity itself
+  def __init__(self, map_name, dust_index):
+    self.map_name = map_name
+    self.dust_index = dust_index
+  def consume_dust_at(self, x, y):
+    return self.dust_index.remove_at(x, y) != None
+
+def draw(sprite_name, x, y, sx=0, sy=0, width=16, height=16, flip_h=False, rotate=0, extra=None):
+  """the flat tuple that render_entities() pastes.
+  extra is called as extra(image, sprite, sx, sy, x, y, width, height) after the main paste."""
+  return (sprite_name, x, y, sx, sy, width, height, flip_h, rotate, extra)
+
+def is_boi(context, y):
+  return context.map_name == "REDCAVE" and y > 1000
+
+def draw_sprite2_windmill_shell(image, sprite, sx, sy, x, y, width, height):
+  image.paste(sprites["windmill_shell"], sx=sx, sy=sy, dx=x, dy=y, width=width, height=height)
+
+def draw_ranks_bush(image, sprite, sx, sy, x, y, width, height):
+  # the 12 is not a mistake. this bush is strangly aligned
+  image.paste(sprite, sx=0, sy=48, dx=x+16, dy=y+12, width=16, height=16)
+
+def draw_mitras_fields_bike(image, sprite, sx, sy, x, y, width, height):
+  image.paste(sprites["bike"], sx=20, sy=0, dx=x-22, dy=y-11, width=20, height=20)
+
+def draw_fintys_shop(image, sprite, sx, sy, x, y, width, height):
+  # gun
+  image.paste(sprites["Trade_NPC"], sx=64, sy=80, dx=x-32, dy=y+32, width=16, height=16)
+  # money sack
+  image.paste(sprites["Trade_NPC"], sx=80, sy=80, dx=x+4, dy=y+32, width=16, height=16)
+  # shoes
+  image.paste(sprites["Trade_NPC"], sx=96, sy=80, dx=x+32+6, dy=y+32, width=16, height=16)
+
+def draw_noose(image, sprite, sx, sy, x, y, width, height):
+  for i in range(1, 4):
+    image.paste(sprite, sx=16, sy=96, dx=x, dy=y-16*i, width=16, height=16)
+
+def draw_wall_boss_parts(image, sprite, sx, sy, x, y, width, height):
+  image.paste(sprites["wall_boss_mouth"], sx=16, dx=1504, dy=960, width=32, height=32)
+  image.paste(sprites["wall_boss_hand"], dx=1456, dy=992, width=32, height=32)
+  sprite_frames.paste(image, sprites["wall_boss_hand"], dx=1552, dy=992, width=32, height=32, flip_h=True)
+
+def render_invisible(entity, x, y, frame, context):
+  return None
+
+def render_switch_pillar(entity, x, y, frame, context):
+  return draw("Switch_Pillar", x, y, sx=(1 - frame) * 16)
+
+def render_silverfish(entity, x, y, frame, context):
+  sx = 0
+  sy = 16
+  flip_h = False
+  if frame == 0: # left
+    sx = 32
+    sy = 16
+    flip_h = True
+  elif frame == 1: # down
+    sy = 16
+  elif frame == 2: # right
+    sx = 32
+    sy = 16
+  elif frame == 3: # up
+    sy = 32
+  else:
+    print("WARNING: what Silverfish direction is this: {}".format(frame))
+  return draw("Silverfish", x, y, sx=sx, sy=sy, flip_h=flip_h)
+
+def render_four_frame_row(entity, x, y, frame, context):
+  return draw(entity["name"], x, y, sx=(frame & 3) * 16)
+
+def render_on_off_laser(entity, x, y, frame, context):
+  sy = 0
+  rotate = 0
+  if frame == 0: # up
+    sy = 16
+  elif frame == 1: # right
+    # rotate left
+    rotate = -1
+  elif frame == 2: # down
+    pass
+  elif frame == 3: # left
+    # rotate right
+    rotate = 1
+  else:
+    print("WARNING: what On_Off_Laser direction is this: {}".format(frame))
+  return draw("On_Off_Laser", x, y, sy=sy, rotate=rotate)
+
+def render_dash_trap(entity, x, y, frame, context):
+  return draw("Dash_Trap", x, y, sx=32 if is_boi(context, y) else 0, sy=16)
+
+def render_circus_folks(entity, x, y, frame, context):
+  if frame == 0:
+    # arthur
+    if x < 1340:
+      # percarious
+      return draw("circus_folks_arthur", x, y - 7 * 16, sy=64)
+    # dead
+    return draw("circus_folks_arthur", x, y, sx=32, sy=64)
+  elif frame == 1:
+    # javiera
+    if x < 1340:
+      # lions closing in
+      return draw("circus_folks_javiera", x, y)
+    # dead
+    return draw("circus_folks_javiera", x, y, sy=48)
+  elif frame == 2:
+    # both
+    return draw("circus_folks_both", x, y - 64, height=32)
+  else: unreachable()
+
+# which card gate picture goes in which map
+card_gate_sy_by_map_name = {
+  "OVERWORLD": 8 * 16,
+  "BEACH": 9 * 16,
+  "SUBURB": 10 * 16,
+  "CELL": 13 * 16,
+  "TERMINAL": 14 * 16,
+  "NEXUS": 15 * 16,
+}
+big_key_gate_sy_by_frame = {1: 7 * 16, 2: 0, 3: 6 * 16}
+
+def render_key_block(entity, x, y, frame, context):
+  map_name = context.map_name
+  if frame == 0:
+    # small key block
+    return draw("KeyBlock", x, y)
+  elif frame in (1, 2, 3):
+    # large key gate
+    return draw("big_gate", x, y, sy=big_key_gate_sy_by_frame[frame], width=32)
+  elif frame == 4:
+    # card gate
+    if map_name == "BLANK":
+      # there are 2 here
+      sy = 11 * 16 if y == 864 else 16 * 16
+    elif map_name in card_gate_sy_by_map_name:
+      sy = card_gate_sy_by_map_name[map_name]
+    else:
+      print("WARNING: ignoring card gate in map: {}".format(map_name))
+      return None
+    return draw("big_gate", x, y, sy=sy, width=32)
+  else:
+    print("WARNING: ignoring KeyBlock frame: {}".format(frame))
+    return None
+
+def render_nonsolid(entity, x, y, frame, context):
+  nonsolid_type = entity["type"]
+  if nonsolid_type == "Rail_1":
+    return draw("nonsolid_rail_sprite", x, y)
+  elif nonsolid_type == "Rail_CROWD":
+    return draw("nonsolid_rail_crowd", x, y)
+  print("WARNING: what nonsolid type is this: {}".format(nonsolid_type))
+  return draw("Nonsolid", x, y)
+
+def render_jump_trigger(entity, x, y, frame, context):
+  if context.map_name in ("APARTMENT", "CLIFF", "BEACH", "CROWD", "DEBUG"):
+    # jump triggers are invisible in these maps
+    return None
+  elif context.map_name == "HOTEL":
+    if entity["type"] != "1":
+      # only type=1 is visible
+      return None
+  return draw("Jump_Trigger", x, y)
+
+def render_gate(entity, x, y, frame, context):
+  return draw("Gate", x, y, sy=32 if context.map_name == "BLANK" else 0)
+
+def render_console(entity, x, y, frame, context):
+  if context.map_name == "WINDMILL":
+    return draw("windmill_console", x, y, width=48, height=48, extra=draw_sprite2_windmill_shell)
+  return draw("Console", x, y)
+
+def render_propelled(entity, x, y, frame, context):
+  sx = 0
+  sy = 0
+  if (frame & 1) == 0:
+    sy = 16
+  if context.consume_dust_at(x, y):
+    sx = 16
+  return draw("Propelled", x, y, sx=sx, sy=sy)
+
+def render_shadow_briar(entity, x, y, frame, context):
+  if context.map_name == "GO":
+    # don't bother with this one
+    return None
+  if frame in (0, 2, 3, 4):
+    return draw("Shadow_Briar", x, y, sy=32) # face down
+  elif frame == 1:
+    return draw("Shadow_Briar", x, y, sx=64, sy=32) # face up
+  print("WARNING: ignoring Shadow_Briar frame: {}".format(frame))
+  return None
+
+def render_chaser(entity, x, y, frame, context):
+  return draw("Chaser", x, y, sx=32 if frame == 0 else 0, sy=32, height=32)
+
+def render_treasure(entity, x, y, frame, context):
+  return draw("Treasure", x, y, sy=32 if context.map_name == "CELL" else 0)
+
+def render_rat(entity, x, y, frame, context):
+  return draw("Rat", x, y, sy=16 if context.map_name == "CELL" else 0)
+
+def render_dash_pad(entity, x, y, frame, context):
+  return draw("Dash_Pad", x, y, sx=frame * 16, sy=16)
+
+def render_spike_roller(entity, x, y, frame, context):
+  if frame in (0, 3):
+    return draw("Spike_Roller_H_S", x, y, width=128)
+  elif frame in (1, 2):
+    return draw("Spike_Roller_V_S", x, y, height=128)
+  elif frame in (4, 7):
+    return draw("Spike_Roller_H", x, y, width=128)
+  elif frame in (5, 6):
+    return draw("Spike_Roller_V", x, y, height=128)
+  print("WARNING: ignoring Spike_Roller frame: {}".format(frame))
+  return None
+
+button_sy_by_map_name = {"REDCAVE": 32, "CELL": 64}
+
+def render_button(entity, x, y, frame, context):
+  return draw("Button", x, y, sy=button_sy_by_map_name.get(context.map_name, 16))
+
+# (sx, sy) for holes and cracked tiles in each map
+hole_style_by_map_name = {
+  "BEDROOM": (0, 0),
+  "STREET": (16, 0),
+  "REDCAVE": (32, 0),
+  "CIRCUS": (32, 16),
+}
+
+def render_hole(entity, x, y, frame, context):
+  map_name = context.map_name
+  if map_name == "HOTEL":
+    # three different styles depending on what floor we're on
+    quad_x = int(x >= 960)
+    quad_y = int(y >= 800)
+    if (quad_x, quad_y) == (0, 0):
+      sx, sy = 0, 16
+    elif (quad_x, quad_y) == (1, 1):
+      sx, sy = 16, 16
+    else:
+      sx, sy = 48, 0
+  elif map_name in hole_style_by_map_name:
+    sx, sy = hole_style_by_map_name[map_name]
+  else:
+    print("WARNING: ignoring {} in map: {}".format(entity["name"], map_name))
+    return None
+  return draw(entity["name"], x, y, sx=sx, sy=sy)
+
+def render_key(entity, x, y, frame, context):
+  if y > 100:
+    # this one's not real, i guess
+    print("WARNING: ignoring key at: {},{}".format(x, y))
+    return None
+  return draw("Key", x, y)
+
+def render_dungeon_statue(entity, x, y, frame, context):
+  if context.map_name == "BEDROOM":
+    sx = 0
+  elif context.map_name == "REDCAVE":
+    sx = 32
+  elif context.map_name == "CROWD":
+    sx = 64
+  else: unreachable()
+  return draw("Dungeon_Statue", x, y, sx=sx, width=32, height=48)
+
+# (sx, sy) for the cell bodies
+cell_body_style_by_frame = {0: (0, 0), 2: (32, 0), 4: (0, 16), 6: (32, 16)}
+
+def render_npc(entity, x, y, frame, context):
+  map_name = context.map_name
+  npc_type = entity["type"]
+  if npc_type == "Cell_Body":
+    if frame not in cell_body_style_by_frame:
+      print("WARNING: ignoring npc cell body frame: {}".format(frame))
+      return None
+    sx, sy = cell_body_style_by_frame[frame]
+    return draw("npc_cell_bodies", x, y, sx=sx, sy=sy)
+  elif npc_type == "rock":
+    if map_name == "CELL":
+      return draw("npc_rock", x, y, sx=16)
+    elif map_name == "SPACE":
+      return draw("Space_NPC", x, y, sx=16 if x > 912 else 0, sy=48)
+    return draw("npc_rock", x, y)
+  elif npc_type == "statue":
+    return draw("npc_sage_statue", x, y)
+  elif npc_type == "big_key":
+    if map_name == "BEDROOM":
+      sy = 0
+    elif map_name == "REDCAVE":
+      sy = 16
+    elif map_name == "CROWD":
+      sy = 32
+    else: unreachable()
+    return draw("big_key", x, y, sy=sy)
+  elif npc_type == "generic":
+    return render_generic_npc(entity, x, y, frame, context)
+  elif npc_type == "biofilm":
+    return draw("biofilm", x, y, width=32, height=32)
+  elif npc_type == "npc_test":
+    # "like music?" scribbly guy
+    return draw("npc_squiggles", x, y)
+  print("WARNING: ignoring npc type: {}: {}: {},{}".format(npc_type, frame, x, y))
+  return None
+
+def render_generic_npc(entity, x, y, frame, context):
+  map_name = context.map_name
+  if map_name == "BEACH":
+    if frame == 7:
+      # Hews the lobster
+      return draw("beach_npcs", x, y)
+    elif frame == 16:
+      return draw("Trade_NPC", x, y, sx=96, sy=128)
+    return draw("NPC", x, y)
+  elif map_name == "WINDMILL":
+    # don't bother rendering the windmill blades
+    return None
+  elif map_name == "BLUE":
+    return draw("npc_snowman", x, y)
+  elif map_name == "HAPPY":
+    # invisible NPC that talks to you at the save point.
+    return None
+  elif map_name == "DRAWER":
+    # trigger for dimming the screen as you leave the game over area.
+    return None
+  elif map_name == "CELL":
+    return draw("npc_cell_bodies", x, y, sy=32)
+  elif map_name == "CLIFF":
+    if frame == 7:
+      return draw("npc_golem", x, y)
+    elif frame == 6:
+      return draw("Dog", x, y)
+    else: unreachable()
+  elif map_name == "HOTEL":
+    if frame == 12:
+      return draw("npc_hotel", x, y, sx=32)
+    elif frame == 5:
+      # spooky eye in the water
+      return draw("Eye_Boss", x, y, sx=72, width=24, height=24)
+    return draw("NPC", x, y)
+  elif map_name == "FIELDS":
+    if frame == 8:
+      # Olive the rabbit
+      return draw("Forest_NPC", x, y, sy=48)
+    elif frame == 13:
+      # Bob the Hamster
+      return draw("Trade_NPC", x, y, sy=128)
+    elif frame == 14:
+      # Chikapu
+      return draw("Trade_NPC", x, y, sx=32, sy=128)
+    elif frame == 15:
+      # Kuribu
+      return draw("Trade_NPC", x, y, sx=64, sy=128)
+    elif frame == 7:
+      # Rank
+      return draw("Trade_NPC", x, y, sx=32, sy=96, height=32, extra=draw_ranks_bush)
+    else: unreachable()
+  elif map_name == "FOREST":
+    # James
+    return draw("Forest_NPC", x, y, sy=16)
+  elif map_name == "SPACE":
+    if y > 500:
+      # drifter
+      return draw("Space_NPC", x, y)
+    # kings
+    return draw("Space_NPC", x, y, sx=64 if x > 912 else 0, sy=64, width=32, height=32)
+  elif map_name == "REDCAVE":
+    return draw("smoke_red", x, y, width=32, height=32)
+  elif map_name == "GO":
+    if frame == 7:
+      # rock in the super bright room
+      return draw("npc_rock", x, y)
+    elif frame == 11:
+      # trafic cone blocking HAPPY
+      return draw("ground_thorn", x, y + 8, sx=48, sy=16)
+    else: unreachable()
+  elif map_name == "SUBURB":
+    return draw("Suburb_Walker", x, y)
+  elif map_name == "DEBUG":
+    if frame == 17:
+      return draw("npc_devs", x, y)
+    elif frame == 18:
+      return draw("npc_devs", x, y, sy=16)
+    else: unreachable()
+  elif map_name == "APARTMENT":
+    return draw("random_npcs", x, y)
+  print("WARNING: ignoring generic npc in map: {}: {}: {},{}".format(map_name, frame, x, y))
+  return None
+
+def render_trade_npc(entity, x, y, frame, context):
+  if frame == 0:
+    # Miao Xiao Tuan Er
+    return draw("Trade_NPC", x, y)
+  elif frame in (1, 2):
+    # fish
+    return draw("Trade_NPC", x, y, sy=32)
+  elif frame == 3:
+    # Finty
+    return draw("Trade_NPC", x, y, sy=80, extra=draw_fintys_shop)
+  elif frame == 4:
+    # Icky
+    return draw("Trade_NPC", x, y, sy=16)
+  else: unreachable()
+
+forest_npc_style_by_frame = {
+  0: (16, 0), # Thorax
+  20: (0, 32), # mushroom
+  30: (0, 48), # Crickson
+  34: (64, 48), # scared rabit
+}
+
+def render_forest_npc(entity, x, y, frame, context):
+  if frame not in forest_npc_style_by_frame: unreachable()
+  sx, sy = forest_npc_style_by_frame[frame]
+  return draw("Forest_NPC", x, y, sx=sx, sy=sy)
+
+def render_space_npc(entity, x, y, frame, context):
+  sx = 0
+  sy = 0
+  if x > 912:
+    sy = 16
+  if frame in (8, 18):
+    # dead
+    sx = 128
+  return draw("Space_NPC", x, y, sx=sx, sy=sy)
+
+def render_space_face(entity, x, y, frame, context):
+  return draw("Space_NPC", x, y, sx=32 if x > 912 else 0, sy=32)
+
+# (sx, sy, draw_noose) for the suburb folks that don't pick their look by frame
+suburb_walker_style_by_position = {
+  (192, 848): (0, 0, False),
+  (544, 848): (0, 64, False),
+  (688, 848): (0, 32, False),
+  (32, 1008): (0, 0, False),
+  (192, 1008): (0, 96, True),
+  (592, 896): (0, 16, False),
+  (96, 1216): (128, 16, False),
+  (272, 1216): (128, 0, False),
+}
+
+def render_suburb_walker(entity, x, y, frame, context):
+  if frame < 6:
+    return draw("Suburb_Walker", x, y, sy=frame * 16)
+  if (x, y) not in suburb_walker_style_by_position: unreachable()
+  sx, sy, has_noose = suburb_walker_style_by_position[(x, y)]
+  return draw("Suburb_Walker", x, y, sx=sx, sy=sy, extra=draw_noose if has_noose else None)
+
+def render_mitra(entity, x, y, frame, context):
+  map_name = context.map_name
+  if map_name == "FIELDS":
+    return draw("Mitra", x, y, sy=16, extra=draw_mitras_fields_bike)
+  elif map_name == "CLIFF":
+    return draw("mitra_on_bike", x, y - 4, sx=40, width=20, height=20, flip_h=True)
+  elif map_name == "OVERWORLD":
+    return draw("mitra_on_bike", x, y - 4, sx=40, width=20, height=20)
+  elif map_name == "GO":
+    # there's no good place to show mitra in GO
+    return None
+  print("WARNING: default rendering mitra in map: {}".format(map_name))
+  return draw("Mitra", x, y)
+
+def render_sage(entity, x, y, frame, context):
+  map_name = context.map_name
+  if map_name == "BLANK":
+    # don't show those two
+    return None
+  if map_name not in ("BEDROOM", "REDCAVE", "CROWD", "NEXUS", "TERMINAL", "OVERWORLD", "GO"):
+    print("WARNING: default rendering sage in map: {}".format(map_name))
+  return draw("Sage", x, y, sy=16)
+
+def render_happy_npc(entity, x, y, frame, context):
+  if frame == 18:
+    return None # briar walking along a trough thing
+  return draw("Happy_NPC", x, y, sy=16 if frame in (0,1,3) else 0) # male
+
+def render_health_cicada(entity, x, y, frame, context):
+  return draw("Health_Cicada", x, y, sy=32 if context.map_name == "CELL" else 0)
+
+def render_eye_boss(entity, x, y, frame, context):
+  return draw("Eye_Boss", x, y, sy=24 if y == 1648 else 0, width=24, height=24)
+
+def render_annoyer(entity, x, y, frame, context):
+  sx = 0
+  sy = 0
+  if context.map_name == "CELL":
+    sy = 16
+  elif frame == 0:
+    sy = 0
+  elif frame == 2:
+    sy = 32
+  elif frame == 8:
+    sx = 32
+    sy = 16
+  # for some reason, these enemies always start offset a littl
+  return draw("Annoyer", x - 3, y - 2, sx=sx, sy=sy)
+
+def render_slime(entity, x, y, frame, context):
+  return draw("Slime", x, y, sx=32 if is_boi(context, y) else 0)
+
+def render_frog(entity, x, y, frame, context):
+  return draw("Frog", x, y, sy=32 if is_boi(context, y) else 0)
+
+# which preview picture each nexus door shows, by frame
+nexus_door_row_by_frame = {
+  13: 0, # STREET
+  49: 1, # OVERWORLD
+  63: 12, # BEDROOM
+  46: 19, # SUBURB
+  60: 4, # APARTMENT
+  55: 11, # BEACH
+  48: 13, # FIELDS
+  50: 8, # FOREST
+  51: 15, # TERMINAL
+  64: 9, # WINDMILL
+  52: 14, # GO
+  56: 20, # BLUE
+  57: 16, # HAPPY
+  62: 2, # REDCAVE
+  53: 10, # REDSEA
+  54: 7, # CLIFF
+  61: 3, # CROWD
+  58: 6, # CIRCUS
+  45: 18, # CELL
+  47: 17, # SPACE
+  59: 5, # HOTEL
+}
+
+def render_door(entity, x, y, frame, context):
+  map_name = context.map_name
+  door_type = entity["type"]
+  if door_type in ("1", "5", "6", "8", "10", "11", "12", "13", "14", "15"):
+    return None # invisible
+  elif door_type == "4":
+    return draw("door_portal", x, y, sy=16 if map_name == "CELL" else 0)
+  elif door_type == "7":
+    if map_name == "NEXUS":
+      # this one's invisible
+      return None
+    return draw("whirlpool", x, y)
+  elif door_type == "9":
+    if map_name != "NEXUS":
+      return None
+    if frame not in nexus_door_row_by_frame: unreachable()
+    return draw("nexus_doors", x, y, sy=nexus_door_row_by_frame[frame] * 32, width=32, height=32)
+  elif door_type == "16":
+    return draw("nexus_pad", x, y, sy=32 if map_name == "CELL" else 0, width=32, height=32)
+  print("WARNING: ignoring door type: {}".format(door_type))
+  return None
+
+# (sx, sy) for each sign
+sign_style_by_frame = {2: (0, 16), 3: (16, 16), 4: (0, 32)}
+
+def render_solid_sprite(entity, x, y, frame, context):
+  solid_type = entity["type"]
+  if solid_type in ("blocker", "vblock"):
+    return None # invisible
+  elif solid_type == "sign":
+    if frame not in sign_style_by_frame:
+      print("WARNING: ignoring sign: {}: {},{}".format(frame, x, y))
+      return None
+    sx, sy = sign_style_by_frame[frame]
+    return draw("npc_rock", x, y, sx=sx, sy=sy)
+  elif solid_type in ("red_cave_n_ss", "red_cave_r_ss", "red_cave_l_ss"):
+    return draw("red_cave", x, y, width=64, height=64)
+  elif solid_type == "tree":
+    return draw("debug_tree", x, y, width=64, height=64)
+  print("WARNING: ignoring Solid_Sprite type: {}: {}: {},{}".format(solid_type, frame, x, y))
+  return None
+
+def render_event(entity, x, y, frame, context):
+  if frame == 2:
+    return draw("checkpoint", x, y, sy=16 if context.map_name == "CELL" else 0)
+  return None # invisible
+
+def render_wall_boss(entity, x, y, frame, context):
+  # special case for all these sprites. the entity position doesn't matter.
+  return draw("wall_boss_wall", 1440, 960, width=160, height=32, extra=draw_wall_boss_parts)
+
+# how to draw each kind of entity.
+# a tuple is a fixed (sx, sy, width, height, offset_x, offset_y) using the entity's own sprite.
+# a function is called with (entity, x, y, frame, context) and returns a draw() tuple, or None to skip the entity.
+# anything not listed here is drawn with its own sprite at 16x16 with a warning.
+entity_specs = {
+  "Switch_Pillar": render_switch_pillar,
+  "Silverfish": render_silverfish,
+  "Pew_Laser": render_four_frame_row,
+  "Steam_Pipe": render_four_frame_row,
+  "On_Off_Laser": render_on_off_laser,
+  "Dash_Trap": render_dash_trap,
+  "Gasguy": (0, 0, 16, 24, 0, 0),
+  "Teleguy": (0, 0, 16, 24, 0, 0),
+  "Sun_Guy": (0, 0, 16, 24, 0, 0),
+  "Dustmaid": (0, 0, 16, 24, 0, 0),
+  "Follower_Bro": (0, 0, 16, 24, 0, 0),
+  "Slasher": (0, 0, 24, 24, 0, 0),
+  "Splitboss": (0, 0, 24, 32, 0, 0),
+  "Contort": (0, 0, 16, 32, 0, 0),
+  "Lion": (0, 0, 32, 32, 0, 0),
+  "Elevator": (0, 0, 32, 32, 0, 0),
+  "Big_Door": (0, 0, 32, 32, 0, 0),
+  "Red_Walker": (0, 0, 32, 48, 0, 0),
+  "Huge_Fucking_Stag": (0, 0, 64, 80, 0, 0),
+  "Fire_Pillar": (0, 0, 16, 16, 0, 16),
+  "Redsea_NPC": lambda entity, x, y, frame, context: draw("Redsea_NPC", x, y, sy=frame * 16 // 10),
+  "Circus_Folks": render_circus_folks,
+  "KeyBlock": render_key_block,
+  "Nonsolid": render_nonsolid,
+  "Jump_Trigger": render_jump_trigger,
+  "Gate": render_gate,
+  "Console": render_console,
+  "Propelled": render_propelled,
+  "Shadow_Briar": render_shadow_briar,
+  "Chaser": render_chaser,
+  "Treasure": render_treasure,
+  "Rat": render_rat,
+  "Dash_Pad": render_dash_pad,
+  "Spike_Roller": render_spike_roller,
+  "Button": render_button,
+  "Hole": render_hole,
+  "CrackedTile": render_hole,
+  "Key": render_key,
+  "Dungeon_Statue": render_dungeon_statue,
+  "NPC": render_npc,
+  "Trade_NPC": render_trade_npc,
+  "Forest_NPC": render_forest_npc,
+  "Space_NPC": render_space_npc,
+  "Space_Face": render_space_face,
+  "Suburb_Walker": render_suburb_walker,
+  "Mitra": render_mitra,
+  "Sage": render_sage,
+  "Happy_NPC": render_happy_npc,
+  "Fisherman": lambda entity, x, y, frame, context: draw("beach_npcs", x, y, sy=16),
+  # there's information to rotate the persons,
+  # but they rotate themselves randomly before you can see it in game,
+  # so whatever
+  "Person": (0, 0, 16, 16, 0, 0),
+  "Health_Cicada": render_health_cicada,
+  "Eye_Boss": render_eye_boss,
+  "Red_Boss": (0, 0, 32, 32, 0, 0),
+  # what are you doing over there?
+  "Sage_Boss": (0, 0, 16, 24, 24, 0),
+  "Red_Pillar": (0, 0, 16, 64, 0, 0),
+  "Mover": (16, 0, 16, 16, 0, 0),
+  "Annoyer": render_annoyer,
+  "Slime": render_slime,
+  "Frog": render_frog,
+  "Door": render_door,
+  "solid_tile": render_invisible,
+  "Water_Anim": render_invisible,
+  "Go_Detector": render_invisible,
+  "Solid_Sprite": render_solid_sprite,
+  "Pillar_Switch": (0, 0, 16, 16, 0, 0),
+  "Dog": (0, 0, 16, 16, 0, 0),
+  "Shieldy": (0, 0, 16, 16, 0, 0),
+  "Rotator": (0, 0, 16, 16, 0, 0),
+  "Dust": (0, 0, 16, 16, 0, 0),
+  "Burst_Plant": (0, 0, 16, 16, 0, 0),
+  "Four_Shooter": (0, 0, 16, 16, 0, 0),
+  "Eye_Light": (0, 0, 16, 16, 0, 0),
+  "Sadbro": (0, 0, 16, 16, 0, 0),
+  "Suburb_Killer": (0, 0, 16, 16, 0, 0),
+  "Stop_Marker": render_invisible,
+  "Event": render_event,
+  "WallBoss": render_wall_boss,
+}
+
+@renderprofile.timed("entities")
+def render_entities(image, entities, map_name, clip=None):
+  """clip is an optional x, y, width, height rectangle. entities drawn entirely outside of it are skipped,
+  without even decoding their sprites, but they still count toward the return value."""
   did_anything = False
 
   # get all the Dust first, since it can go away to fule a Propelled
   dust_entities  = [entity for entity in entities if entity["name"] == "Dust"]
   other_entities = [entity for entity in entities if entity["name"] != "Dust"]
+  context = EntityContext(map_name, spatialindex.SpatialHash(dust_entities))
 
-  def consume_dust_at(x, y):
-    for i, dust in enumerate(dust_entities):
-      if dust["x"] == x and dust["y"] == y:
-        del dust_entities[i]
-        return True
-    return False
-
-  # chain lets us delete from dust_entities and then not iterate over them
-  for entity in itertools.chain(other_entities, dust_entities):
+  # the dust is checked lazily, so any that got consumed in the meantime isn't drawn.
+  remaining_dust = (dust for dust in dust_entities if dust in context.dust_index)
+  for entity in itertools.chain(other_entities, remaining_dust):
     entity_name = entity["name"]
     x = entity["x"]
     y = entity["y"]
     if x < 0 or y < 0:
       print("WARNING: ignoring out of bounds entity: {}, {}".format(x, y))
       continue
-    frame = entity["frame"]
-    sx = 0
-    sy = 0
-    width = 16
-    height = 16
-    sprite = sprites.get(entity_name, None)
-    sprite2 = None
-    draw_ranks_bush = False
-    draw_mitras_fields_bike = False
-    draw_fintys_shop = False
-    draw_noose = False
-    is_boi = map_name == "REDCAVE" and y > 1000
-    flip_h = False
-    rotate = 0
-    if entity_name == "Switch_Pillar":
-      sx = (1 - frame) * 16
-    elif entity_name == "Silverfish":
-      sy = 16
-      if frame == 0: # left
-        sx = 32
-        sy = 16
-        flip_h = True
-      elif frame == 1: # down
-        sy = 16
-      elif frame == 2: # right
-        sx = 32
-        sy = 16
-      elif frame == 3: # up
-        sy = 32
-      else:
-        print("WARNING: what Silverfish direction is this: {}".format(frame))
-    elif entity_name in ("Pew_Laser", "Steam_Pipe"):
-      sx = (frame & 3) * 16
-    elif entity_name == "On_Off_Laser":
-      if frame == 0: # up
-        sy = 16
-      elif frame == 1: # right
-        # rotate left
-        rotate = -1
-      elif frame == 2: # down
-        pass
-      elif frame == 3: # left
-        # rotate right
-        rotate = 1
-      else:
-        print("WARNING: what On_Off_Laser direction is this: {}".format(frame))
-    elif entity_name == "Dash_Trap":
-      sy = 16
-      if is_boi:
-        sx = 32
-    elif entity_name in ("Gasguy", "Teleguy", "Sun_Guy", "Dustmaid", "Follower_Bro"):
-      height = 24
-    elif entity_name == "Slasher":
-      width = 24
-      height = 24
-    elif entity_name == "Splitboss":
-      width = 24
-      height = 32
-    elif entity_name == "Contort":
-      height = 32
-    elif entity_name in ("Lion", "Elevator", "Big_Door"):
-      width = 32
-      height = 32
-    elif entity_name == "Red_Walker":
-      width = 32
-      height = 48
-    elif entity_name == "Huge_Fucking_Stag":
-      width = 64
-      height = 80
-    elif entity_name == "Fire_Pillar":
-      y += 16
-    elif entity_name == "Redsea_NPC":
-      sy = frame * 16 // 10
-    elif entity_name == "Circus_Folks":
-      if frame == 0:
-        # arthur
-        sprite = sprites["circus_folks_arthur"]
-        sy = 64
-        if x < 1340:
-          # percarious
-          y -= 7 * 16
-        else:
-          # dead
-          sx = 32
-      elif frame == 1:
-        # javiera
-        sprite = sprites["circus_folks_javiera"]
-        if x < 1340:
-          # lions closing in
-          pass
-        else:
-          # dead
-          sy = 48
-      elif frame == 2:
-        # both
-        sprite = sprites["circus_folks_both"]
-        y -= 64
-        height = 32
-      else: unreachable()
-    elif entity_name == "KeyBlock":
-      if frame == 0:
-        pass # small key block
-      elif frame in (1, 2, 3):
-        # large key gate
-        sprite = sprites["big_gate"]
-        width = 32
-        if frame == 1:
-          sy = 7 * 16
-        elif frame == 2:
-          sy = 0
-        elif frame == 3:
-          sy = 6 * 16
-      elif frame == 4:
-        # card gate
-        sprite = sprites["big_gate"]
-        width = 32
-        if map_name == "OVERWORLD":
-          sy = 8 * 16
-        elif map_name == "BEACH":
-          sy = 9 * 16
-        elif map_name == "SUBURB":
-          sy = 10 * 16
-        elif map_name == "CELL":
-          sy = 13 * 16
-        elif map_name == "TERMINAL":
-          sy = 14 * 16
-        elif map_name == "NEXUS":
-          sy = 15 * 16
-        elif map_name == "BLANK":
-          # there are 2 here
-          if y == 864:
-            sy = 11 * 16
-          else:
-            sy = 16 * 16
-        else:
-          print("WARNING: ignoring card gate in map: {}".format(map_name))
-          continue
-      else:
-        print("WARNING: ignoring KeyBlock frame: {}".format(frame))
-        continue
-    elif entity_name == "Nonsolid":
-      nonsolid_type = entity["type"]
-      if nonsolid_type == "Rail_1":
-        sprite = sprites["nonsolid_rail_sprite"]
-      elif nonsolid_type == "Rail_CROWD":
-        sprite = sprites["nonsolid_rail_crowd"]
-      else:
-        print("WARNING: what nonsolid type is this: {}".format(nonsolid_type))
-    elif entity_name == "Jump_Trigger":
-      if map_name in ("APARTMENT", "CLIFF", "BEACH", "CROWD", "DEBUG"):
-        # jump triggers are invisible in these maps
-        continue
-      elif map_name == "HOTEL":
-        if entity["type"] != "1":
-          # only type=1 is visible
-          continue
-    elif entity_name == "Gate":
-      if map_name == "BLANK":
-        sy = 32
-    elif entity_name == "Console":
-      if map_name == "WINDMILL":
-        sprite = sprites["windmill_console"]
-        sprite2 = sprites["windmill_shell"]
-        width = 48
-        height = 48
-    elif entity_name == "Propelled":
-      if (frame & 1) == 0:
-        sy = 16
-      if consume_dust_at(x, y):
-        sx = 16
-    elif entity_name == "Shadow_Briar":
-      sy = 32
-      if map_name == "GO":
-        # don't bother with this one
-        continue
-      if frame in (0, 2, 3, 4):
-        pass # face down
-      elif frame == 1:
-        sx = 64 # face up
-      else:
-        print("WARNING: ignoring Shadow_Briar frame: {}".format(frame))
-        continue
-    elif entity_name == "Chaser":
-      height = 32
-      sy = 32
-      if frame == 0:
-        sx = 32
-    elif entity_name == "Treasure":
-      if map_name == "CELL":
-        sy = 32
-    elif entity_name == "Rat":
-      if map_name == "CELL":
-        sy = 16
-    elif entity_name == "Dash_Pad":
-      sy = 16
-      sx = frame * 16
-    elif entity_name == "Spike_Roller":
-      if frame in (0, 3):
-        sprite = sprites["Spike_Roller_H_S"]
-        width = 128
-      elif frame in (1, 2):
-        sprite = sprites["Spike_Roller_V_S"]
-        height = 128
-      elif frame in (4, 7):
-        sprite = sprites["Spike_Roller_H"]
-        width = 128
-      elif frame in (5, 6):
-        sprite = sprites["Spike_Roller_V"]
-        height = 128
-      else:
-        print("WARNING: ignoring Spike_Roller frame: {}".format(frame))
-        continue
-    elif entity_name == "Button":
-      if map_name == "REDCAVE":
-        sy = 32
-      elif map_name == "CELL":
-        sy = 64
-      else:
-        sy = 16
-    elif entity_name in ("Hole", "CrackedTile"):
-      if map_name == "BEDROOM":
-        pass
-      elif map_name == "STREET":
-        sx = 16
-      elif map_name == "REDCAVE":
-        sx = 32
-      elif map_name == "CIRCUS":
-        sx = 32
-        sy = 16
-      elif map_name == "HOTEL":
-        # three different styles depending on what floor we're on
-        quad_x = int(x >= 960)
-        quad_y = int(y >= 800)
-        if (quad_x, quad_y) == (0, 0):
-          sy = 16
-        elif (quad_x, quad_y) == (1, 1):
-          sx = 16
-          sy = 16
-        else:
-          sx = 48
-      else:
-        print("WARNING: ignoring {} in map: {}".format(entity_name, map_name))
-        continue
-    elif entity_name == "Key":
-      if y > 100:
-        # this one's not real, i guess
-        print("WARNING: ignoring key at: {},{}".format(x, y))
-        continue
-    elif entity_name == "Dungeon_Statue":
-      width = 32
-      height = 48
-      if map_name == "BEDROOM":
-        pass
-      elif map_name == "REDCAVE":
-        sx = 32
-      elif map_name == "CROWD":
-        sx = 64
-      else: unreachable()
-    elif entity_name == "NPC":
-      npc_type = entity["type"]
-      if npc_type == "Cell_Body":
-        sprite = sprites["npc_cell_bodies"]
-        if frame == 0:
-          pass
-        elif frame == 2:
-          sx = 32
-        elif frame == 4:
-          sy = 16
-        elif frame == 6:
-          sx = 32
-          sy = 16
-        else:
-          print("WARNING: ignoring npc cell body frame: {}".format(frame))
-          continue
-      elif npc_type == "rock":
-        sprite = sprites["npc_rock"]
-        if map_name == "CELL":
-          sx = 16
-        elif map_name == "SPACE":
-          sprite = sprites["Space_NPC"]
-          sy = 48
-          if x > 912:
-            sx = 16
-      elif npc_type == "statue":
-        sprite = sprites["npc_sage_statue"]
-      elif npc_type == "big_key":
-        sprite = sprites["big_key"]
-        if map_name == "BEDROOM":
-          sy = 0
-        elif map_name == "REDCAVE":
-          sy = 16
-        elif map_name == "CROWD":
-          sy = 32
-        else: unreachable()
-      elif npc_type == "generic":
-        if map_name == "BEACH":
-          if frame == 7:
-            # Hews the lobster
-            sprite = sprites["beach_npcs"]
-          elif frame == 16:
-            sprite = sprites["Trade_NPC"]
-            sx = 96
-            sy = 128
-        elif map_name == "WINDMILL":
-          # don't bother rendering the windmill blades
-          continue
-        elif map_name == "BLUE":
-          sprite = sprites["npc_snowman"]
-        elif map_name == "HAPPY":
-          # invisible NPC that talks to you at the save point.
-          continue
-        elif map_name == "DRAWER":
-          # trigger for dimming the screen as you leave the game over area.
-          continue
-        elif map_name == "CELL":
-          sprite = sprites["npc_cell_bodies"]
-          sy = 32
-        elif map_name == "CLIFF":
-          if frame == 7:
-            sprite = sprites["npc_golem"]
-          elif frame == 6:
-            sprite = sprites["Dog"]
-          else: unreachable()
-        elif map_name == "HOTEL":
-          if frame == 12:
-            sprite = sprites["npc_hotel"]
-            sx = 32
-          elif frame == 5:
-            # spooky eye in the water
-            sprite = sprites["Eye_Boss"]
-            sx = 72
-            width = 24
-            height = 24
-        elif map_name == "FIELDS":
-          sprite = sprites["Trade_NPC"]
-          sy = 128
-          if frame == 8:
-            # Olive the rabbit
-            sprite = sprites["Forest_NPC"]
-            sy = 48
-          elif frame == 13:
-            # Bob the Hamster
-            pass
-          elif frame == 14:
-            # Chikapu
-            sx = 32
-          elif frame == 15:
-            # Kuribu
-            sx = 64
-          elif frame == 7:
-            # Rank
-            sy = 96
-            sx = 32
-            height = 32
-            draw_ranks_bush = True
-          else: unreachable()
-        elif map_name == "FOREST":
-          # James
-          sprite = sprites["Forest_NPC"]
-          sy = 16
-        elif map_name == "SPACE":
-          sprite = sprites["Space_NPC"]
-          if y > 500:
-            # drifter
-            pass
-          else:
-            # kings
-            sy = 64
-            width = 32
-            height = 32
-            if x > 912:
-              sx = 64
-        elif map_name == "REDCAVE":
-          sprite = sprites["smoke_red"]
-          width = 32
-          height = 32
-        elif map_name == "GO":
-          if frame == 7:
-            # rock in the super bright room
-            sprite = sprites["npc_rock"]
-          elif frame == 11:
-            # trafic cone blocking HAPPY
-            sprite = sprites["ground_thorn"]
-            sx = 48
-            sy = 16
-            y += 8
-          else: unreachable()
-        elif map_name == "SUBURB":
-          sprite = sprites["Suburb_Walker"]
-        elif map_name == "DEBUG":
-          sprite = sprites["npc_devs"]
-          if frame == 17:
-            pass
-          elif frame == 18:
-            sy = 16
-          else: unreachable()
-        elif map_name == "APARTMENT":
-          sprite = sprites["random_npcs"]
-        else:
-          print("WARNING: ignoring generic npc in map: {}: {}: {},{}".format(map_name, frame, x, y))
-          continue
-      elif npc_type == "biofilm":
-        sprite = sprites["biofilm"]
-        width = 32
-        height = 32
-      elif npc_type == "npc_test":
-        # "like music?" scribbly guy
-        sprite = sprites["npc_squiggles"]
-      else:
-        print("WARNING: ignoring npc type: {}: {}: {},{}".format(npc_type, frame, x, y))
-        continue
-    elif entity_name == "Trade_NPC":
-      if frame == 0:
-        # Miao Xiao Tuan Er
-        pass
-      elif frame in (1, 2):
-        # fish
-        sy = 32
-      elif frame == 3:
-        # Finty
-        sy = 80
-        draw_fintys_shop = True
-      elif frame == 4:
-        # Icky
-        sy = 16
-      else: unreachable()
-    elif entity_name == "Forest_NPC":
-      if frame == 0:
-        # Thorax
-        sx = 16
-      elif frame == 20:
-        # mushroom
-        sy = 32
-      elif frame == 30:
-        # Crickson
-        sy = 48
-      elif frame == 34:
-        # scared rabit
-        sx = 64
-        sy = 48
-      else: unreachable()
-    elif entity_name == "Space_NPC":
-      if x > 912:
-        sy = 16
-      if frame in (8, 18):
-        # dead
-        sx = 128
-    elif entity_name == "Space_Face":
-      sprite = sprites["Space_NPC"]
-      sy = 32
-      if x > 912:
-        sx = 32
-    elif entity_name == "Suburb_Walker":
-      if frame < 6:
-        sy = frame * 16
-      elif (x, y) == (192, 848):
-        sy = 0
-      elif (x, y) == (544, 848):
-        sy = 64
-      elif (x, y) == (688, 848):
-        sy = 32
-      elif (x, y) == (32, 1008):
-        sy = 0
-      elif (x, y) == (192, 1008):
-        sy = 96
-        draw_noose = True
-      elif (x, y) == (592, 896):
-        sy = 16
-      elif (x, y) == (96, 1216):
-        sx = 128
-        sy = 16
-      elif (x, y) == (272, 1216):
-        sx = 128
-        sy = 0
-      else: unreachable()
-    elif entity_name == "Mitra":
-      if map_name == "FIELDS":
-        sy = 16
-        draw_mitras_fields_bike = True
-      elif map_name == "CLIFF":
-        sprite = sprites["mitra_on_bike"]
-        sx = 40
-        width = 20
-        height = 20
-        y -= 4
-        flip_h = True
-      elif map_name == "OVERWORLD":
-        sprite = sprites["mitra_on_bike"]
-        sx = 40
-        width = 20
-        height = 20
-        y -= 4
-      elif map_name == "GO":
-        # there's no good place to show mitra in GO
-        continue
-      else:
-        print("WARNING: default rendering mitra in map: {}".format(map_name))
-    elif entity_name == "Sage":
-      sy = 16
-      if map_name in ("BEDROOM", "REDCAVE", "CROWD", "NEXUS", "TERMINAL", "OVERWORLD", "GO"):
-        pass
-      elif map_name == "BLANK":
-        # don't show those two
-        continue
-      else:
-        print("WARNING: default rendering sage in map: {}".format(map_name))
-    elif entity_name == "Happy_NPC":
-      if frame == 18:
-        continue # briar walking along a trough thing
-      if frame in (0,1,3):
-        sy = 16 # male
-    elif entity_name == "Fisherman":
-      sprite = sprites["beach_npcs"]
-      sy = 16
-    elif entity_name == "Person":
-      # there's information to rotate the persons,
-      # but they rotate themselves randomly before you can see it in game,
-      # so whatever
-      pass
-    elif entity_name == "Health_Cicada":
-      if map_name == "CELL":
-        sy = 32
-    elif entity_name == "Eye_Boss":
-      width = 24
-      height = 24
-      if y == 1648:
-        sy = 24
-    elif entity_name == "Red_Boss":
-      width = 32
-      height = 32
-    elif entity_name == "Sage_Boss":
-      height = 24
-      # what are you doing over there?
-      x += 24
-    elif entity_name == "Red_Pillar":
-      height = 64
-    elif entity_name == "Mover":
-      sx = 16
-    elif entity_name == "Annoyer":
-      if map_name == "CELL":
-        sy = 16
-      elif frame == 0:
-        sy = 0
-      elif frame == 2:
-        sy = 32
-      elif frame == 8:
-        sx = 32
-        sy = 16
-      # for some reason, these enemies always start offset a littl
-      x -= 3
-      y -= 2
-    elif entity_name == "Slime":
-      if is_boi:
-        sx = 32
-    elif entity_name == "Frog":
-      if is_boi:
-        sy = 32
-    elif entity_name == "Door":
-      door_type = entity["type"]
-      if door_type in ("1", "5", "6", "8", "10", "11", "12", "13", "14", "15"):
-        continue # invisible
-      elif door_type == "4":
-        sprite = sprites["door_portal"]
-        if map_name == "CELL":
-          sy = 16
-      elif door_type == "7":
-        if map_name == "NEXUS":
-          # this one's invisible
-          continue
-        sprite = sprites["whirlpool"]
-      elif door_type == "9":
-        if map_name != "NEXUS":
-          continue
-        sprite = sprites["nexus_doors"]
-        width = 32
-        height = 32
-        if frame == 13: # STREET
-          sy = 0 * 32
-        elif frame == 49: # OVERWORLD
-          sy = 1 * 32
-        elif frame == 63: # BEDROOM
-          sy = 12 * 32
-        elif frame == 46: # SUBURB
-          sy = 19 * 32
-        elif frame == 60: # APARTMENT
-          sy = 4 * 32
-        elif frame == 55: # BEACH
-          sy = 11 * 32
-        elif frame == 48: # FIELDS
-          sy = 13 * 32
-        elif frame == 50: # FOREST
-          sy = 8 * 32
-        elif frame == 51: # TERMINAL
-          sy = 15 * 32
-        elif frame == 64: # WINDMILL
-          sy = 9 * 32
-        elif frame == 52: # GO
-          sy = 14 * 32
-        elif frame == 56: # BLUE
-          sy = 20 * 32
-        elif frame == 57: # HAPPY
-          sy = 16 * 32
-        elif frame == 62: # REDCAVE
-          sy = 2 * 32
-        elif frame == 53: # REDSEA
-          sy = 10 * 32
-        elif frame == 54: # CLIFF
-          sy = 7 * 32
-        elif frame == 61: # CROWD
-          sy = 3 * 32
-        elif frame == 58: # CIRCUS
-          sy = 6 * 32
-        elif frame == 45: # CELL
-          sy = 18 * 32
-        elif frame == 47: # SPACE
-          sy = 17 * 32
-        elif frame == 59: # HOTEL
-          sy = 5 * 32
-        else: unreachable()
-      elif door_type == "16":
-        sprite = sprites["nexus_pad"]
-        width = 32
-        height = 32
-        if map_name == "CELL":
-          sy = 32
-      else:
-        print("WARNING: ignoring door type: {}".format(door_type))
-        continue
-    elif entity_name in ("solid_tile", "Water_Anim", "Go_Detector"):
-      continue # invisible
-    elif entity_name == "Solid_Sprite":
-      solid_type = entity["type"]
-      if solid_type in ("blocker", "vblock"):
-        continue # invisible
-      elif solid_type == "sign":
-        sprite = sprites["npc_rock"]
-        if frame == 2:
-          sy = 16
-        elif frame == 3:
-          sx = 16
-          sy = 16
-        elif frame == 4:
-          sy = 32
-        else:
-          print("WARNING: ignoring sign: {}: {},{}".format(frame, x, y))
-          continue
-      elif solid_type in ("red_cave_n_ss", "red_cave_r_ss", "red_cave_l_ss"):
-        sprite = sprites["red_cave"]
-        width = 64
-        height = 64
-      elif solid_type == "tree":
-        sprite = sprites["debug_tree"]
-        width = 64
-        height = 64
-      else:
-        print("WARNING: ignoring Solid_Sprite type: {}: {}: {},{}".format(solid_type, frame, x, y))
-        continue
-    elif entity_name in (
-        "Pillar_Switch", "Dog", "Shieldy", "Rotator", "Dust",
-        "Burst_Plant", "Four_Shooter", "Eye_Light", "Sadbro", "Suburb_Killer"
-      ):
-      pass # simple
-    elif entity_name == "Stop_Marker":
-      continue # invisible
-    elif entity_name == "Event":
-      if frame == 2:
-        sprite = sprites["checkpoint"]
-        if map_name == "CELL":
-          sy = 16
-      else:
-        continue # invisible
-    elif entity_name in sprites:
-      if entity_name not in warning_set:
-        warning_set.add(entity_name)
-        print("default rendering sprite: {}".format(entity_name))
-
-    if entity_name == "WallBoss":
-      # special case for all these sprites
-      image.paste(sprites["wall_boss_wall"], dx=1440, dy=960, width=160, height=32)
-      image.paste(sprites["wall_boss_mouth"], sx=16, dx=1504, dy=960, width=32, height=32)
-      image.paste(sprites["wall_boss_hand"], dx=1456, dy=992, width=32, height=32)
-      image.paste(sprites["wall_boss_hand"], dx=1552, dy=992, width=32, height=32, flip_h=True)
-      did_anything = True
-    elif sprite != None:
-      image.paste(sprite, sx=sx, sy=sy, dx=x, dy=y, width=width, height=height, flip_h=flip_h, rotate=rotate)
-      did_anything = True
-      if sprite2 != None:
-        image.paste(sprite2, sx=sx, sy=sy, dx=x, dy=y, width=width, height=height)
-      elif draw_ranks_bush:
-        # the 12 is not a mistake. this bush is strangly aligned
-        image.paste(sprite, sx=0, sy=48, dx=x+16, dy=y+12, width=16, height=16)
-      elif draw_mitras_fields_bike:
-        image.paste(sprites["bike"], sx=20, sy=0, dx=x-22, dy=y-11, width=20, height=20)
-      elif draw_fintys_shop:
-        # gun
-        image.paste(sprites["Trade_NPC"], sx=64, sy=80, dx=x-32, dy=y+32, width=16, height=16)
-        # money sack
-        image.paste(sprites["Trade_NPC"], sx=80, sy=80, dx=x+4, dy=y+32, width=16, height=16)
-        # shoes
-        image.paste(sprites["Trade_NPC"], sx=96, sy=80, dx=x+32+6, dy=y+32, width=16, height=16)
-      elif draw_noose:
-        for i in range(1, 4):
-          image.paste(sprite, sx=16, sy=96, dx=x, dy=y-16*i, width=16, height=16)
+    spec = entity_specs.get(entity_name)
+    if spec == None:
+      if entity_name in sprites:
+        warn_once(entity_name, "default rendering sprite: {}".format(entity_name))
+      spec = draw(entity_name, x, y)
+    elif type(spec) == tuple:
+      sx, sy, width, height, offset_x, offset_y = spec
+      spec = draw(entity_name, x + offset_x, y + offset_y, sx=sx, sy=sy, width=width, height=height)
     else:
-      if entity_name not in warning_set:
-        warning_set.add(entity_name)
-        print("WARNING: ignoring entity: {}".format(entity_name))
+      spec = spec(entity, x, y, entity["frame"], context)
+      if spec == None: continue
+    sprite_name, x, y, sx, sy, width, height, flip_h, rotate, extra = spec
+
+    if sprite_name not in sprites:
+      warn_once(entity_name, "WARNING: ignoring entity: {}".format(entity_name))
+      continue
+    if clip != None and extra == None and not rects_overlap(clip, (x, y) + ((height, width) if rotate != 0 else (width, height))):
+      did_anything = True
+      continue
+    sprite = sprites[sprite_name]
+    sprite_frames.paste(image, sprite, sx=sx, sy=sy, dx=x, dy=y, width=width, height=height, flip_h=flip_h, rotate=rotate)
+    did_anything = True
+    if extra != None:
+      extra(image, sprite, sx, sy, x, y, width, height)
 
   return did_anything
 
-def grayscale(v):
-  gray = (
-    ((v >> 24) & 0xff) +
-    ((v >> 16) & 0xff) +
-    ((v >>  8) & 0xff)
-  ) // 3
-  return (
-    (gray << 24) |
-    (gray << 16) |
-    (gray <<  8) |
-    (v & 0xff)
-  )
+def rects_overlap(a, b):
+  """a and b are x, y, width, height"""
+  return a[0] < b[0] + b[2] and b[0] < a[0] + a[2] and a[1] < b[1] + b[3] and b[1] < a[1] + a[3]
+
+file_hashes = {}
+def hash_file(filename):
+  digest = file_hashes.get(filename)
+  if digest == None:
+    with find_and_open(filename, "rb") as f:
+      digest = buildcache.hash_bytes(f.read())
+    file_hashes[filename] = digest
+  return digest
+
+def get_input_filenames(mapfile, args):
+  # every file that affects the output except for the registry and the sprites,
+  # which we only find out about by rendering the entities.
+  filenames = [mapfile["tileset"]] + [layerfile for layerfile in mapfile["layers"] if layerfile != None]
+  if args.physics:
+    filenames += [physics_tileset_path, "blocker_sprite.png", "vblock_sprite.png"]
+  if args.grid:
+    filenames.append(["grid_overlay.png", "grid_overlay_solid.png"][args.physics])
+  return filenames
+
+def read_changes(path):
+  """the files that extract_swf.py --incremental says changed, relative to the source directory"""
+  with open(path) as f:
+    changes = json.load(f)
+  return set(changes["added"] + changes["changed"] + changes["removed"])
+
+def is_affected_by_changes(mapfile, args, cache_entry, changed_paths):
+  """whether anything the map was last built from is in changed_paths, or it was built with different settings or code.
+  without a cache entry or the outputs, there's no telling, so it is."""
+  if cache_entry == None: return True
+  inputs = cache_entry["inputs"]
+  if inputs.get("renderer") != get_renderer_hash(): return True
+  if inputs.get("physics") != mapfile["physics"]: return True
+  if inputs.get("flags") != get_build_flags(args): return True
+  if inputs.get("png") != get_png_settings(args): return True
+  for path in cache_entry["outputs"]:
+    if not os.path.exists(path): return True
+  for filename in [registry_path] + get_input_filenames(mapfile, args) + list(cache_entry["sprites"]):
+    if filename in changed_paths: return True
+    if filename.endswith(".dat") and filename[:-len(".dat")] + ".bin" in changed_paths: return True
+  return False
+
+# the code that decides what gets written. changing any of it means every map has to be built again.
+renderer_files = [__file__] + [module.__file__ for module in (
+  simplepng, fastpaint, tilelayer, tilestamps, imagefilters, spriteatlas, pngstream, pngcache, registryindex, spatialindex, slippytiles)]
+
+def get_renderer_hash():
+  return buildcache.hash_bytes(" ".join(hash_file(filename) for filename in renderer_files).encode("utf8"))
+
+def get_build_inputs(mapfile, entities, args):
+  return {
+    "renderer": get_renderer_hash(),
+    "files": {filename: hash_file(filename) for filename in get_input_filenames(mapfile, args)},
+    "entities": buildcache.hash_bytes(json.dumps(entities, sort_keys=True).encode("utf8")),
+    "physics": mapfile["physics"],
+    "flags": get_build_flags(args),
+    "png": get_png_settings(args),
+  }
+
+def get_build_flags(args):
+  return {"physics": args.physics, "separate": args.separate, "grid": args.grid, "tiles": args.tiles, "region": args.region}
+
+def get_png_settings(args):
+  return [args.png_mode, args.png_level]
+
+# filters that get run over every layer of these maps, except in physics mode
+map_filters = {
+  "SUBURB": [imagefilters.grayscale],
+}
+
+@renderprofile.timed("effects")
+def apply_effects(layers, map_name, args):
+  if not args.physics:
+    for image_filter in map_filters.get(map_name, ()):
+      for layer in layers:
+        if layer == None: continue
+        image_filter(layer)
+
+  # overlay grid lines
+  if args.grid:
+    for layer in layers:
+      if layer == None: continue
+      for y in range(layer.height // 160):
+        for x in range(layer.width // 160):
+          layer.paste([grid_overlay, grid_overlay_solid][args.physics], dx=x*160, dy=y*160)
+
+def get_file_name_base(mapfile, args):
+  file_name_base = "maps/" + mapfile["map_name"]
+  if args.physics:
+    file_name_base += "_p"
+  if args.region != None:
+    file_name_base += "_{}_{}_{}x{}".format(*args.region)
+  return file_name_base
+
+def get_cache_key(mapfile, args):
+  cache_key = os.path.basename(get_file_name_base(mapfile, args))
+  if args.separate:
+    cache_key += "_separate"
+  return cache_key
+
+def build_map(mapfile, objects_by_map_name, args):
+  """returns the list of files written and the list of sprite files used"""
+  with renderprofile.map_scope(mapfile["map_name"]):
+    result = render_map(mapfile, objects_by_map_name, args)
+  if args.sprite_report:
+    print("Sprites used by {}: {}".format(mapfile["map_name"], " ".join(sorted(sprites.used)) or "(none)"))
+    print("Tiles used by {}: {} distinct".format(mapfile["map_name"], tilelayer.count_distinct_tiles(read_map_layers(mapfile))))
+  return result
+
+def render_map(mapfile, objects_by_map_name, args):
+  map_name = mapfile["map_name"]
+  file_name_base = get_file_name_base(mapfile, args)
+  print("Processing: " + map_name)
+  sprites.used.clear()
+
+  if args.stream:
+    return build_map_streaming(mapfile, objects_by_map_name, args), sprites.used_paths()
+
+  if args.region != None:
+    return build_map_region(mapfile, objects_by_map_name, args), sprites.used_paths()
+
+  if args.incremental:
+    context = get_incremental_context(mapfile, objects_by_map_name[map_name], args)
+    outputs = build_map_incrementally(mapfile, objects_by_map_name, args, context)
+    if outputs != None:
+      return outputs, sprites.used_paths()
+
+  layers = render_layers(mapfile, objects_by_map_name, args)
+
+  # save images
+  outputs = []
+  if args.separate:
+    for i, layer in enumerate(layers):
+      if layer == None: continue
+      outputs.append("{}_{}.png".format(file_name_base, i))
+      with renderprofile.stage("encode"), open(outputs[-1], "wb") as f:
+        write_png(f, layer)
+  else:
+    composite_layers(layers)
+    outputs.append(file_name_base + ".png")
+    with renderprofile.stage("encode"), open(outputs[-1], "wb") as f:
+      write_png(f, layers[0])
+    if args.incremental:
+      present = [layer != None for layer in layers]
+      save_incremental_state(mapfile, context, read_map_layers(mapfile), present, layers[0])
+    if args.tiles:
+      outputs.append(write_tiles(mapfile, layers[0], args))
+  return outputs, sprites.used_paths()
+
+def render_layers(mapfile, objects_by_map_name, args):
+  """returns the four layer images with the entities and effects drawn, or None for the empty ones"""
+  map_name = mapfile["map_name"]
+  # build initial map image
+  layers = generate_map_image(mapfile, physics_only=args.physics)
+  # draw the supported entities on the maps
+  entity_layer = simplepng.ImageBuffer(layers[0].width, layers[0].height)
+  if args.physics:
+    render_function = render_physics_entities
+  else:
+    render_function = render_entities
+  if render_function(entity_layer, objects_by_map_name[map_name], map_name):
+    layers[2] = entity_layer
+
+  apply_effects(layers, map_name, args)
+  return layers
+
+def composite_layers(layers):
+  """adds everything to layers[0] and returns it"""
+  with renderprofile.stage("composite"):
+    for layer in layers[1:]:
+      if layer == None: continue
+      layers[0].paste(layer)
+  return layers[0]
+
+def has_tiles(layer, x_blocks, y_blocks):
+  """whether the layer has any tiles in the part that gets painted"""
+  for y in range(min(y_blocks, layer.height)):
+    if any(tilelayer.get_row(layer, y)[:x_blocks]):
+      return True
+  return False
+
+def render_region(mapfile, objects_by_map_name, args, x, y, width, height):
+  """renders the rectangle of the map at x,y, and returns the same image that cropping the whole map would give.
+  only the tiles and entities that overlap it get painted. returns None if it's entirely outside the map."""
+  map_name = mapfile["map_name"]
+  layers = read_map_layers(mapfile)
+  first_layer = [layer for layer in layers if layer != None][0]
+  x_blocks = first_layer.width
+  y_blocks = first_layer.height
+  right = min(x + width, x_blocks * 16)
+  bottom = min(y + height, y_blocks * 16)
+  x = max(x, 0)
+  y = max(y, 0)
+  if right <= x or bottom <= y:
+    return None
+  # paint whole tiles, and cut out the exact rectangle at the end
+  tile_x = x // 16
+  tile_y = y // 16
+  tiles_wide = (right + 15) // 16 - tile_x
+  tiles_high = (bottom + 15) // 16 - tile_y
+  left = tile_x * 16
+  top = tile_y * 16
+  region_width = tiles_wide * 16
+  region_height = tiles_high * 16
+
+  tileset = read_tileset(mapfile["tileset"])
+  region_layers = [None, None, None, None]
+  for i, layer in enumerate(layers):
+    # a layer with tiles anywhere gets things like grid lines everywhere, even where it's empty
+    if layer == None or not has_tiles(layer, x_blocks, y_blocks): continue
+    region_layers[i] = simplepng.ImageBuffer(region_width, region_height)
+    paint_with_layer(region_layers[i], tilelayer.crop(layer, tile_x, tile_y, tiles_wide, tiles_high), tileset)
+  if region_layers[0] == None:
+    region_layers[0] = simplepng.ImageBuffer(region_width, region_height)
+  entity_layer = simplepng.ImageBuffer(region_width, region_height)
+  map_region = lambda image: ImageRegion(image, left, top, x_blocks * 16, y_blocks * 16)
+  if render_entities(map_region(entity_layer), objects_by_map_name[map_name], map_name, clip=(left, top, region_width, region_height)):
+    region_layers[2] = entity_layer
+
+  apply_effects([None if layer == None else map_region(layer) for layer in region_layers], map_name, args)
+  composite = composite_layers(region_layers)
+  if (x, y, right, bottom) == (left, top, left + region_width, top + region_height):
+    return composite
+  image = simplepng.ImageBuffer(right - x, bottom - y)
+  copy_pixels(image, composite, x - left, y - top, 0, 0, image.width, image.height)
+  return image
+
+def build_map_region(mapfile, objects_by_map_name, args):
+  x, y, width, height = args.region
+  image = render_region(mapfile, objects_by_map_name, args, x, y, width, height)
+  if image == None:
+    sys.exit("ERROR: region {},{},{},{} is outside of map: {}".format(x, y, width, height, mapfile["map_name"]))
+  output = get_file_name_base(mapfile, args) + ".png"
+  with renderprofile.stage("encode"), open(output, "wb") as f:
+    write_png(f, image)
+  return [output]
+
+def get_incremental_state_paths(mapfile):
+  base = os.path.join("maps", ".incremental", mapfile["map_name"])
+  return base + ".json", base + ".rgba"
+
+def get_incremental_context(mapfile, entities, args):
+  # everything the last render depended on other than the layer cells themselves
+  context = get_build_inputs(mapfile, entities, args)
+  for layerfile in mapfile["layers"]:
+    context["files"].pop(layerfile, None)
+  return context
+
+def get_painted_layers(layers):
+  # crop each layer to the part that actually gets painted, which is the size of the first layer.
+  first_layer = [layer for layer in layers if layer != None][0]
+  return [
+    None if layer == None else tilelayer.crop(layer, 0, 0, first_layer.width, first_layer.height)
+    for layer in layers
+  ]
+
+@renderprofile.timed("incremental")
+def save_incremental_state(mapfile, context, layers, present, composite):
+  state_path, pixels_path = get_incremental_state_paths(mapfile)
+  if not os.path.isdir(os.path.dirname(state_path)):
+    os.makedirs(os.path.dirname(state_path))
+  grids = []
+  for layer in get_painted_layers(layers):
+    if layer == None:
+      grids.append(None)
+    else:
+      grids.append({
+        "width": layer.width,
+        "height": layer.height,
+        "data": base64.b64encode(layer.data.tobytes()).decode("ascii"),
+      })
+  state = {
+    "context": context,
+    "sprites": {path: hash_file(path) for path in sprites.used_paths()},
+    "sprite_names": sorted(sprites.used),
+    "present": present,
+    "grids": grids,
+  }
+  pngcache.write_pixels(pixels_path, composite)
+  with open(state_path, "w") as f:
+    json.dump(state, f)
+
+@renderprofile.timed("incremental")
+def load_incremental_state(mapfile, context):
+  state_path, pixels_path = get_incremental_state_paths(mapfile)
+  try:
+    with open(state_path, "r") as f:
+      state = json.load(f)
+    composite = pngcache.read_pixels(pixels_path)
+  except (OSError, ValueError):
+    return None, None
+  if composite == None or state["context"] != context or "sprite_names" not in state:
+    return None, None
+  for path, digest in state["sprites"].items():
+    try:
+      if hash_file(path) != digest: return None, None
+    except OSError:
+      return None, None
+  # we're going to write into this, so get it out of the mmap.
+  data = array.array("I")
+  data.frombytes(composite.data.cast("B"))
+  composite.data = data
+  grids = []
+  for grid in state["grids"]:
+    if grid == None:
+      grids.append(None)
+    else:
+      data = array.array("H")
+      data.frombytes(base64.b64decode(grid["data"]))
+      grids.append(tilelayer.Layer(grid["width"], grid["height"], data))
+  state["grids"] = grids
+  return state, composite
+
+def build_map_incrementally(mapfile, objects_by_map_name, args, context):
+  """repaints only the screens whose tiles changed since the last render.
+  the whole image still gets encoded again, which is most of what an incremental build of a big map costs.
+  returns the files written, or None if that's not possible and the whole map needs to be rendered."""
+  map_name = mapfile["map_name"]
+  state, composite = load_incremental_state(mapfile, context)
+  if state == None: return None
+  # the screens we don't repaint still have the sprites they were drawn with
+  sprites.used.update(state["sprite_names"])
+  layers = get_painted_layers(read_map_layers(mapfile))
+  width = layers[0].width * 16
+  height = layers[0].height * 16
+  if (composite.width, composite.height) != (width, height): return None
+
+  changed_cells = set()
+  for i, (old_layer, new_layer) in enumerate(zip(state["grids"], layers)):
+    if (old_layer == None) != (new_layer == None): return None
+    if new_layer == None: continue
+    if (old_layer.width, old_layer.height) != (new_layer.width, new_layer.height): return None
+    if any(new_layer.data) != state["present"][i]:
+      # a layer appearing or disappearing changes things like the grid lines everywhere.
+      return None
+    changed_cells.update(tilelayer.find_changed_cells(old_layer, new_layer))
+  if not state["present"][0]: return None
+
+  changed_screens = sorted(set((x * 16 // 160, y * 16 // 160) for x, y in changed_cells))
+  print("Repainting {} screens".format(len(changed_screens)))
+  outputs = []
+  if len(changed_screens) > 0:
+    tileset = read_tileset(mapfile["tileset"])
+    for screen_x, screen_y in changed_screens:
+      region_x = screen_x * 160
+      region_y = screen_y * 160
+      region_width = min(160, width - region_x)
+      region_height = min(160, height - region_y)
+      region_layers = [None, None, None, None]
+      for i, layer in enumerate(layers):
+        if not state["present"][i]: continue
+        region_layers[i] = simplepng.ImageBuffer(region_width, region_height)
+        if i == 2:
+          # only the entities that overlap the screen get drawn
+          render_entities(ImageRegion(region_layers[i], region_x, region_y, width, height), objects_by_map_name[map_name], map_name,
+            clip=(region_x, region_y, region_width, region_height))
+        else:
+          region_tiles = tilelayer.crop(layer, region_x // 16, region_y // 16, region_width // 16, region_height // 16)
+          paint_with_layer(region_layers[i], region_tiles, tileset)
+      apply_effects(region_layers, map_name, args)
+      with renderprofile.stage("composite"):
+        for layer in region_layers[1:]:
+          if layer == None: continue
+          region_layers[0].paste(layer)
+        copy_pixels(composite, region_layers[0], 0, 0, region_x, region_y, region_width, region_height)
+
+  output = get_file_name_base(mapfile, args) + ".png"
+  # the composite we kept is the same as the image, unless someone deleted the image or wants it written anyway
+  if len(changed_screens) > 0 or args.force or not os.path.exists(output):
+    outputs.append(output)
+    with renderprofile.stage("encode"), open(output, "wb") as f:
+      write_png(f, composite)
+  save_incremental_state(mapfile, context, layers, state["present"], composite)
+  if args.tiles:
+    outputs.append(write_tiles(mapfile, composite, args))
+  return outputs
+
+@renderprofile.timed("tiles")
+def write_tiles(mapfile, image, args):
+  """returns the path to the manifest"""
+  directory = os.path.join("maps", "tiles", os.path.basename(get_file_name_base(mapfile, args)))
+  written, skipped = slippytiles.write_tiles(image, directory)
+  print("Wrote {} tiles, {} unchanged".format(written, skipped))
+  return os.path.join(directory, "manifest.json")
+
+class ImageRegion:
+  """looks like a whole map image to paste(), but only keeps the rectangle at left,top the size of region."""
+  def __init__(self, region, left, top, width, height):
+    self.region = region
+    self.left = left
+    self.top = top
+    self.width = width
+    self.height = height
+    self.data = region.data
+
+  def paste(self, other, sx=0, sy=0, dx=0, dy=0, width=None, height=None, flip_h=False, rotate=0):
+    if width == None: width = other.width - sx
+    if height == None: height = other.height - sy
+    if rotate != 0:
+      dest_width, dest_height = height, width
+    else:
+      dest_width, dest_height = width, height
+    region_dx = dx - self.left
+    region_dy = dy - self.top
+    if (region_dx + dest_width <= 0 or region_dx >= self.region.width or
+        region_dy + dest_height <= 0 or region_dy >= self.region.height):
+      # not in this region
+      return
+    if (region_dx >= 0 and region_dx + dest_width <= self.region.width and
+        region_dy >= 0 and region_dy + dest_height <= self.region.height):
+      self.region.paste(other, sx=sx, sy=sy, dx=region_dx, dy=region_dy, width=width, height=height, flip_h=flip_h, rotate=rotate)
+      return
+    # this straddles the edge of the region. paste it onto a copy of the pixels it covers,
+    # so the blending is the same as it would be on the whole image, then copy back the part we have.
+    first_column = max(0, region_dx)
+    last_column = min(self.region.width, region_dx + dest_width)
+    first_row = max(0, region_dy)
+    last_row = min(self.region.height, region_dy + dest_height)
+    scratch = simplepng.ImageBuffer(dest_width, dest_height)
+    copy_pixels(scratch, self.region, first_column, first_row, first_column - region_dx, first_row - region_dy,
+      last_column - first_column, last_row - first_row)
+    scratch.paste(other, sx=sx, sy=sy, dx=0, dy=0, width=width, height=height, flip_h=flip_h, rotate=rotate)
+    copy_pixels(self.region, scratch, first_column - region_dx, first_row - region_dy, first_column, first_row,
+      last_column - first_column, last_row - first_row)
+
+def build_map_streaming(mapfile, objects_by_map_name, args):
+  """renders the map in bands of tile rows straight into the png, so memory use doesn't depend on the map height."""
+  map_name = mapfile["map_name"]
+  tileset = read_tileset(mapfile["tileset"])
+  layers = get_painted_layers(read_map_layers(mapfile))
+  x_blocks = layers[0].width
+  y_blocks = layers[0].height
+  width = x_blocks * 16
+  height = y_blocks * 16
+  # a layer that's entirely empty isn't drawn at all, not even the grid lines.
+  present = [layer != None and any(layer.data) for layer in layers]
+  # the layers stay in memory for the whole render, so keep them small
+  layers = [None if layer == None else tilelayer.encode_runs(layer) for layer in layers]
+  entities = objects_by_map_name[map_name]
+
+  output = get_file_name_base(mapfile, args) + ".png"
+  with open(output, "wb") as f:
+    if png_mode == "simplepng":
+      writer = pngstream.PngStreamWriter(f, width, height)
+    else:
+      options = get_png_options()
+      # there's no way to know the colors before the whole image is rendered
+      del options["indexed"]
+      writer = pngstream.PngStreamWriter(f, width, height, **options)
+    for band_y in range(0, y_blocks, args.band_rows):
+      band_rows = min(args.band_rows, y_blocks - band_y)
+      top = band_y * 16
+      bands = [None, None, None, None]
+      for i, layer in enumerate(layers):
+        if not present[i]: continue
+        bands[i] = simplepng.ImageBuffer(width, band_rows * 16)
+        paint_with_layer(bands[i], tilelayer.crop(layer, 0, band_y, x_blocks, band_rows), tileset)
+      entity_band = simplepng.ImageBuffer(width, band_rows * 16)
+      band_output = io.StringIO()
+      with contextlib.redirect_stdout(band_output):
+        if render_entities(ImageRegion(entity_band, 0, top, width, height), entities, map_name):
+          bands[2] = entity_band
+      if band_y == 0:
+        # every band says the same thing
+        sys.stdout.write(band_output.getvalue())
+      apply_effects([None if band == None else ImageRegion(band, 0, top, width, height) for band in bands], map_name, args)
+      with renderprofile.stage("composite"):
+        for band in bands[1:]:
+          if band == None: continue
+          bands[0].paste(band)
+      with renderprofile.stage("encode"):
+        writer.write_image_rows(bands[0])
+    with renderprofile.stage("encode"):
+      writer.finish()
+  return [output]
+
+# how --png-mode compresses the finished maps. simplepng is the default, and has no options.
+png_modes = {
+  # for previews
+  "fast": {"level": 1, "filters": pngstream.filter_none, "indexed": False},
+  # tile based maps almost always fit in a palette
+  "small": {"level": 9, "filters": pngstream.filter_adaptive, "indexed": True},
+}
+png_mode = "simplepng"
+png_level = None
+
+def get_png_options():
+  options = dict(png_modes[png_mode])
+  if png_level != None:
+    options["level"] = png_level
+  return options
+
+def write_png(f, image):
+  if png_mode == "simplepng":
+    simplepng.write_png(f, image)
+  else:
+    pngstream.write_png(f, image, **get_png_options())
+
+def configure(args):
+  global src_root, use_numpy, png_cache, png_mode, png_level
+  src_root = args.source
+  png_mode = args.png_mode
+  png_level = args.png_level
+  if not args.no_cache:
+    png_cache = pngcache.PngCache(args.cache_dir, args.cache_size * 1024 * 1024)
+  if args.no_numpy:
+    use_numpy = False
+    imagefilters.use_numpy = False
+  if args.profile:
+    renderprofile.active = renderprofile.Profiler(args.profile_dir, use_cprofile=args.cprofile, trace_memory=args.profile_memory)
+    renderprofile.count_pastes(simplepng.ImageBuffer)
+
+def start_loading(threads):
+  """starts reading the registry and the global tilesets in the background"""
+  global asset_loader
+  asset_loader = assetloader.AssetLoader(threads)
+  asset_loader.load((registry_path, False), open_registry)
+  for filename in global_tileset_paths:
+    asset_loader.load((filename, False), decode_tileset, filename, False)
+
+def preload_map_inputs(mapfile):
+  asset_loader.load((mapfile["tileset"], False), decode_tileset, mapfile["tileset"], False)
+  for layerfile in mapfile["layers"]:
+    if layerfile == None: continue
+    asset_loader.load((layerfile, False), load_layer_file, layerfile)
+
+def stop_loading():
+  global asset_loader
+  if asset_loader != None:
+    asset_loader.close()
+    asset_loader = None
+
+worker_objects_by_map_name = None
+def init_worker(args, objects_by_map_name):
+  global worker_objects_by_map_name
+  configure(args)
+  worker_objects_by_map_name = objects_by_map_name
+  if len(sprites.paths) == 0:
+    # we weren't forked from the parent, so we have to load these ourselves.
+    load_sprites()
+
+def build_map_worker(mapfile, args):
+  global pending_warnings
+  pending_warnings = []
+  output = io.StringIO()
+  result = None
+  error = None
+  with contextlib.redirect_stdout(output):
+    try:
+      result = build_map(mapfile, worker_objects_by_map_name, args)
+    except SystemExit as e:
+      # don't let this kill the worker process. the parent will exit instead.
+      error = e.code
+  map_profile = None
+  if renderprofile.active != None:
+    map_profile = renderprofile.active.maps.get(mapfile["map_name"])
+  return mapfile["map_name"], result, output.getvalue(), pending_warnings, error, map_profile
+
+def build_maps_in_parallel(mapfiles_to_build, objects_by_map_name, args, on_built):
+  # with fork, the workers inherit the registry and sprites that are already loaded.
+  if "fork" in multiprocessing.get_all_start_methods():
+    context = multiprocessing.get_context("fork")
+  else:
+    context = multiprocessing.get_context()
+  jobs = args.jobs or os.cpu_count()
+  with context.Pool(jobs, initializer=init_worker, initargs=(args, objects_by_map_name)) as pool:
+    results = pool.imap_unordered(functools.partial(build_map_worker, args=args), mapfiles_to_build)
+    for map_name, result, output, warnings, error, map_profile in results:
+      sys.stdout.write(output)
+      for key, message in warnings:
+        warn_once(key, message)
+      if map_profile != None:
+        renderprofile.active.maps[map_name] = map_profile
+      sys.stdout.flush()
+      if error != None:
+        pool.terminate()
+        sys.exit(error)
+      on_built(map_name, result)
+
+def parse_numbers(text, count):
+  numbers = [int(number) for number in text.split(",")]
+  if len(numbers) != count:
+    raise ValueError(text)
+  return numbers
 
 def main():
   import argparse
   parser = argparse.ArgumentParser()
   parser.add_argument("map_name", nargs="*")
   parser.add_argument("-s", "--separate", action="store_true")
-  parser.add_argument("-f", "--force", action="store_true")
+  parser.add_argument("-f", "--force", action="store_true", help=
+    "rebuild maps even if none of their inputs have changed since the last build.")
   parser.add_argument("-p", "--physics", action="store_true")
   parser.add_argument("-g", "--grid", action="store_true")
   parser.add_argument("--source", default="Anodyne_1.509")
+  parser.add_argument("-j", "--jobs", type=int, default=1, help=
+    "render this many maps at once in separate processes. 0 means one per cpu.")
+  parser.add_argument("-i", "--incremental", action="store_true", help=
+    "remember the layers each map was rendered from, and next time only repaint the screens whose tiles changed. "+
+    "the whole image still gets encoded again, so on big maps most of the time goes to that. --png-mode fast helps.")
+  parser.add_argument("-t", "--tiles", action="store_true", help=
+    "also cut each map into screen sized tiles with zoomed out levels in maps/tiles/NAME/z/x/y.png.")
+  parser.add_argument("--stream", action="store_true", help=
+    "render and compress each map a band of rows at a time, to use less memory on huge maps.")
+  parser.add_argument("--band-rows", type=int, default=10, help=
+    "how many rows of tiles to render at once with --stream. default: %(default)s")
+  parser.add_argument("--region", metavar="X,Y,W,H", help=
+    "only render this rectangle of each map, in pixels, to maps/NAME_X_Y_WxH.png. only the tiles and entities in it get painted.")
+  parser.add_argument("--screen", metavar="COLUMN,ROW", help=
+    "only render this 160x160 screen of each map. same as --region COLUMN*160,ROW*160,160,160.")
+  parser.add_argument("--changes", metavar="extract_changes.json", help=
+    "only consider rebuilding the maps that use a file in this list of changes from extract_swf.py --incremental. "+
+    "this skips hashing the inputs of every other map, so it assumes nothing else has changed since the last build.")
+  parser.add_argument("--sprite-report", action="store_true", help=
+    "print which sprites each map used, and how many different tiles its layers use.")
+  parser.add_argument("--no-cache", action="store_true", help=
+    "always decode tilesets and sprites from their png files instead of using the decoded pixel cache.")
+  parser.add_argument("--cache-dir", default=".pngcache", help=
+    "where to keep decoded pixels. default: %(default)s")
+  parser.add_argument("--cache-size", type=int, default=512, help=
+    "evict the least recently used decoded pixels when the cache gets bigger than this many MiB. default: %(default)s")
+  parser.add_argument("--no-numpy", action="store_true", help=
+    "don't use numpy to paint tile layers, even if it's installed.")
+  parser.add_argument("--png-mode", choices=["simplepng", "fast", "small"], default="simplepng", help=
+    "how to compress the map images. fast is for previews. small tries every row filter, "+
+    "and makes an indexed color png when there are 256 colors or less. default: %(default)s")
+  parser.add_argument("--png-level", type=int, choices=range(10), metavar="0-9", help=
+    "zlib compression level for --png-mode fast or small. default: 1 for fast, 9 for small")
+  parser.add_argument("--profile", action="store_true", help=
+    "record the time and pastes of each stage of each map, and print a summary at the end.")
+  parser.add_argument("--profile-dir", default="maps/profile", help=
+    "where --profile writes profile.json, and --cprofile writes NAME.prof for each map. default: %(default)s")
+  parser.add_argument("--cprofile", action="store_true", help=
+    "like --profile, but also run each map under cProfile.")
+  parser.add_argument("--profile-memory", action="store_true", help=
+    "like --profile, but also record the peak memory of each stage with tracemalloc. this makes everything several times slower.")
+  parser.add_argument("--load-threads", type=int, default=0, help=
+    "read and decode the registry, tilesets and layers this many at a time in the background, "+
+    "ahead of when they're needed. this helps when the files are slow to read, like on a network drive. "+
+    "png decoding mostly holds the GIL, so it doesn't help much otherwise. default: %(default)s")
   args = parser.parse_args()
+  if args.cprofile or args.profile_memory:
+    args.profile = True
+  if args.jobs < 0:
+    parser.error("--jobs must not be negative")
+  if args.incremental and (args.separate or args.physics):
+    parser.error("--incremental only works for the normal combined map images")
+  if args.stream and (args.separate or args.physics or args.incremental or args.tiles):
+    parser.error("--stream only works for the normal combined map images, and not with --incremental or --tiles")
+  if args.tiles and args.separate:
+    parser.error("--tiles needs the combined map images, so it doesn't work with --separate")
+  if args.band_rows < 1:
+    parser.error("--band-rows must be positive")
+  if args.png_level != None and args.png_mode == "simplepng":
+    parser.error("--png-level needs --png-mode fast or small")
+  if args.region != None and args.screen != None:
+    parser.error("use either --region or --screen, not both")
+  try:
+    if args.region != None:
+      args.region = parse_numbers(args.region, 4)
+    elif args.screen != None:
+      column, row = parse_numbers(args.screen, 2)
+      args.region = [column * 160, row * 160, 160, 160]
+  except ValueError:
+    parser.error("--region looks like 160,320,160,160 and --screen looks like 1,2")
+  if args.region != None:
+    if args.region[2] <= 0 or args.region[3] <= 0:
+      parser.error("the region must have a positive width and height")
+    if args.separate or args.physics or args.incremental or args.stream or args.tiles:
+      parser.error("--region and --screen only work for the normal combined map images")
+  if args.load_threads < 0:
+    parser.error("--load-threads must not be negative")
+  if args.profile:
+    # the stage times wouldn't mean much with loading overlapping everything
+    args.load_threads = 0
 
   valid_map_names = set(mapfile["map_name"] for mapfile in mapfiles)
   for map_name in args.map_name:
     if map_name not in valid_map_names:
       parser.error("unknown map name: {}\nvalid choices: {}".format(map_name, " ".join(valid_map_names)))
 
-  global src_root
-  src_root = args.source
+  configure(args)
+  if args.load_threads > 0:
+    start_loading(args.load_threads)
 
   # read registry XML file that contains entity information
   objects_by_map_name = read_registry()
@@ -1271,59 +2078,61 @@ def main():
   if not os.path.exists("maps"):
     os.makedirs("maps")
 
+  # only rebuild maps whose inputs have changed since the last time
+  cache = buildcache.BuildCache("maps/.buildcache.json")
+  changed_paths = None
+  if args.changes != None:
+    try:
+      changed_paths = read_changes(args.changes)
+    except (OSError, ValueError, KeyError) as e:
+      sys.exit("ERROR: can't read changes from {}: {}".format(args.changes, e))
+  mapfiles_to_build = []
+  inputs_by_map_name = {}
   for mapfile in mapfiles:
     map_name = mapfile["map_name"]
-    file_name_base = "maps/" + map_name
     if len(args.map_name) > 0 and map_name not in args.map_name:
       continue
-    if len(args.map_name) == 0 and not args.separate and not args.force and not args.physics:
-      if os.path.exists(file_name_base + ".png"):
-        print("Skipping: " + map_name)
-        continue
-    print("Processing: " + map_name)
-
-    if args.physics:
-      file_name_base += "_p"
-
-    # build initial map image
-    layers = generate_map_image(mapfile, physics_only=args.physics)
-    # draw the supported entities on the maps
-    entity_layer = simplepng.ImageBuffer(layers[0].width, layers[0].height)
-    if args.physics:
-      render_function = render_physics_entities
-    else:
-      render_function = render_entities
-    if render_function(entity_layer, objects_by_map_name[map_name], map_name):
-      layers[2] = entity_layer
+    if changed_paths != None and not args.force and not is_affected_by_changes(mapfile, args, cache.entries.get(get_cache_key(mapfile, args)), changed_paths):
+      print("Skipping: " + map_name)
+      continue
+    inputs = get_build_inputs(mapfile, objects_by_map_name[map_name], args)
+    if not args.force and cache.is_up_to_date(get_cache_key(mapfile, args), inputs, hash_file):
+      print("Skipping: " + map_name)
+      continue
+    mapfiles_to_build.append(mapfile)
+    inputs_by_map_name[map_name] = inputs
 
-    # apply grayscale effect to SUBURB
-    if map_name == "SUBURB" and not args.physics:
-      for layer in layers:
-        if layer == None: continue
-        for i in range(len(layer.data)):
-          layer.data[i] = grayscale(layer.data[i])
+  mapfiles_by_name = {mapfile["map_name"]: mapfile for mapfile in mapfiles}
+  def on_built(map_name, result):
+    outputs, used_sprite_paths = result
+    if args.incremental:
+      # an incremental build leaves the map image alone when nothing in it changed, but it's still what the map got built into
+      output = get_file_name_base(mapfiles_by_name[map_name], args) + ".png"
+      if output not in outputs:
+        outputs = [output] + outputs
+    sprite_hashes = {path: hash_file(path) for path in used_sprite_paths}
+    cache.update(get_cache_key(mapfiles_by_name[map_name], args), inputs_by_map_name[map_name], outputs, sprite_hashes)
+    cache.save()
 
-    # overlay grid lines
-    if args.grid:
-      for layer in layers:
-        if layer == None: continue
-        for y in range(layer.height // 160):
-          for x in range(layer.width // 160):
-            layer.paste([grid_overlay, grid_overlay_solid][args.physics], dx=x*160, dy=y*160)
+  if args.jobs != 1 and len(mapfiles_to_build) > 1:
+    # the workers load their own maps, and shouldn't be forked while we have threads
+    stop_loading()
+    build_maps_in_parallel(mapfiles_to_build, objects_by_map_name, args, on_built)
+  else:
+    if asset_loader != None:
+      for mapfile in mapfiles_to_build:
+        preload_map_inputs(mapfile)
+    for mapfile in mapfiles_to_build:
+      on_built(mapfile["map_name"], build_map(mapfile, objects_by_map_name, args))
+    stop_loading()
 
-    # save images
-    if args.separate:
-      for i, layer in enumerate(layers):
-        if layer == None: continue
-        with open("{}_{}.png".format(file_name_base, i), "wb") as f:
-          simplepng.write_png(f, layer)
-    else:
-      # add everything to layer[0]
-      for layer in layers[1:]:
-        if layer == None: continue
-        layers[0].paste(layer)
-      with open(file_name_base + ".png", "wb") as f:
-        simplepng.write_png(f, layers[0])
+  if args.tiles and os.path.isdir("maps/tiles"):
+    slippytiles.write_index("maps/tiles")
+
+  if renderprofile.active != None:
+    report_path = renderprofile.active.write_report()
+    print(renderprofile.format_summary(renderprofile.active.get_report()))
+    print("Wrote profile: " + report_path)
 
 if __name__ == "__main__":
   main()
@@ -1,11 +1,176 @@
 #!/usr/bin/env python3
 
 import os
+import sys
+import json
+import hashlib
 import subprocess
 import shutil
 import re
+import concurrent.futures
 
 tmp_dir = ".tmp"
+# ffdec export item type -> the directory it exports into
+export_dirs = {
+  "script": "scripts",
+  "image": "images",
+  "binaryData": "binaryData",
+  "sound": "sounds",
+}
+# what buildmap2 needs. the scripts become the root of the output.
+default_exports = ["script", "image", "binaryData"]
+# exported files that don't have a name to put them under
+unnamed_files = ("154.png", "177.mp3", "158.mp3")
+manifest_name = "extract_manifest.json"
+changes_name = "extract_changes.json"
+
+def run_exports(ffdec, swf, item_types):
+  """runs one ffdec per export item type at the same time.
+  each one exports into tmp_dir/ITEM_TYPE, which only appears once that export has finished."""
+  processes = []
+  if not os.path.isdir(tmp_dir):
+    os.makedirs(tmp_dir)
+  for item_type in item_types:
+    partial_dir = os.path.join(tmp_dir, item_type + ".partial")
+    if os.path.isdir(partial_dir):
+      shutil.rmtree(partial_dir)
+    cmd = [ffdec, "-export", item_type, partial_dir, swf]
+    print(repr(cmd))
+    processes.append((item_type, partial_dir, subprocess.Popen(cmd)))
+  failed = []
+  for item_type, partial_dir, process in processes:
+    if process.wait() != 0:
+      failed.append(item_type)
+      continue
+    os.rename(partial_dir, os.path.join(tmp_dir, item_type))
+  if len(failed) > 0:
+    sys.exit("ERROR: ffdec failed to export: " + ", ".join(failed))
+
+def get_relocated_name(file):
+  prefix_part, name = file.split("_", 1)
+  assert([c for c in prefix_part if c not in "01234596789"] == [])
+  # undo "/" -> "." transformation, but don't replace too many "."s.
+  name, ext = name.rsplit(".", 1)
+  # lowercase letters are package names. uppercase letters are the start of the file name.
+  name_start = re.search("[^.a-z]", name).start()
+  name = name[:name_start].replace(".", "/") + name[name_start:]
+  return name + "." + ext
+
+def get_moves(item_type, output):
+  """returns (source, destination) for every file in an export other than the scripts"""
+  export_dir = os.path.join(tmp_dir, item_type, export_dirs[item_type])
+  if not os.path.isdir(export_dir):
+    # nothing of this type in the swf
+    return []
+  moves = []
+  for file in sorted(os.listdir(export_dir)):
+    if file in unnamed_files: continue
+    moves.append((os.path.join(export_dir, file), os.path.join(output, get_relocated_name(file))))
+  return moves
+
+def relocate(item_types, output):
+  """moves everything exported into place, creating each directory once"""
+  scripts_dir = os.path.join(tmp_dir, "script", export_dirs["script"])
+  if "script" in item_types and os.path.isdir(scripts_dir):
+    os.rename(scripts_dir, output)
+  elif not os.path.isdir(output):
+    os.makedirs(output)
+  moves = []
+  for item_type in item_types:
+    if item_type == "script": continue
+    moves += get_moves(item_type, output)
+  for directory in sorted(set(os.path.dirname(destination) for source, destination in moves)):
+    if not os.path.isdir(directory):
+      os.makedirs(directory)
+  for source, destination in moves:
+    os.replace(source, destination)
+  print("Moved {} files".format(len(moves)))
+
+def hash_file(path):
+  digest = hashlib.sha1()
+  with open(path, "rb") as f:
+    for chunk in iter(lambda: f.read(0x100000), b""):
+      digest.update(chunk)
+  return digest.hexdigest(), os.path.getsize(path)
+
+def list_files(root):
+  """relative paths with / separators of every file under root, except the ones we write about the others"""
+  paths = []
+  for directory, dirnames, filenames in os.walk(root):
+    for filename in filenames:
+      path = os.path.relpath(os.path.join(directory, filename), root).replace(os.sep, "/")
+      if path in (manifest_name, changes_name): continue
+      paths.append(path)
+  return sorted(paths)
+
+def hash_files(root, paths):
+  """returns {path: {"sha1": ..., "size": ...}}. hashlib doesn't hold the GIL, so these go in parallel."""
+  with concurrent.futures.ThreadPoolExecutor() as pool:
+    results = pool.map(hash_file, [os.path.join(root, path) for path in paths])
+    return {path: {"sha1": digest, "size": size} for path, (digest, size) in zip(paths, results)}
+
+def write_json(path, value):
+  tmp_path = path + ".tmp"
+  with open(tmp_path, "w") as f:
+    json.dump(value, f, indent=1, sort_keys=True)
+  os.replace(tmp_path, path)
+
+def write_manifest(swf, item_types, output, files=None):
+  """writes what's in the output directory, so anything downstream can tell what changed without hashing it all again.
+  files is what hash_files() says is in it, if that's already known."""
+  if files == None:
+    files = hash_files(output, list_files(output))
+  swf_digest, swf_size = hash_file(swf)
+  path = os.path.join(output, manifest_name)
+  write_json(path, {
+    "swf": {"sha1": swf_digest, "size": swf_size},
+    "exports": sorted(item_types),
+    "files": files,
+  })
+  print("Wrote manifest of {} files: {}".format(len(files), path))
+
+def read_manifest_files(output):
+  """returns the files from the manifest of the last extraction that finished, or None if there isn't one"""
+  try:
+    with open(os.path.join(output, manifest_name)) as f:
+      return json.load(f)["files"]
+  except (OSError, ValueError, KeyError):
+    return None
+
+def update_incrementally(swf, item_types, staging_dir, output):
+  """moves the files in staging_dir that are different from the ones in output into it,
+  deletes the ones that aren't extracted anymore, and writes the manifest and the list of changes."""
+  new_files = hash_files(staging_dir, list_files(staging_dir))
+  old_files = hash_files(output, list_files(output)) if os.path.isdir(output) else {}
+  # changes are relative to the last extraction that finished, even if an interrupted one already replaced some files.
+  recorded_files = read_manifest_files(output)
+  if recorded_files == None:
+    # without a manifest, we can't tell extracted files from anything else, so nothing gets deleted.
+    print("No manifest in {}, so comparing against everything in it".format(output))
+    recorded_files = {path: old_files[path] for path in old_files if path in new_files}
+  changes = {
+    "added": sorted(path for path in new_files if path not in recorded_files),
+    "changed": sorted(path for path in new_files if path in recorded_files and new_files[path] != recorded_files[path]),
+    "removed": sorted(path for path in recorded_files if path not in new_files),
+  }
+  # the change list goes first, so it's never missing something that's already been swapped in
+  if not os.path.isdir(output):
+    os.makedirs(output)
+  write_json(os.path.join(output, changes_name), changes)
+
+  replaced = [path for path in sorted(new_files) if new_files[path] != old_files.get(path)]
+  for directory in sorted(set(os.path.dirname(os.path.join(output, path)) for path in replaced)):
+    if not os.path.isdir(directory):
+      os.makedirs(directory)
+  for path in replaced:
+    # each file is swapped in whole, so nothing ever sees half of one
+    os.replace(os.path.join(staging_dir, path), os.path.join(output, path))
+  for path in changes["removed"]:
+    if path in old_files:
+      os.remove(os.path.join(output, path))
+  write_manifest(swf, item_types, output, new_files)
+  print("{} added, {} changed, {} removed, {} unchanged".format(
+    len(changes["added"]), len(changes["changed"]), len(changes["removed"]), len(new_files) - len(replaced)))
 
 def main():
   import argparse
@@ -14,40 +179,37 @@ def main():
   parser.add_argument("swf", metavar="Anodyne.swf")
   parser.add_argument("-f", "--force", action="store_true")
   parser.add_argument("-o", "--output", default="Anodyne_1.509")
+  parser.add_argument("--export", nargs="+", choices=sorted(export_dirs), default=default_exports, help=
+    "which kinds of things to export. each one is a separate ffdec run, and they all run at once. default: %(default)s")
+  parser.add_argument("-i", "--incremental", action="store_true", help=
+    "extract into a staging directory, and only replace the files in the output that changed. "+
+    "the changes get listed in OUTPUT/{}, which buildmap2.py --changes can use to only rebuild the maps they affect.".format(changes_name))
   args = parser.parse_args()
+  item_types = sorted(set(args.export))
+  if args.force and args.incremental:
+    parser.error("--force replaces everything, so it doesn't make sense with --incremental")
 
-  if args.force or not os.path.isdir(tmp_dir):
-    if os.path.isdir(tmp_dir):
-      shutil.rmtree(tmp_dir)
-    cmd = [args.ffdec, "-export", "all", tmp_dir, args.swf]
-    print(repr(cmd))
-    subprocess.check_call(cmd)
-
-  if args.force and os.path.exists(args.output):
-    shutil.rmtree(args.output)
+  if args.force:
+    for path in (tmp_dir, args.output):
+      if os.path.exists(path):
+        shutil.rmtree(path)
+  elif os.path.exists(args.output) and not os.path.isdir(tmp_dir) and not args.incremental:
+    sys.exit("ERROR: already extracted to {}. use --force or --incremental to extract again.".format(args.output))
 
-  if args.force or not os.path.exists(args.output):
-    os.rename(os.path.join(tmp_dir, "scripts"), args.output)
-
-  for dir in os.listdir(tmp_dir):
-    if dir in ("sprites", "texts", "frames", "shapes"):
-      shutil.rmtree(os.path.join(tmp_dir, dir))
-      continue
-    for file in os.listdir(os.path.join(tmp_dir, dir)):
-      if file in ("154.png", "177.mp3", "158.mp3"):
-        os.remove(os.path.join(tmp_dir, dir, file))
-        continue
-      prefix_part, name = file.split("_", 1)
-      assert([c for c in prefix_part if c not in "01234596789"] == [])
-      # undo "/" -> "." transformation, but don't replace too many "."s.
-      name, ext = name.rsplit(".", 1)
-      # lowercase letters are package names. uppercase letters are the start of the file name.
-      name_start = re.search("[^.a-z]", name).start()
-      name = name[:name_start].replace(".", "/") + name[name_start:]
-      name = name + "." + ext
-      os.rename(os.path.join(tmp_dir, dir, file), os.path.join(args.output, name))
-    os.rmdir(os.path.join(tmp_dir, dir))
-  os.rmdir(tmp_dir)
+  # exports and moves left over from an earlier run that didn't finish get picked up where they left off
+  run_exports(args.ffdec, args.swf, [item_type for item_type in item_types if not os.path.isdir(os.path.join(tmp_dir, item_type))])
+  if args.incremental:
+    staging_dir = args.output + ".staging"
+    if os.path.exists(staging_dir):
+      shutil.rmtree(staging_dir)
+    relocate(item_types, staging_dir)
+    shutil.rmtree(tmp_dir)
+    update_incrementally(args.swf, item_types, staging_dir, args.output)
+    shutil.rmtree(staging_dir)
+  else:
+    relocate(item_types, args.output)
+    shutil.rmtree(tmp_dir)
+    write_manifest(args.swf, item_types, args.output)
 
 if __name__ == "__main__":
   main()
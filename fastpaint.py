@@ -0,0 +1,86 @@
+"""Optional NumPy versions of the tile painting loops in buildmap2."""
+
+import array
+import renderprofile
+try:
+  import numpy
+except ImportError:
+  numpy = None
+
+def get_pixels(image):
+  return numpy.asarray(image.data, dtype=numpy.uint32).reshape(image.height, image.width)
+
+def set_pixels(image, pixels):
+  pixels = pixels.reshape(-1)
+  if isinstance(image.data, array.array):
+    image.data = array.array(image.data.typecode, pixels.astype(image.data.typecode).tobytes())
+  else:
+    image.data = pixels.tolist()
+
+def get_tiles(tileset):
+  """returns (tiles, mixed), where tiles is a (n_tiles, 16, 16) array in tileset order,
+  and mixed says which tiles have semitransparent pixels."""
+  tiles_x = tileset.width // 16
+  tiles_y = tileset.height // 16
+  pixels = get_pixels(tileset)[:tiles_y*16, :tiles_x*16]
+  tiles = pixels.reshape(tiles_y, 16, tiles_x, 16).swapaxes(1, 2).reshape(-1, 16, 16)
+  alpha = tiles & 0xff
+  # fully transparent pixels never change the destination.
+  tiles = numpy.where(alpha == 0, 0, tiles).astype(numpy.uint32)
+  # anything else has to be alpha blended by ImageBuffer.paste to get identical results.
+  mixed = ((alpha != 0) & (alpha != 0xff)).any(axis=(1, 2))
+  return tiles, mixed
+
+def get_index_grid(layer):
+  return numpy.frombuffer(layer.data, dtype=numpy.uint16).reshape(layer.height, layer.width)
+
+def paint_tile_indexes(image, index_grid, tileset, tiles, mixed, skip=0):
+  """index_grid is a 2d int array of tile indexes. cells equal to skip aren't painted."""
+  y_blocks, x_blocks = index_grid.shape
+  painted = index_grid != skip
+  gather = painted & (index_grid >= 0) & (index_grid < len(tiles))
+  gather[gather] = ~mixed[index_grid[gather]]
+  # one fancy-index gather for the whole layer, then lay the tiles out in rows.
+  layer_pixels = numpy.zeros((y_blocks, x_blocks, 16, 16), dtype=numpy.uint32)
+  layer_pixels[gather] = tiles[index_grid[gather]]
+  gathered = int(gather.sum())
+  renderprofile.count_paste(16*16*gathered, gathered)
+  layer_pixels = layer_pixels.swapaxes(1, 2).reshape(y_blocks * 16, x_blocks * 16)
+
+  pixels = get_pixels(image).copy()
+  region = pixels[:y_blocks*16, :x_blocks*16]
+  region[:] = numpy.where((layer_pixels & 0xff) != 0, layer_pixels, region)
+  set_pixels(image, pixels)
+
+  # semitransparent and out of range tiles go the slow way.
+  tiles_per_row = tileset.width // 16
+  for y, x in zip(*numpy.nonzero(painted & ~gather)):
+    tile_index = int(index_grid[y, x])
+    tile_y = tile_index // tiles_per_row
+    tile_x = tile_index % tiles_per_row
+    image.paste(tileset, sx=tile_x*16, sy=tile_y*16, dx=int(x)*16, dy=int(y)*16, width=16, height=16)
+
+def paint_with_layer(image, layer, tileset):
+  x_blocks = min(image.width // 16, layer.width)
+  y_blocks = min(image.height // 16, layer.height)
+  index_grid = get_index_grid(layer)[:y_blocks, :x_blocks].astype(numpy.int64)
+  if not index_grid.any():
+    return False
+  tiles, mixed = get_tiles(tileset)
+  paint_tile_indexes(image, index_grid, tileset, tiles, mixed)
+  return True
+
+def paint_remapped_layer(image, layer, lookup, tileset):
+  """like paint_with_layer, but tile index i is painted as tile lookup[i] of the tileset, and -1 isn't painted.
+  tile indexes past the end of lookup use its last entry."""
+  x_blocks = min(image.width // 16, layer.width)
+  y_blocks = min(image.height // 16, layer.height)
+  index_grid = get_index_grid(layer)[:y_blocks, :x_blocks].astype(numpy.int64)
+  table = numpy.asarray(lookup, dtype=numpy.int64)
+  # the whole layer in one gather
+  index_grid = table[numpy.minimum(index_grid, len(table) - 1)]
+  if (index_grid == -1).all():
+    return False
+  tiles, mixed = get_tiles(tileset)
+  paint_tile_indexes(image, index_grid, tileset, tiles, mixed, skip=-1)
+  return True
@@ -0,0 +1,106 @@
+"""Whole-image pixel filters, done in bulk instead of calling a Python function per pixel.
+
+Every filter changes image.data in place, so anything else holding the same buffer sees the result."""
+
+import sys
+import array
+try:
+  import numpy
+except ImportError:
+  numpy = None
+
+use_numpy = numpy != None
+
+def grayscale_pixel(v):
+  gray = (
+    ((v >> 24) & 0xff) +
+    ((v >> 16) & 0xff) +
+    ((v >>  8) & 0xff)
+  ) // 3
+  return (
+    (gray << 24) |
+    (gray << 16) |
+    (gray <<  8) |
+    (v & 0xff)
+  )
+
+def get_typecode(data):
+  """the array typecode of image data that's an array, or a memoryview like pngcache gives us, otherwise None"""
+  if isinstance(data, array.array):
+    return data.typecode
+  if isinstance(data, memoryview):
+    return data.format
+  return None
+
+def store_pixels(data, pixels):
+  typecode = get_typecode(data)
+  if typecode != None:
+    data[:] = array.array(typecode, pixels.astype(typecode).tobytes())
+  else:
+    data[:] = pixels.tolist()
+
+def map_pixels(image, function):
+  """replaces every pixel v with function(v), calling it once per distinct color."""
+  data = image.data
+  table = {v: function(v) for v in set(data)}
+  typecode = get_typecode(data)
+  if typecode != None:
+    data[:] = array.array(typecode, map(table.__getitem__, data))
+  else:
+    data[:] = list(map(table.__getitem__, data))
+
+def map_channels(image, red=None, green=None, blue=None, alpha=None):
+  """each channel that isn't None is replaced through its 256 byte lookup table."""
+  data = image.data
+  tables = ((24, red), (16, green), (8, blue), (0, alpha))
+  if use_numpy:
+    pixels = numpy.asarray(data, dtype=numpy.uint32)
+    for shift, table in tables:
+      if table == None: continue
+      lookup = numpy.frombuffer(bytes(table), dtype=numpy.uint8).astype(numpy.uint32)
+      pixels = (pixels & ~numpy.uint32(0xff << shift)) | (lookup[(pixels >> shift) & 0xff] << shift)
+    store_pixels(data, pixels)
+  elif get_typecode(data) != None:
+    # translate each channel's bytes in one go
+    raw = bytearray(data.tobytes())
+    size = data.itemsize
+    for shift, table in tables:
+      if table == None: continue
+      offset = shift // 8
+      if sys.byteorder == "big":
+        offset = size - 1 - offset
+      raw[offset::size] = raw[offset::size].translate(bytes(table))
+    new_data = array.array(get_typecode(data))
+    new_data.frombytes(bytes(raw))
+    data[:] = new_data
+  else:
+    def function(v):
+      for shift, table in tables:
+        if table == None: continue
+        v = (v & ~(0xff << shift)) | (table[(v >> shift) & 0xff] << shift)
+      return v
+    map_pixels(image, function)
+
+def grayscale(image):
+  """averages the red, green and blue of every pixel"""
+  if use_numpy:
+    pixels = numpy.asarray(image.data, dtype=numpy.uint32)
+    gray = (((pixels >> 24) & 0xff) + ((pixels >> 16) & 0xff) + ((pixels >> 8) & 0xff)) // 3
+    store_pixels(image.data, (gray * numpy.uint32(0x01010100)) | (pixels & 0xff))
+  else:
+    # maps are made of tiles, so there aren't many distinct colors
+    map_pixels(image, grayscale_pixel)
+
+fade_table = bytes(a & 0x7f for a in range(256))
+
+def fade(image):
+  """makes the image semitransparent by clearing the msb of the alpha channel"""
+  map_channels(image, alpha=fade_table)
+
+def tint(image, color):
+  """multiplies the red, green and blue of every pixel by those of color, which is 0xRRGGBB"""
+  tables = []
+  for shift in (16, 8, 0):
+    amount = (color >> shift) & 0xff
+    tables.append(bytes(c * amount // 0xff for c in range(256)))
+  map_channels(image, *tables)
@@ -0,0 +1,94 @@
+"""On-disk cache of decoded PNG pixels, so repeat runs don't have to inflate and unfilter them again."""
+
+import os
+import sys
+import mmap
+import array
+import struct
+import hashlib
+sys.path.append(os.path.join(os.path.dirname(__file__), "simplepng.py"))
+import simplepng
+
+# magic, version, width, height
+header_format = "=4sIII"
+header_size = struct.calcsize(header_format)
+magic = b"ANOP"
+version = 1
+entry_extension = ".rgba"
+
+class PngCache:
+  def __init__(self, directory, max_size):
+    self.directory = directory
+    self.max_size = max_size
+
+  def get_entry_path(self, f):
+    source_stat = os.fstat(f.fileno())
+    key = "{}\0{}\0{}".format(os.path.realpath(f.name), source_stat.st_mtime_ns, source_stat.st_size)
+    return os.path.join(self.directory, hashlib.sha1(key.encode("utf8")).hexdigest() + entry_extension)
+
+  def read_png(self, f):
+    entry_path = self.get_entry_path(f)
+    try:
+      image = read_pixels(entry_path)
+      if image != None:
+        # the mtime is how we know what was used least recently
+        os.utime(entry_path)
+        return image
+    except (OSError, ValueError):
+      pass
+    image = simplepng.read_png(f)
+    try:
+      self.store(entry_path, image)
+    except OSError:
+      pass
+    return image
+
+  def store(self, entry_path, image):
+    if not os.path.isdir(self.directory):
+      os.makedirs(self.directory)
+    write_pixels(entry_path, image)
+    self.evict()
+
+  def evict(self):
+    entries = []
+    total_size = 0
+    for name in os.listdir(self.directory):
+      if not name.endswith(entry_extension): continue
+      path = os.path.join(self.directory, name)
+      try:
+        entry_stat = os.stat(path)
+      except OSError:
+        continue
+      entries.append((entry_stat.st_mtime_ns, entry_stat.st_size, path))
+      total_size += entry_stat.st_size
+    # least recently used first
+    entries.sort()
+    for _, size, path in entries:
+      if total_size <= self.max_size: break
+      try:
+        os.remove(path)
+      except OSError:
+        # another process got it first
+        pass
+      total_size -= size
+
+def read_pixels(path):
+  """returns None if the file isn't raw pixels written by write_pixels()"""
+  with open(path, "rb") as f:
+    # copy on write, so callers can modify the pixels without touching the file.
+    contents = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+  if len(contents) < header_size:
+    return None
+  file_magic, file_version, width, height = struct.unpack_from(header_format, contents)
+  if (file_magic, file_version) != (magic, version) or len(contents) != header_size + width * height * 4:
+    return None
+  image = simplepng.ImageBuffer(width, height)
+  image.data = memoryview(contents)[header_size:].cast("I")
+  return image
+
+def write_pixels(path, image):
+  tmp_path = "{}.{}.tmp".format(path, os.getpid())
+  with open(tmp_path, "wb") as f:
+    f.write(struct.pack(header_format, magic, version, image.width, image.height))
+    f.write(array.array("I", image.data).tobytes())
+  os.replace(tmp_path, path)
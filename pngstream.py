@@ -0,0 +1,190 @@
+"""Writes an RGBA png a few rows at a time, so the whole image never has to be in memory."""
+
+import sys
+import zlib
+import array
+import struct
+try:
+  import numpy
+except ImportError:
+  numpy = None
+
+signature = b"\x89PNG\r\n\x1a\n"
+# the compressed stream gets split into IDAT chunks about this big
+idat_size = 0x10000
+
+# how each row gets filtered before compression
+filter_none = "none"
+# try every filter type on each row and keep the one that looks most compressible
+filter_adaptive = "adaptive"
+
+def write_chunk(f, chunk_type, data):
+  f.write(struct.pack(">I", len(data)))
+  f.write(chunk_type)
+  f.write(data)
+  f.write(struct.pack(">I", zlib.crc32(data, zlib.crc32(chunk_type))))
+
+class PngStreamWriter:
+  def __init__(self, f, width, height, level=6, filters=filter_none, palette=None):
+    """palette is a list of at most 256 0xRRGGBBAA colors. if given, the png is indexed color,
+    and every pixel written has to be one of them."""
+    self.f = f
+    self.width = width
+    self.height = height
+    self.filters = filters
+    self.rows_written = 0
+    self.compressor = zlib.compressobj(level)
+    self.pending = bytearray()
+    f.write(signature)
+    if palette == None:
+      self.palette_indexes = None
+      self.bytes_per_pixel = 4
+      # 8 bits per channel, RGBA, no interlacing
+      write_chunk(f, b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 6, 0, 0, 0))
+    else:
+      assert len(palette) <= 256
+      self.palette_indexes = {color: i for i, color in enumerate(palette)}
+      self.bytes_per_pixel = 1
+      # 8 bit palette indexes, no interlacing
+      write_chunk(f, b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 3, 0, 0, 0))
+      write_chunk(f, b"PLTE", b"".join(struct.pack(">I", color)[:3] for color in palette))
+      # alpha for each palette entry. trailing opaque entries can be left out.
+      alphas = bytes(color & 0xff for color in palette).rstrip(b"\xff")
+      if len(alphas) > 0:
+        write_chunk(f, b"tRNS", alphas)
+    self.stride = width * self.bytes_per_pixel
+    # the filters look at the row above, even across calls
+    self.previous_row = bytes(self.stride)
+
+  def write_image_rows(self, image):
+    """appends all the rows of the given image, which must be as wide as the png."""
+    assert image.width == self.width
+    assert self.rows_written + image.height <= self.height
+    if self.palette_indexes != None:
+      raw = bytes(map(self.palette_indexes.__getitem__, image.data))
+    else:
+      pixels = array.array("I", image.data)
+      if sys.byteorder == "little":
+        # 0xRRGGBBAA needs to come out as R, G, B, A
+        pixels.byteswap()
+      raw = pixels.tobytes()
+    stride = self.stride
+    if self.filters == filter_adaptive and image.height > 0:
+      scanlines = filter_rows(raw, stride, self.bytes_per_pixel, self.previous_row)
+      self.previous_row = raw[(image.height - 1) * stride:]
+    else:
+      scanlines = bytearray()
+      for y in range(image.height):
+        # filter type none
+        scanlines.append(0)
+        scanlines += raw[y*stride:(y+1)*stride]
+    self.rows_written += image.height
+    self.pending += self.compressor.compress(bytes(scanlines))
+    self.flush_chunks(idat_size)
+
+  def flush_chunks(self, minimum_size):
+    while len(self.pending) >= max(minimum_size, 1):
+      write_chunk(self.f, b"IDAT", bytes(self.pending[:idat_size]))
+      del self.pending[:idat_size]
+
+  def finish(self):
+    assert self.rows_written == self.height, "only wrote {} of {} rows".format(self.rows_written, self.height)
+    self.pending += self.compressor.flush()
+    self.flush_chunks(0)
+    write_chunk(self.f, b"IEND", b"")
+
+def filter_rows(raw, stride, bytes_per_pixel, previous_row):
+  """returns the scanlines for the given rows, each with whichever filter gives the smallest sum of absolute differences"""
+  if numpy != None:
+    return filter_rows_numpy(raw, stride, bytes_per_pixel, previous_row)
+  scanlines = bytearray()
+  for y in range(len(raw) // stride):
+    row = raw[y*stride:(y+1)*stride]
+    best = None
+    for filter_type in range(5):
+      filtered = filter_row(filter_type, row, previous_row, bytes_per_pixel)
+      score = sum(map(score_table.__getitem__, filtered))
+      if best == None or score < best[0]:
+        best = (score, filter_type, filtered)
+    scanlines.append(best[1])
+    scanlines += best[2]
+    previous_row = row
+  return scanlines
+
+# bytes as signed differences, so -1 is as good as 1
+score_table = [b if b < 128 else 256 - b for b in range(256)]
+
+def filter_row(filter_type, row, previous_row, bytes_per_pixel):
+  if filter_type == 0:
+    return row
+  left = bytes(bytes_per_pixel) + row[:-bytes_per_pixel]
+  if filter_type == 1:
+    # sub
+    return bytes((x - a) & 0xff for x, a in zip(row, left))
+  if filter_type == 2:
+    # up
+    return bytes((x - b) & 0xff for x, b in zip(row, previous_row))
+  if filter_type == 3:
+    # average
+    return bytes((x - ((a + b) >> 1)) & 0xff for x, a, b in zip(row, left, previous_row))
+  # paeth
+  upper_left = bytes(bytes_per_pixel) + previous_row[:-bytes_per_pixel]
+  return bytes((x - paeth_predictor(a, b, c)) & 0xff for x, a, b, c in zip(row, left, previous_row, upper_left))
+
+def paeth_predictor(a, b, c):
+  p = a + b - c
+  pa = abs(p - a)
+  pb = abs(p - b)
+  pc = abs(p - c)
+  if pa <= pb and pa <= pc:
+    return a
+  if pb <= pc:
+    return b
+  return c
+
+def filter_rows_numpy(raw, stride, bytes_per_pixel, previous_row):
+  rows = numpy.frombuffer(raw, dtype=numpy.uint8).reshape(-1, stride).astype(numpy.int16)
+  above = numpy.vstack([numpy.frombuffer(previous_row, dtype=numpy.uint8).astype(numpy.int16)[numpy.newaxis], rows[:-1]])
+  left = numpy.zeros_like(rows)
+  left[:, bytes_per_pixel:] = rows[:, :-bytes_per_pixel]
+  upper_left = numpy.zeros_like(rows)
+  upper_left[:, bytes_per_pixel:] = above[:, :-bytes_per_pixel]
+  p = left + above - upper_left
+  pa = numpy.abs(p - left)
+  pb = numpy.abs(p - above)
+  pc = numpy.abs(p - upper_left)
+  paeth = numpy.where((pa <= pb) & (pa <= pc), left, numpy.where(pb <= pc, above, upper_left))
+  candidates = numpy.stack([
+    rows,
+    rows - left,
+    rows - above,
+    rows - ((left + above) >> 1),
+    rows - paeth,
+  ]).astype(numpy.uint8)
+  scores = numpy.abs(candidates.view(numpy.int8).astype(numpy.int64)).sum(axis=2)
+  # ties go to the lowest filter type, same as the pure python version
+  best = scores.argmin(axis=0)
+  scanlines = numpy.empty((rows.shape[0], stride + 1), dtype=numpy.uint8)
+  scanlines[:, 0] = best
+  scanlines[:, 1:] = candidates[best, numpy.arange(rows.shape[0])]
+  return bytearray(scanlines.tobytes())
+
+def find_palette(image):
+  """returns the image's colors if there are few enough for an indexed png, otherwise None"""
+  colors = set(image.data)
+  if len(colors) > 256:
+    return None
+  # the semitransparent colors go first, so the tRNS chunk can stop before the opaque ones
+  return sorted(colors, key=lambda color: (color & 0xff == 0xff, color))
+
+def write_png(f, image, level=6, filters=filter_none, indexed=False):
+  """writes the whole image. with indexed, it's an indexed color png if it has 256 colors or less."""
+  palette = None
+  if indexed:
+    palette = find_palette(image)
+  if palette != None:
+    # filtering palette indexes rarely helps, because neighboring indexes aren't similar colors
+    filters = filter_none
+  writer = PngStreamWriter(f, image.width, image.height, level=level, filters=filters, palette=palette)
+  writer.write_image_rows(image)
+  writer.finish()
@@ -0,0 +1,130 @@
+"""A compiled per-map index of the entity registry, so we don't have to parse all the XML every run."""
+
+import os
+import struct
+
+# magic, version, source size, source mtime_ns, map count
+header_format = "<4sIQqI"
+header_size = struct.calcsize(header_format)
+# map name, offset, size, entity count
+table_entry_format = "<32sIII"
+table_entry_size = struct.calcsize(table_entry_format)
+# x, y, frame, name length, type length
+record_format = "<iiiHH"
+record_size = struct.calcsize(record_format)
+no_type = 0xffff
+magic = b"ANOR"
+version = 1
+index_extension = ".index"
+
+class RegistryIndex:
+  """acts like the dict of entity lists by map name that the XML parser makes,
+  but only reads a map's entities from disk when they're asked for."""
+  def __init__(self, path):
+    self.path = path
+    self.table = {}
+    self.entities_by_map_name = {}
+    with open(path, "rb") as f:
+      self.source_size, self.source_mtime_ns, map_count = read_header(f)
+      table = f.read(table_entry_size * map_count)
+    for i in range(map_count):
+      name, offset, size, count = struct.unpack_from(table_entry_format, table, i * table_entry_size)
+      self.table[name.rstrip(b"\0").decode("utf8")] = (offset, size, count)
+
+  def __contains__(self, map_name):
+    return map_name in self.table
+
+  def __getitem__(self, map_name):
+    entities = self.entities_by_map_name.get(map_name)
+    if entities == None:
+      entities = self.read_map(map_name)
+      self.entities_by_map_name[map_name] = entities
+    return entities
+
+  def keys(self):
+    return self.table.keys()
+
+  def read_map(self, map_name):
+    if map_name not in self.table:
+      return []
+    offset, size, count = self.table[map_name]
+    with open(self.path, "rb") as f:
+      f.seek(offset)
+      data = f.read(size)
+    return decode_entities(data, count)
+
+def read_header(f):
+  file_magic, file_version, source_size, source_mtime_ns, map_count = struct.unpack(header_format, f.read(header_size))
+  if (file_magic, file_version) != (magic, version):
+    raise ValueError("not a registry index")
+  return source_size, source_mtime_ns, map_count
+
+def encode_entities(entities):
+  chunks = []
+  for entity in entities:
+    name = entity["name"].encode("utf8")
+    if entity["type"] == None:
+      entity_type = b""
+      type_length = no_type
+    else:
+      entity_type = entity["type"].encode("utf8")
+      type_length = len(entity_type)
+    chunks.append(struct.pack(record_format, entity["x"], entity["y"], entity["frame"], len(name), type_length))
+    chunks.append(name)
+    chunks.append(entity_type)
+  return b"".join(chunks)
+
+def decode_entities(data, count):
+  entities = []
+  offset = 0
+  for _ in range(count):
+    x, y, frame, name_length, type_length = struct.unpack_from(record_format, data, offset)
+    offset += record_size
+    name = data[offset:offset+name_length].decode("utf8")
+    offset += name_length
+    if type_length == no_type:
+      entity_type = None
+    else:
+      entity_type = data[offset:offset+type_length].decode("utf8")
+      offset += type_length
+    entities.append({
+      "name": name,
+      "x": x,
+      "y": y,
+      "frame": frame,
+      "type": entity_type,
+    })
+  return entities
+
+def write_index(path, source_stat, objects_by_map_name):
+  map_names = sorted(objects_by_map_name.keys())
+  blobs = [encode_entities(objects_by_map_name[map_name]) for map_name in map_names]
+  offset = header_size + table_entry_size * len(map_names)
+  tmp_path = "{}.{}.tmp".format(path, os.getpid())
+  with open(tmp_path, "wb") as f:
+    f.write(struct.pack(header_format, magic, version, source_stat.st_size, source_stat.st_mtime_ns, len(map_names)))
+    for map_name, blob in zip(map_names, blobs):
+      encoded_name = map_name.encode("utf8")
+      assert len(encoded_name) <= 32, map_name
+      f.write(struct.pack(table_entry_format, encoded_name, offset, len(blob), len(objects_by_map_name[map_name])))
+      offset += len(blob)
+    for blob in blobs:
+      f.write(blob)
+  os.replace(tmp_path, path)
+
+def load_registry(f, parse):
+  """f is the open registry XML file. parse(f) is only called if the index is missing or out of date."""
+  source_stat = os.fstat(f.fileno())
+  index_path = f.name + index_extension
+  try:
+    index = RegistryIndex(index_path)
+    if (index.source_size, index.source_mtime_ns) == (source_stat.st_size, source_stat.st_mtime_ns):
+      return index
+  except (OSError, ValueError, struct.error):
+    pass
+  objects_by_map_name = parse(f)
+  try:
+    write_index(index_path, source_stat, objects_by_map_name)
+  except OSError:
+    return objects_by_map_name
+  return RegistryIndex(index_path)
@@ -0,0 +1,209 @@
+"""Where the time goes in a buildmap2 run: wall time, pastes and, if asked for, memory for each stage of each map."""
+
+import os
+import json
+import time
+import functools
+import cProfile
+import contextlib
+import tracemalloc
+try:
+  import resource
+except ImportError:
+  # not on windows
+  resource = None
+
+# the order stages are listed in the summary. anything else goes after these.
+stage_order = ["registry", "decode", "layers", "paint", "entities", "effects", "composite", "encode", "tiles", "incremental"]
+
+# the Profiler for this process, or None when not profiling
+active = None
+
+def new_stats():
+  return {"seconds": 0.0, "calls": 0, "pastes": 0, "pixels": 0, "peak_bytes": 0}
+
+class Profiler:
+  def __init__(self, directory, use_cprofile=False, trace_memory=False):
+    self.directory = directory
+    self.use_cprofile = use_cprofile
+    # tracemalloc slows everything down a lot, so the peaks are only recorded when asked for
+    self.trace_memory = trace_memory
+    # stage name -> stats for everything outside of a map, like parsing the registry
+    self.startup = {}
+    # map name -> {"total": stats, "stages": {stage name -> stats}}
+    self.maps = {}
+    self.stages = self.startup
+    # [stats, start time, time spent in nested stages, peak bytes so far]
+    self.stack = []
+    if trace_memory:
+      tracemalloc.start()
+
+  def push(self, stats):
+    if self.trace_memory:
+      if len(self.stack) > 0:
+        # the parent's peak so far has to survive the reset
+        self.stack[-1][3] = max(self.stack[-1][3], tracemalloc.get_traced_memory()[1])
+      tracemalloc.reset_peak()
+    self.stack.append([stats, time.perf_counter(), 0.0, 0])
+
+  def pop(self):
+    stats, start, nested_seconds, peak = self.stack.pop()
+    elapsed = time.perf_counter() - start
+    if self.trace_memory:
+      peak = max(peak, tracemalloc.get_traced_memory()[1])
+      tracemalloc.reset_peak()
+    # a stage's time doesn't include the stages nested inside it
+    stats["seconds"] += elapsed - nested_seconds
+    stats["calls"] += 1
+    stats["peak_bytes"] = max(stats["peak_bytes"], peak)
+    if len(self.stack) > 0:
+      self.stack[-1][2] += elapsed
+      self.stack[-1][3] = max(self.stack[-1][3], peak)
+
+  @contextlib.contextmanager
+  def stage(self, name):
+    stats = self.stages.get(name)
+    if stats == None:
+      stats = self.stages[name] = new_stats()
+    self.push(stats)
+    try:
+      yield
+    finally:
+      self.pop()
+
+  @contextlib.contextmanager
+  def map_scope(self, map_name):
+    total = new_stats()
+    self.stages = {}
+    self.maps[map_name] = {"total": total, "stages": self.stages}
+    profile = None
+    if self.use_cprofile:
+      profile = cProfile.Profile()
+      profile.enable()
+    # the total is a stage too, so it gets the time and peak of everything nested in it
+    self.push(total)
+    try:
+      yield
+    finally:
+      self.pop()
+      # pop() only counted the time outside of the nested stages
+      total["seconds"] += sum(stats["seconds"] for stats in self.stages.values())
+      for stats in self.stages.values():
+        total["pastes"] += stats["pastes"]
+        total["pixels"] += stats["pixels"]
+      if profile != None:
+        profile.disable()
+        make_directory(self.directory)
+        profile.dump_stats(os.path.join(self.directory, map_name + ".prof"))
+      self.stages = self.startup
+
+  def count_paste(self, pixels, pastes=1):
+    if len(self.stack) == 0: return
+    stats = self.stack[-1][0]
+    stats["pastes"] += pastes
+    stats["pixels"] += pixels
+
+  def get_report(self):
+    report = {
+      "startup": self.startup,
+      "maps": self.maps,
+      "traced_memory": self.trace_memory,
+    }
+    if resource != None:
+      # the biggest process, including anything tracemalloc can't see.
+      # worker processes only count once they've exited.
+      report["max_rss_kib"] = max(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+      )
+    return report
+
+  def write_report(self):
+    make_directory(self.directory)
+    path = os.path.join(self.directory, "profile.json")
+    with open(path, "w") as f:
+      json.dump(self.get_report(), f, indent=1, sort_keys=True)
+    return path
+
+def make_directory(directory):
+  if not os.path.isdir(directory):
+    os.makedirs(directory)
+
+def stage(name):
+  """with stage(name): times the block as part of the given stage, if we're profiling."""
+  if active == None:
+    return contextlib.nullcontext()
+  return active.stage(name)
+
+def timed(name):
+  """decorates a function so every call to it is part of the given stage"""
+  def decorate(function):
+    @functools.wraps(function)
+    def timed_function(*args, **kwargs):
+      if active == None:
+        return function(*args, **kwargs)
+      with active.stage(name):
+        return function(*args, **kwargs)
+    return timed_function
+  return decorate
+
+def map_scope(map_name):
+  if active == None:
+    return contextlib.nullcontext()
+  return active.map_scope(map_name)
+
+def count_paste(pixels, pastes=1):
+  """counts pixels copied without ImageBuffer.paste(), like whole tile rows at a time, toward the current stage"""
+  if active != None:
+    active.count_paste(pixels, pastes)
+
+def count_pastes(image_class):
+  """makes every image_class.paste() count toward the current stage."""
+  paste = image_class.paste
+  if getattr(paste, "counts_pastes", False): return
+  def counting_paste(self, other, sx=0, sy=0, dx=0, dy=0, width=None, height=None, flip_h=False, rotate=0):
+    if active != None:
+      paste_width = other.width - sx if width == None else width
+      paste_height = other.height - sy if height == None else height
+      active.count_paste(paste_width * paste_height)
+    return paste(self, other, sx=sx, sy=sy, dx=dx, dy=dy, width=width, height=height, flip_h=flip_h, rotate=rotate)
+  counting_paste.counts_pastes = True
+  image_class.paste = counting_paste
+
+def sorted_stage_names(stage_names):
+  return sorted(stage_names, key=lambda name: (stage_order.index(name) if name in stage_order else len(stage_order), name))
+
+def format_summary(report):
+  """a table of seconds per stage for each map, plus the totals"""
+  stage_names = set(report["startup"])
+  for map_report in report["maps"].values():
+    stage_names.update(map_report["stages"])
+  stage_names = sorted_stage_names(stage_names)
+  header = ["map"] + stage_names + ["total", "pastes", "Mpixels", "peak MiB"]
+  rows = []
+  if len(report["startup"]) > 0:
+    rows.append(["(startup)"] + [
+      format_seconds(report["startup"].get(name)) for name in stage_names
+    ] + ["", "", "", ""])
+  for map_name, map_report in sorted(report["maps"].items()):
+    total = map_report["total"]
+    rows.append([map_name] + [
+      format_seconds(map_report["stages"].get(name)) for name in stage_names
+    ] + [
+      "{:.3f}".format(total["seconds"]),
+      str(total["pastes"]),
+      "{:.1f}".format(total["pixels"] / 1e6),
+      "{:.1f}".format(total["peak_bytes"] / (1024 * 1024)) if report["traced_memory"] else "-",
+    ])
+  widths = [max(len(row[i]) for row in [header] + rows) for i in range(len(header))]
+  lines = []
+  for row in [header] + rows:
+    lines.append("  ".join([row[0].ljust(widths[0])] + [cell.rjust(width) for cell, width in zip(row[1:], widths[1:])]))
+  if "max_rss_kib" in report:
+    lines.append("max rss: {:.1f} MiB".format(report["max_rss_kib"] / 1024))
+  return "\n".join(lines)
+
+def format_seconds(stats):
+  if stats == None:
+    return "-"
+  return "{:.3f}".format(stats["seconds"])
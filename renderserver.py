@@ -0,0 +1,249 @@
+#!/usr/bin/env python3
+
+"""Serves buildmap2 renders over HTTP, keeping the registry, sprites, tilesets and layers loaded between requests.
+
+GET /map/NAME.png?physics=1&grid=1 renders a combined map image, and GET /maps lists the map names.
+Add region=X,Y,W,H or screen=COLUMN,ROW to render only part of the map, like buildmap2.py --region and --screen.
+Inputs that change on disk are reloaded on the next request, and only the renders that used them are thrown out."""
+
+import os
+import io
+import sys
+import json
+import argparse
+import collections
+import socketserver
+import urllib.parse
+import http.server
+import buildmap2
+
+class RenderedMap:
+  def __init__(self, png, inputs):
+    self.png = png
+    # filename -> stat key, for every file the render read
+    self.inputs = inputs
+
+class RenderServerState:
+  def __init__(self, max_size):
+    # (map name, physics, grid, region) -> RenderedMap, least recently used first
+    self.rendered = collections.OrderedDict()
+    self.rendered_size = 0
+    self.max_size = max_size
+    # filename -> stat key, for everything we've read
+    self.stat_keys = {}
+    self.mapfiles_by_name = {mapfile["map_name"]: mapfile for mapfile in buildmap2.mapfiles}
+    buildmap2.loaded_inputs = {}
+    self.objects_by_map_name = buildmap2.read_registry()
+    buildmap2.load_sprites()
+    self.watch(buildmap2.registry_path)
+
+  def watch(self, filename):
+    if filename not in self.stat_keys:
+      self.stat_keys[filename] = get_stat_key(filename)
+    return self.stat_keys[filename]
+
+  def reload_changed_inputs(self):
+    """forgets everything that came from a file that's different now"""
+    changed = set(filename for filename, stat_key in self.stat_keys.items() if get_stat_key(filename) != stat_key)
+    if len(changed) == 0: return
+    for filename in sorted(changed):
+      print("Changed: " + filename)
+      del self.stat_keys[filename]
+    for key in list(buildmap2.loaded_inputs):
+      if key[0] in changed:
+        del buildmap2.loaded_inputs[key]
+    for sprite_name, (path, fade) in buildmap2.sprites.paths.items():
+      if path in changed:
+        image = buildmap2.sprites.images.pop(sprite_name, None)
+        if image != None:
+          # otherwise the atlas would keep the old image and its frames around for good
+          buildmap2.sprite_frames.forget(image)
+    if not changed.isdisjoint(buildmap2.global_tileset_paths):
+      buildmap2.sprite_frames.clear()
+      buildmap2.load_sprites()
+    if buildmap2.registry_path in changed:
+      self.objects_by_map_name = buildmap2.read_registry()
+      self.watch(buildmap2.registry_path)
+    for key, rendered_map in list(self.rendered.items()):
+      if not changed.isdisjoint(rendered_map.inputs):
+        self.forget(key)
+
+  def forget(self, key):
+    self.rendered_size -= len(self.rendered.pop(key).png)
+
+  def get_map_png(self, map_name, physics, grid, region=None):
+    """region is None for the whole map, or x, y, width, height. returns (png, whether it was cached).
+    the png is None if the region is outside of the map."""
+    key = (map_name, physics, grid, region)
+    rendered_map = self.rendered.get(key)
+    if rendered_map != None:
+      self.rendered.move_to_end(key)
+      return rendered_map.png, True
+    rendered_map = self.render(self.mapfiles_by_name[map_name], physics, grid, region)
+    if rendered_map == None:
+      return None, False
+    self.rendered[key] = rendered_map
+    self.rendered_size += len(rendered_map.png)
+    while self.rendered_size > self.max_size and len(self.rendered) > 1:
+      self.forget(next(iter(self.rendered)))
+    return rendered_map.png, False
+
+  def render(self, mapfile, physics, grid, region):
+    args = argparse.Namespace(physics=physics, grid=grid)
+    print("Processing: " + mapfile["map_name"])
+    buildmap2.sprites.used.clear()
+    if region != None:
+      image = buildmap2.render_region(mapfile, self.objects_by_map_name, args, *region)
+      if image == None:
+        return None
+    else:
+      image = buildmap2.composite_layers(buildmap2.render_layers(mapfile, self.objects_by_map_name, args))
+    with io.BytesIO() as f:
+      buildmap2.write_png(f, image)
+      png = f.getvalue()
+    filenames = [buildmap2.registry_path] + buildmap2.get_input_filenames(mapfile, args) + buildmap2.sprites.used_paths()
+    return RenderedMap(png, {filename: self.watch(filename) for filename in filenames})
+
+def get_stat_key(filename):
+  path = buildmap2.find_file(filename)
+  if path == None:
+    return None
+  stat = os.stat(path)
+  return (path, stat.st_mtime_ns, stat.st_size)
+
+def parse_flag(query, name):
+  value = query.get(name, ["0"])[-1]
+  if value not in ("0", "1"):
+    raise ValueError("{} must be 0 or 1".format(name))
+  return value == "1"
+
+def parse_region(query):
+  if "region" in query and "screen" in query:
+    raise ValueError("use either region or screen, not both")
+  if "region" in query:
+    region = buildmap2.parse_numbers(query["region"][-1], 4)
+    if region[2] <= 0 or region[3] <= 0:
+      raise ValueError("the region must have a positive width and height")
+    return tuple(region)
+  if "screen" in query:
+    column, row = buildmap2.parse_numbers(query["screen"][-1], 2)
+    return (column * 160, row * 160, 160, 160)
+  return None
+
+class RenderRequestHandler(http.server.BaseHTTPRequestHandler):
+  def do_GET(self):
+    url = urllib.parse.urlsplit(self.path)
+    state = self.server.state
+    if url.path == "/maps":
+      self.send_body(200, "application/json", json.dumps(sorted(state.mapfiles_by_name)).encode("utf8"))
+      return
+    if not (url.path.startswith("/map/") and url.path.endswith(".png")):
+      self.send_error(404)
+      return
+    map_name = url.path[len("/map/"):-len(".png")]
+    if map_name not in state.mapfiles_by_name:
+      self.send_error(404, "unknown map name: " + map_name)
+      return
+    try:
+      query = urllib.parse.parse_qs(url.query)
+      physics = parse_flag(query, "physics")
+      grid = parse_flag(query, "grid")
+      region = parse_region(query)
+      if region != None and physics:
+        raise ValueError("region and screen only work for the normal map images")
+    except ValueError as e:
+      self.send_error(400, str(e))
+      return
+    try:
+      state.reload_changed_inputs()
+      png, cached = state.get_map_png(map_name, physics, grid, region)
+    except SystemExit as e:
+      # the renderer gives up with sys.exit(), which shouldn't take the server with it
+      self.send_error(500, str(e.code))
+      return
+    sys.stdout.flush()
+    if png == None:
+      self.send_error(404, "the region is outside of the map")
+      return
+    self.send_body(200, "image/png", png, {"X-Render-Cache": ["miss", "hit"][cached]})
+
+  def send_body(self, status, content_type, body, headers={}):
+    self.send_response(status)
+    self.send_header("Content-Type", content_type)
+    self.send_header("Content-Length", str(len(body)))
+    for name, value in headers.items():
+      self.send_header(name, value)
+    self.end_headers()
+    self.wfile.write(body)
+
+  def address_string(self):
+    if isinstance(self.client_address, str):
+      # unix sockets don't have a client address
+      return "unix"
+    return super().address_string()
+
+class UnixHTTPServer(socketserver.UnixStreamServer):
+  def server_bind(self):
+    if os.path.exists(self.server_address):
+      # left over from a server that didn't shut down cleanly
+      os.unlink(self.server_address)
+    super().server_bind()
+
+def parse_address(text):
+  host, _, port = text.rpartition(":")
+  return host or "127.0.0.1", int(port)
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--listen", default="127.0.0.1:8000", help=
+    "[HOST:]PORT to serve HTTP on. default: %(default)s")
+  parser.add_argument("--socket", help=
+    "serve HTTP on this unix socket instead.")
+  parser.add_argument("--source", default="Anodyne_1.509")
+  parser.add_argument("--max-cache-size", type=int, default=256, help=
+    "keep this many MiB of rendered pngs, dropping the least recently used. default: %(default)s")
+  parser.add_argument("--no-cache", action="store_true", help=
+    "always decode tilesets and sprites from their png files instead of using the decoded pixel cache.")
+  parser.add_argument("--cache-dir", default=".pngcache", help=
+    "where to keep decoded pixels. default: %(default)s")
+  parser.add_argument("--cache-size", type=int, default=512, help=
+    "evict the least recently used decoded pixels when the cache gets bigger than this many MiB. default: %(default)s")
+  parser.add_argument("--no-numpy", action="store_true", help=
+    "don't use numpy to paint tile layers, even if it's installed.")
+  parser.add_argument("--png-mode", choices=["simplepng", "fast", "small"], default="simplepng", help=
+    "how to compress the map images. see buildmap2.py --help. default: %(default)s")
+  parser.add_argument("--png-level", type=int, choices=range(10), metavar="0-9", help=
+    "zlib compression level for --png-mode fast or small.")
+  args = parser.parse_args()
+  try:
+    address = parse_address(args.listen)
+  except ValueError:
+    parser.error("--listen looks like 127.0.0.1:8000 or 8000")
+  if args.max_cache_size < 0:
+    parser.error("--max-cache-size must not be negative")
+  if args.png_level != None and args.png_mode == "simplepng":
+    parser.error("--png-level needs --png-mode fast or small")
+  args.profile = False
+
+  buildmap2.configure(args)
+  state = RenderServerState(args.max_cache_size * 1024 * 1024)
+  # these handle one request at a time, because rendering uses buildmap2's globals
+  if args.socket != None:
+    server = UnixHTTPServer(args.socket, RenderRequestHandler)
+    print("Serving on: " + args.socket)
+  else:
+    server = http.server.HTTPServer(address, RenderRequestHandler)
+    print("Serving on: http://{}:{}/".format(*address))
+  server.state = state
+  sys.stdout.flush()
+  try:
+    server.serve_forever()
+  except KeyboardInterrupt:
+    pass
+  finally:
+    server.server_close()
+    if args.socket != None and os.path.exists(args.socket):
+      os.unlink(args.socket)
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,154 @@
+"""Cuts a map image into screen-sized tiles with a pyramid of zoomed out levels, for slippy map viewers."""
+
+import os
+import json
+import array
+import hashlib
+import pngstream
+
+# one screen of the game
+tile_size = 160
+
+class TileImage:
+  def __init__(self, width, height, data=None):
+    self.width = width
+    self.height = height
+    if data == None:
+      data = array.array("I", bytes(width * height * 4))
+    self.data = data
+
+def cut_tiles(image):
+  """returns {(x, y): TileImage} for every screen of the image. edge tiles are padded with transparency."""
+  tiles = {}
+  for tile_y in range((image.height + tile_size - 1) // tile_size):
+    for tile_x in range((image.width + tile_size - 1) // tile_size):
+      tile = TileImage(tile_size, tile_size)
+      width = min(tile_size, image.width - tile_x * tile_size)
+      height = min(tile_size, image.height - tile_y * tile_size)
+      for y in range(height):
+        start = (tile_y * tile_size + y) * image.width + tile_x * tile_size
+        tile.data[y*tile_size:y*tile_size+width] = array.array("I", image.data[start:start+width])
+      tiles[(tile_x, tile_y)] = tile
+  return tiles
+
+def average_pixels(pixels):
+  # weight the colors by alpha so transparent pixels don't darken the edges
+  total_alpha = 0
+  red = green = blue = 0
+  for pixel in pixels:
+    alpha = pixel & 0xff
+    total_alpha += alpha
+    red += ((pixel >> 24) & 0xff) * alpha
+    green += ((pixel >> 16) & 0xff) * alpha
+    blue += ((pixel >> 8) & 0xff) * alpha
+  if total_alpha == 0:
+    return 0
+  return (
+    ((red // total_alpha) << 24) |
+    ((green // total_alpha) << 16) |
+    ((blue // total_alpha) << 8) |
+    (total_alpha // len(pixels))
+  )
+
+def merge_children(children):
+  """children is [top_left, top_right, bottom_left, bottom_right], any of which can be None.
+  returns one tile with each child shrunk into its quadrant."""
+  tile = TileImage(tile_size, tile_size)
+  half = tile_size // 2
+  for quadrant, child in enumerate(children):
+    if child == None: continue
+    offset_x = (quadrant % 2) * half
+    offset_y = (quadrant // 2) * half
+    data = child.data
+    for y in range(half):
+      row = (y * 2) * tile_size
+      next_row = row + tile_size
+      dest = (offset_y + y) * tile_size + offset_x
+      for x in range(half):
+        tile.data[dest + x] = average_pixels((
+          data[row + x*2], data[row + x*2 + 1],
+          data[next_row + x*2], data[next_row + x*2 + 1],
+        ))
+  return tile
+
+def build_pyramid(image):
+  """returns (max_zoom, levels), where levels[z] is {(x, y): TileImage}.
+  max_zoom is the full resolution, and zoom 0 fits the whole map in one tile."""
+  screens = max((image.width + tile_size - 1) // tile_size, (image.height + tile_size - 1) // tile_size, 1)
+  max_zoom = 0
+  while (1 << max_zoom) < screens:
+    max_zoom += 1
+  levels = {max_zoom: cut_tiles(image)}
+  for zoom in range(max_zoom - 1, -1, -1):
+    # each level is made from the one below it, not from the original image.
+    below = levels[zoom + 1]
+    level = {}
+    for x, y in sorted(set((child_x // 2, child_y // 2) for child_x, child_y in below)):
+      level[(x, y)] = merge_children([
+        below.get((x*2, y*2)), below.get((x*2 + 1, y*2)),
+        below.get((x*2, y*2 + 1)), below.get((x*2 + 1, y*2 + 1)),
+      ])
+    levels[zoom] = level
+  return max_zoom, levels
+
+def write_tiles(image, directory):
+  """writes directory/z/x/y.png and directory/manifest.json. tiles whose pixels haven't changed aren't rewritten.
+  returns (tiles written, tiles skipped)."""
+  manifest_path = os.path.join(directory, "manifest.json")
+  try:
+    with open(manifest_path, "r") as f:
+      old_hashes = json.load(f)["tiles"]
+  except (OSError, ValueError, KeyError):
+    old_hashes = {}
+
+  max_zoom, levels = build_pyramid(image)
+  hashes = {}
+  written = 0
+  skipped = 0
+  for zoom, level in sorted(levels.items()):
+    for (x, y), tile in sorted(level.items()):
+      key = "{}/{}/{}".format(zoom, x, y)
+      digest = hashlib.sha1(tile.data.tobytes()).hexdigest()
+      hashes[key] = digest
+      path = os.path.join(directory, str(zoom), str(x), "{}.png".format(y))
+      if old_hashes.get(key) == digest and os.path.exists(path):
+        skipped += 1
+        continue
+      if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+      with open(path, "wb") as f:
+        writer = pngstream.PngStreamWriter(f, tile.width, tile.height)
+        writer.write_image_rows(tile)
+        writer.finish()
+      written += 1
+
+  # tiles that don't exist anymore, like if the map got smaller
+  for key in old_hashes:
+    if key in hashes: continue
+    try:
+      os.remove(os.path.join(directory, key + ".png"))
+    except OSError:
+      pass
+
+  with open(manifest_path, "w") as f:
+    json.dump({
+      "width": image.width,
+      "height": image.height,
+      "tile_size": tile_size,
+      "max_zoom": max_zoom,
+      "tiles": hashes,
+    }, f, indent=1, sort_keys=True)
+  return written, skipped
+
+def write_index(directory):
+  """lists every tiled map in directory/index.json, so a viewer can find them all in one place."""
+  maps = {}
+  for name in sorted(os.listdir(directory)):
+    try:
+      with open(os.path.join(directory, name, "manifest.json"), "r") as f:
+        manifest = json.load(f)
+    except (OSError, ValueError):
+      continue
+    maps[name] = {key: manifest[key] for key in ("width", "height", "tile_size", "max_zoom")}
+  with open(os.path.join(directory, "index.json"), "w") as f:
+    json.dump(maps, f, indent=1, sort_keys=True)
@@ -0,0 +1,106 @@
+"""A spatial hash over registry entities, for finding entities by position without scanning them all."""
+
+from collections import defaultdict
+
+class SpatialHash:
+  def __init__(self, entities=(), cell_size=16):
+    self.cell_size = cell_size
+    # exact position -> entities there, in the order they were added
+    self.by_point = defaultdict(list)
+    # cell -> entities whose position is in it
+    self.by_cell = defaultdict(list)
+    self.ids = set()
+    for entity in entities:
+      self.add(entity)
+
+  def __len__(self):
+    return len(self.ids)
+
+  def __contains__(self, entity):
+    return id(entity) in self.ids
+
+  def get_cell(self, x, y):
+    return (x // self.cell_size, y // self.cell_size)
+
+  def add(self, entity):
+    x = entity["x"]
+    y = entity["y"]
+    self.by_point[(x, y)].append(entity)
+    self.by_cell[self.get_cell(x, y)].append(entity)
+    self.ids.add(id(entity))
+
+  def remove(self, entity):
+    x = entity["x"]
+    y = entity["y"]
+    remove_by_identity(self.by_point, (x, y), entity)
+    remove_by_identity(self.by_cell, self.get_cell(x, y), entity)
+    self.ids.discard(id(entity))
+
+  def at(self, x, y):
+    """entities at exactly this position"""
+    return list(self.by_point.get((x, y), ()))
+
+  def remove_at(self, x, y):
+    """removes and returns the first entity added at exactly this position, or None."""
+    entities = self.by_point.get((x, y))
+    if not entities:
+      return None
+    entity = entities[0]
+    self.remove(entity)
+    return entity
+
+  def in_rect(self, x, y, width, height):
+    """entities whose position is inside the rectangle"""
+    found = []
+    min_cell_x, min_cell_y = self.get_cell(x, y)
+    max_cell_x, max_cell_y = self.get_cell(x + width - 1, y + height - 1)
+    for cell_y in range(min_cell_y, max_cell_y + 1):
+      for cell_x in range(min_cell_x, max_cell_x + 1):
+        for entity in self.by_cell.get((cell_x, cell_y), ()):
+          if x <= entity["x"] < x + width and y <= entity["y"] < y + height:
+            found.append(entity)
+    return found
+
+def remove_by_identity(buckets, key, entity):
+  bucket = buckets[key]
+  for i, other in enumerate(bucket):
+    if other is entity:
+      del bucket[i]
+      break
+  if len(bucket) == 0:
+    del buckets[key]
+
+def benchmark(count=20000):
+  """compares finding the Dust under each Propelled with a linear scan vs the spatial hash."""
+  import time
+  import random
+  rng = random.Random(0)
+  positions = [(rng.randrange(4000) * 16, rng.randrange(4000) * 16) for _ in range(count)]
+  platforms = [{"name": "Propelled", "x": x, "y": y} for x, y in positions]
+
+  def make_dust():
+    # half the platforms have dust on them
+    return [{"name": "Dust", "x": x, "y": y} for x, y in positions[::2]]
+
+  dust_entities = make_dust()
+  start = time.perf_counter()
+  for platform in platforms:
+    for i, dust in enumerate(dust_entities):
+      if dust["x"] == platform["x"] and dust["y"] == platform["y"]:
+        del dust_entities[i]
+        break
+  linear_time = time.perf_counter() - start
+
+  start = time.perf_counter()
+  dust_index = SpatialHash(make_dust())
+  for platform in platforms:
+    dust_index.remove_at(platform["x"], platform["y"])
+  hash_time = time.perf_counter() - start
+
+  assert len(dust_entities) == len(dust_index) == 0
+  print("{} platforms, {} dust".format(count, len(positions[::2])))
+  print("linear scan:  {:.3f}s".format(linear_time))
+  print("spatial hash: {:.3f}s".format(hash_time))
+
+if __name__ == "__main__":
+  benchmark()
@@ -0,0 +1,146 @@
+"""Sprite frames cut out and transformed once, so every later paste of them is a plain copy of their opaque pixels."""
+
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(__file__), "simplepng.py"))
+import simplepng
+import renderprofile
+
+# what pasting a frame has to do, like tilestamps
+opaque = "opaque"            # overwrite the destination with whole rows
+masked = "masked"            # overwrite the destination with the runs of opaque pixels, and leave the rest
+transparent = "transparent"  # nothing
+mixed = "mixed"              # alpha blend with ImageBuffer.paste
+
+class Frame:
+  def __init__(self, image):
+    self.image = image
+    self.width = image.width
+    self.height = image.height
+    # (y, x, pixels) for each run of fully opaque pixels
+    self.runs = []
+    alphas = set()
+    for y in range(image.height):
+      row = image.data[y*image.width:(y+1)*image.width]
+      x = 0
+      while x < image.width:
+        alpha = row[x] & 0xff
+        alphas.add(alpha)
+        end = x + 1
+        while end < image.width and row[end] & 0xff == alpha:
+          end += 1
+        if alpha == 0xff:
+          self.runs.append((y, x, row[x:end]))
+        x = end
+    if alphas == {0xff}:
+      self.kind = opaque
+    elif alphas <= {0}:
+      self.kind = transparent
+    elif alphas == {0, 0xff}:
+      self.kind = masked
+    else:
+      self.kind = mixed
+
+  def paste(self, image, dx, dy):
+    """pastes the frame with its top left corner at dx,dy, clipped to the image"""
+    if self.kind == transparent:
+      return
+    if self.kind == mixed or not isinstance(image, simplepng.ImageBuffer):
+      # anything that stands in for an image, like buildmap2.ImageRegion, does its own clipping
+      image.paste(self.image, dx=dx, dy=dy, width=self.width, height=self.height)
+      return
+    data = image.data
+    inside = dx >= 0 and dy >= 0 and dx + self.width <= image.width and dy + self.height <= image.height
+    pixels = 0
+    for y, x, run in self.runs:
+      ty = dy + y
+      tx = dx + x
+      if inside:
+        start = ty * image.width + tx
+        data[start:start+len(run)] = run
+        pixels += len(run)
+        continue
+      if not 0 <= ty < image.height: continue
+      first = max(0, -tx)
+      last = min(len(run), image.width - tx)
+      if first >= last: continue
+      start = ty * image.width + tx
+      data[start+first:start+last] = run[first:last]
+      pixels += last - first
+    renderprofile.count_paste(pixels)
+
+class FrameAtlas:
+  def __init__(self):
+    # (id(sprite), sx, sy, width, height, flip_h, rotate) -> the Frame, or None if it couldn't be cut out
+    self.frames = {}
+    # keeps the sprites alive so their ids don't get reused
+    self.sprites = {}
+    self.hits = 0
+    self.misses = 0
+
+  def get_frame(self, sprite, sx, sy, width, height, flip_h, rotate):
+    key = (id(sprite), sx, sy, width, height, flip_h, rotate)
+    try:
+      frame = self.frames[key]
+      self.hits += 1
+      return frame
+    except KeyError:
+      pass
+    self.misses += 1
+    self.sprites[id(sprite)] = sprite
+    frame_image = cut_frame(sprite, sx, sy, width, height, flip_h, rotate)
+    frame = None if frame_image == None else Frame(frame_image)
+    self.frames[key] = frame
+    return frame
+
+  def forget(self, sprite):
+    """drops the frames cut out of sprite, for when it's been reloaded"""
+    if self.sprites.pop(id(sprite), None) == None: return
+    for key in [key for key in self.frames if key[0] == id(sprite)]:
+      del self.frames[key]
+
+  def clear(self):
+    self.frames.clear()
+    self.sprites.clear()
+
+  def paste(self, image, sprite, sx=0, sy=0, dx=0, dy=0, width=16, height=16, flip_h=False, rotate=0):
+    """same as image.paste(sprite, ...), but the transform and finding out which pixels need blending are only done once per frame.
+    most sprite pixels are either fully opaque or fully transparent, so most pastes are just copies of the opaque runs."""
+    frame = self.get_frame(sprite, sx, sy, width, height, flip_h, rotate)
+    if frame == None:
+      image.paste(sprite, sx=sx, sy=sy, dx=dx, dy=dy, width=width, height=height, flip_h=flip_h, rotate=rotate)
+      return
+    frame.paste(image, dx, dy)
+
+def cut_frame(sprite, sx, sy, width, height, flip_h, rotate):
+  """returns an image of the given paste with the transform applied, or None if the transform does something we can't reproduce."""
+  if rotate == 0:
+    frame_width, frame_height = width, height
+  else:
+    frame_width, frame_height = height, width
+  # let simplepng do the transform on an image of source positions,
+  # so we find out where each pixel goes without doing any blending.
+  # position i is stored as i+1 with full alpha. 0 means nothing landed there.
+  positions = simplepng.ImageBuffer(width, height)
+  source_count = 0
+  for y in range(height):
+    source_y = sy + y
+    if not 0 <= source_y < sprite.height: continue
+    for x in range(width):
+      source_x = sx + x
+      if not 0 <= source_x < sprite.width: continue
+      positions.data[y*width+x] = ((source_y * sprite.width + source_x + 1) << 8) | 0xff
+      source_count += 1
+  placed = simplepng.ImageBuffer(frame_width, frame_height)
+  placed.paste(positions, dx=0, dy=0, width=width, height=height, flip_h=flip_h, rotate=rotate)
+
+  frame_image = simplepng.ImageBuffer(frame_width, frame_height)
+  placed_count = 0
+  for i, position in enumerate(placed.data):
+    if position == 0: continue
+    frame_image.data[i] = sprite.data[(position >> 8) - 1]
+    placed_count += 1
+  if placed_count != source_count:
+    # some of it landed outside the frame rectangle
+    return None
+  return frame_image
@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+
+"""Run with: python3 -m unittest test_imagefilters"""
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+sys.path.append(os.path.join(os.path.dirname(__file__), "simplepng.py"))
+import simplepng
+import imagefilters
+import pngcache
+import pngstream
+
+class FadeCachedTilesetTest(unittest.TestCase):
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.path = os.path.join(self.directory, "tiles.png")
+    image = simplepng.ImageBuffer(4, 2)
+    for i in range(len(image.data)):
+      image.data[i] = 0x11223300 | (i * 0x21 + 0x80) & 0xff
+    self.pixels = list(image.data)
+    with open(self.path, "wb") as f:
+      pngstream.write_png(f, image)
+    self.cache = pngcache.PngCache(os.path.join(self.directory, "cache"), 1024 * 1024)
+    self.use_numpy = imagefilters.use_numpy
+
+  def tearDown(self):
+    imagefilters.use_numpy = self.use_numpy
+    shutil.rmtree(self.directory)
+
+  def read_faded(self):
+    with open(self.path, "rb") as f:
+      image = self.cache.read_png(f)
+    imagefilters.fade(image)
+    return list(image.data)
+
+  def check_fade_twice(self):
+    faded = [(v & ~0xff) | (v & 0x7f) for v in self.pixels]
+    # the first read decodes the png. the second one is a cache hit, which is a memoryview of the cache file.
+    self.assertEqual(self.read_faded(), faded)
+    self.assertEqual(self.read_faded(), faded)
+    # fading the cached pixels mustn't change the cache file
+    self.assertEqual(self.read_faded(), faded)
+
+  def test_fade_twice(self):
+    imagefilters.use_numpy = False
+    self.check_fade_twice()
+
+  @unittest.skipIf(imagefilters.numpy == None, "numpy isn't installed")
+  def test_fade_twice_numpy(self):
+    imagefilters.use_numpy = True
+    self.check_fade_twice()
+
+  def test_map_pixels_on_cached_pixels(self):
+    for _ in range(2):
+      with open(self.path, "rb") as f:
+        image = self.cache.read_png(f)
+      imagefilters.map_pixels(image, imagefilters.grayscale_pixel)
+      self.assertEqual(list(image.data), [imagefilters.grayscale_pixel(v) for v in self.pixels])
+
+if __name__ == "__main__":
+  unittest.main()
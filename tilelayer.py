@@ -0,0 +1,179 @@
+"""Tile layers parsed into uint16 grids, cached next to the CSV files they came from."""
+
+import os
+import sys
+import csv
+import io
+import mmap
+import array
+import struct
+import itertools
+
+# magic, version, source size, source mtime_ns, width, height
+header_format = "<4sIQqII"
+header_size = struct.calcsize(header_format)
+magic = b"ANOL"
+version = 1
+sidecar_extension = ".layer"
+
+class Layer:
+  def __init__(self, width, height, data):
+    self.width = width
+    self.height = height
+    # row-major tile indexes. either an array("H") or a memoryview cast to "H".
+    self.data = data
+
+  def get_distinct_tiles(self):
+    """the set of nonzero tile indexes in the layer"""
+    return set(self.data) - {0}
+
+class RunLengthLayer:
+  """a layer stored as runs of the same tile in each row, leaving out tile 0.
+  most layers are mostly empty or repetitive, so this is a lot smaller than a Layer."""
+  def __init__(self, width, height, runs, row_starts):
+    self.width = width
+    self.height = height
+    # array("H") of (x, length, tile_index) triples
+    self.runs = runs
+    # the runs of row y are the triples from row_starts[y] up to row_starts[y + 1]
+    self.row_starts = row_starts
+
+  def get_distinct_tiles(self):
+    """the set of nonzero tile indexes in the layer, straight from the runs"""
+    return set(self.runs[2::3])
+
+  @property
+  def data(self):
+    """the whole layer decoded, like Layer.data"""
+    data = array.array("H")
+    for y in range(self.height):
+      data.extend(get_row(self, y))
+    return data
+
+def find_runs(values, skip=0):
+  """returns (x, length, value) for each run of the same value, except for runs of skip"""
+  runs = []
+  x = 0
+  for value, group in itertools.groupby(values):
+    length = len(list(group))
+    if value != skip:
+      runs.append((x, length, value))
+    x += length
+  return runs
+
+def encode_runs(layer):
+  runs = array.array("H")
+  row_starts = array.array("I", [0])
+  for y in range(layer.height):
+    for run in get_row_runs(layer, y):
+      runs.extend(run)
+    row_starts.append(len(runs) // 3)
+  return RunLengthLayer(layer.width, layer.height, runs, row_starts)
+
+def get_row_runs(layer, y):
+  """returns (x, length, tile_index) for each run of the same nonzero tile in the row"""
+  if isinstance(layer, RunLengthLayer):
+    runs = layer.runs[layer.row_starts[y]*3:layer.row_starts[y+1]*3]
+    return [tuple(runs[i:i+3]) for i in range(0, len(runs), 3)]
+  start = y * layer.width
+  return find_runs(layer.data[start:start+layer.width])
+
+def get_row(layer, y):
+  if isinstance(layer, RunLengthLayer):
+    row = array.array("H", bytes(layer.width * 2))
+    for x, length, tile_index in get_row_runs(layer, y):
+      row[x:x+length] = array.array("H", [tile_index]) * length
+    return row
+  start = y * layer.width
+  return layer.data[start:start+layer.width]
+
+def count_distinct_tiles(layers):
+  """how many different nonzero tiles the layers use between them. None layers are skipped."""
+  tiles = set()
+  for layer in layers:
+    if layer == None: continue
+    tiles |= layer.get_distinct_tiles()
+  return len(tiles)
+
+def crop(layer, x, y, width, height):
+  """returns a copy of the given rectangle of tiles, clipped to the layer bounds"""
+  width = max(0, min(width, layer.width - x))
+  height = max(0, min(height, layer.height - y))
+  data = array.array("H")
+  for row in range(y, y + height):
+    data.extend(get_row(layer, row)[x:x+width])
+  return Layer(width, height, data)
+
+def find_changed_cells(old_layer, new_layer):
+  """the layers must be the same size. returns a list of (x, y) tile coordinates."""
+  changed = []
+  width = new_layer.width
+  for y in range(new_layer.height):
+    start = y * width
+    old_row = old_layer.data[start:start+width]
+    new_row = new_layer.data[start:start+width]
+    if old_row == new_row: continue
+    for x in range(width):
+      if old_row[x] != new_row[x]:
+        changed.append((x, y))
+  return changed
+
+def parse_csv(text):
+  rows = list(csv.reader(io.StringIO(text), delimiter=","))
+  if len(rows) == 0:
+    return Layer(0, 0, array.array("H"))
+  width = len(rows[0])
+  data = array.array("H")
+  for y, row in enumerate(rows):
+    if len(row) != width:
+      raise ValueError("row {} has {} cells instead of {}".format(y, len(row), width))
+    data.extend(int(cell) for cell in row)
+  return Layer(width, len(rows), data)
+
+def read_sidecar(path, source_stat):
+  with open(path, "rb") as f:
+    contents = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+  if len(contents) < header_size:
+    return None
+  file_magic, file_version, source_size, source_mtime_ns, width, height = struct.unpack_from(header_format, contents)
+  if (file_magic, file_version) != (magic, version):
+    return None
+  if (source_size, source_mtime_ns) != (source_stat.st_size, source_stat.st_mtime_ns):
+    # the csv changed since we parsed it
+    return None
+  if len(contents) != header_size + width * height * 2:
+    return None
+  if sys.byteorder == "little":
+    data = memoryview(contents)[header_size:].cast("H")
+  else:
+    data = array.array("H", contents[header_size:])
+    data.byteswap()
+  return Layer(width, height, data)
+
+def write_sidecar(path, source_stat, layer):
+  data = array.array("H", layer.data)
+  if sys.byteorder != "little":
+    data.byteswap()
+  tmp_path = path + ".tmp"
+  with open(tmp_path, "wb") as f:
+    f.write(struct.pack(header_format, magic, version, source_stat.st_size, source_stat.st_mtime_ns, layer.width, layer.height))
+    f.write(data.tobytes())
+  os.replace(tmp_path, path)
+
+def load_layer(f):
+  """f is the open csv file. its parsed form is reused from the sidecar file if it's up to date."""
+  source_stat = os.fstat(f.fileno())
+  sidecar_path = f.name + sidecar_extension
+  try:
+    layer = read_sidecar(sidecar_path, source_stat)
+    if layer != None:
+      return layer
+  except (OSError, ValueError):
+    pass
+  layer = parse_csv(f.read().decode("utf8"))
+  try:
+    write_sidecar(sidecar_path, source_stat, layer)
+  except OSError:
+    # read-only source directory or something. just parse it again next time.
+    pass
+  return layer
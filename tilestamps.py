@@ -0,0 +1,78 @@
+"""Each tile of a tileset cut out once, so painting a layer doesn't re-read and alpha blend the tileset for every cell."""
+
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(__file__), "simplepng.py"))
+import simplepng
+import renderprofile
+
+# what pasting a stamp has to do
+opaque = "opaque"            # overwrite the destination
+transparent = "transparent"  # nothing
+mixed = "mixed"              # alpha blend with ImageBuffer.paste
+
+class Stamp:
+  def __init__(self, kind, image):
+    self.kind = kind
+    # 16x16, the same kind of image as the ones it gets pasted into
+    self.image = image
+    self.rows = [image.data[y*16:(y+1)*16] for y in range(16)]
+
+class StampCache:
+  def __init__(self, tileset):
+    self.tileset = tileset
+    self.tiles_per_row = tileset.width // 16
+    # tile index -> Stamp, only for the tiles that have been used
+    self.stamps = {}
+
+  def get_stamp(self, tile_index):
+    stamp = self.stamps.get(tile_index)
+    if stamp == None:
+      stamp = self.stamps[tile_index] = cut_stamp(self.tileset, tile_index, self.tiles_per_row)
+    return stamp
+
+  def paste(self, image, tile_index, x, y, count=1):
+    """pastes the tile count times in a row, starting at tile x,y. the tiles have to fit in the image.
+    for count > 1, the image has to be transparent there, like a new layer image is,
+    because only the first copy of a mixed tile is blended and the rest are copies of it."""
+    stamp = self.get_stamp(tile_index)
+    if stamp.kind == transparent:
+      return
+    data = image.data
+    if stamp.kind == opaque:
+      for row, tile_row in enumerate(stamp.rows):
+        start = (y*16 + row) * image.width + x*16
+        data[start:start+16*count] = tile_row * count
+      renderprofile.count_paste(16*16*count, count)
+      return
+    image.paste(stamp.image, dx=x*16, dy=y*16, width=16, height=16)
+    if count == 1: return
+    renderprofile.count_paste(16*16*(count - 1), count - 1)
+    for row in range(y*16, y*16 + 16):
+      start = row * image.width + x*16
+      data[start+16:start+16*count] = data[start:start+16] * (count - 1)
+
+def cut_stamp(tileset, tile_index, tiles_per_row):
+  """anything outside the tileset is left transparent, the same as a clipped paste"""
+  image = simplepng.ImageBuffer(16, 16)
+  sx = (tile_index % tiles_per_row) * 16
+  sy = (tile_index // tiles_per_row) * 16
+  alphas = set()
+  for y in range(16):
+    if not 0 <= sy + y < tileset.height:
+      alphas.add(0)
+      continue
+    for x in range(16):
+      if not 0 <= sx + x < tileset.width:
+        alphas.add(0)
+        continue
+      v = tileset.data[(sy + y) * tileset.width + sx + x]
+      image.data[y*16+x] = v
+      alphas.add(v & 0xff)
+  if alphas == {0xff}:
+    kind = opaque
+  elif alphas == {0}:
+    kind = transparent
+  else:
+    kind = mixed
+  return Stamp(kind, image)